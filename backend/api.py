@@ -1,21 +1,162 @@
 import os
 import io
 import time
-import json
+startup_start = time.perf_counter()  # Taken before the heavier imports so they show up in the startup log
+import asyncio
+import base64
+import binascii
+import tarfile
+import zipfile
 import numpy as np
-import cv2
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, Response
 from pydantic import BaseModel
 from improved_parts_classifier import ImprovedPartsClassifier
+from batcher import MicroBatcher
+from prediction_cache import PredictionCache
+from part_catalog import PartCatalog, dumps
+from embedding_index import EmbeddingIndex, similarity_probabilities, combine_probabilities
+from tta import DEFAULT_VIEWS, augment, average_views
+import detection
+from metrics import Registry, process_rss_bytes
+import preprocessing
 import uvicorn
-import tensorflow as tf
+
+# Startup time per phase, logged as each finishes and reported by /health
+startup_timings = {}
+
+def record_phase(name, phase_start):
+    startup_timings[name] = time.perf_counter() - phase_start
+    print(f"Startup phase '{name}' took {startup_timings[name]:.2f} seconds")
+
+record_phase("imports", startup_start)
+
+# Micro-batching settings: requests are coalesced for up to BATCH_MAX_DELAY_MS
+# or until BATCH_MAX_SIZE images are waiting, whichever comes first
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "16"))
+BATCH_MAX_DELAY_MS = float(os.environ.get("BATCH_MAX_DELAY_MS", "5"))
+
+# Thread settings: decode/preprocessing and inference run on their own bounded
+# executors so the event loop stays free for health checks and new uploads
+PREPROCESS_THREADS = int(os.environ.get("PREPROCESS_THREADS", str(min(4, os.cpu_count() or 1))))
+PREPROCESS_MAX_PENDING = int(os.environ.get("PREPROCESS_MAX_PENDING", str(4 * PREPROCESS_THREADS)))
+INFERENCE_THREADS = int(os.environ.get("INFERENCE_THREADS", "1"))
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", "0"))  # 0 lets TensorFlow decide
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", "0"))
+# Keras backend only: bfloat16 compute and an XLA-compiled forward pass
+KERAS_PRECISION = os.environ.get("KERAS_PRECISION", "float32")
+KERAS_JIT_COMPILE = os.environ.get("KERAS_JIT_COMPILE", "0") == "1"
+
+# /predict_batch limits: total images accepted per request, and the largest
+# chunk sent through the model at once (bounds peak memory)
+PREDICT_BATCH_MAX_FILES = int(os.environ.get("PREDICT_BATCH_MAX_FILES", "256"))
+PREDICT_BATCH_CHUNK_SIZE = int(os.environ.get("PREDICT_BATCH_CHUNK_SIZE", "64"))
+
+# Prediction cache: identical uploads (retries, re-renders, duplicate scans) reuse
+# the earlier model output. PREDICTION_CACHE_SIZE=0 disables it; set
+# PREDICTION_CACHE_PATH to share entries between workers through a SQLite file
+PREDICTION_CACHE_SIZE = int(os.environ.get("PREDICTION_CACHE_SIZE", "1024"))
+PREDICTION_CACHE_TTL = float(os.environ.get("PREDICTION_CACHE_TTL", "3600"))
+PREDICTION_CACHE_PATH = os.environ.get("PREDICTION_CACHE_PATH")
+
+# Fast responses: build prediction JSON directly (orjson when installed) with the
+# part details spliced in pre-serialized, instead of validating through Pydantic
+FAST_RESPONSES = os.environ.get("FAST_RESPONSES", "1") == "1"
+# How often (seconds) to check Details.json for changes
+DETAILS_RELOAD_INTERVAL = float(os.environ.get("DETAILS_RELOAD_INTERVAL", "2"))
+
+# Embedding index: parts enrolled from a few reference photos (POST /index/enroll
+# or build_embedding_index.py) are recognised without retraining. PREDICT_MODE is
+# the default answer: 'softmax' (the model's head), 'index' (the nearest enrolled
+# class) or 'combined' (INDEX_WEIGHT of the index averaged with the head); the
+# index needs the keras backend
+EMBEDDING_INDEX_PATH = os.environ.get("EMBEDDING_INDEX_PATH")
+PREDICT_MODES = ["softmax", "index", "combined"]
+PREDICT_MODE = os.environ.get("PREDICT_MODE", "softmax")
+INDEX_WEIGHT = float(os.environ.get("INDEX_WEIGHT", "0.5"))
+INDEX_TEMPERATURE = float(os.environ.get("INDEX_TEMPERATURE", "0.05"))
+INDEX_REDUCE = os.environ.get("INDEX_REDUCE", "centroid")
+if PREDICT_MODE not in PREDICT_MODES:
+    raise ValueError(f"PREDICT_MODE must be one of {PREDICT_MODES}, got '{PREDICT_MODE}'")
+if PREDICT_MODE != "softmax" and not EMBEDDING_INDEX_PATH:
+    raise ValueError(f"PREDICT_MODE={PREDICT_MODE} needs EMBEDDING_INDEX_PATH")
+
+# Test-time augmentation: predictions less than TTA_THRESHOLD confident (0: every
+# prediction) are averaged with the model's outputs for flipped, cropped and
+# rotated views of the image. TTA_ENABLED is the default for the tta query parameter
+TTA_ENABLED = os.environ.get("TTA_ENABLED", "0") == "1"
+TTA_THRESHOLD = float(os.environ.get("TTA_THRESHOLD", "0.7"))
+
+# Detection (POST /detect): candidate regions of a shelf or bin photo are
+# classified in one batch; DETECT_SCALES are window sides as fractions of the
+# image's short side, DETECT_MAX_SIDE the longest side crops are cut from
+DETECT_PROPOSALS = os.environ.get("DETECT_PROPOSALS", "windows")
+DETECT_SCALES = tuple(float(scale) for scale in os.environ.get("DETECT_SCALES", "1.0,0.6,0.35").split(","))
+DETECT_OVERLAP = float(os.environ.get("DETECT_OVERLAP", "0.5"))
+DETECT_MAX_SIDE = int(os.environ.get("DETECT_MAX_SIDE", "1024"))
+DETECT_MIN_CONFIDENCE = float(os.environ.get("DETECT_MIN_CONFIDENCE", "0.5"))
+DETECT_IOU_THRESHOLD = float(os.environ.get("DETECT_IOU_THRESHOLD", "0.4"))
+DETECT_MAX_DETECTIONS = int(os.environ.get("DETECT_MAX_DETECTIONS", "20"))
+if DETECT_PROPOSALS not in detection.PROPOSAL_METHODS:
+    raise ValueError(f"DETECT_PROPOSALS must be one of {list(detection.PROPOSAL_METHODS)}, got '{DETECT_PROPOSALS}'")
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png']
+ARCHIVE_EXTENSIONS = ['.zip', '.tar', '.tgz', '.gz', '.bz2', '.xz']
+
+def configure_tensorflow():
+    """
+    Import TensorFlow and apply the thread settings
+
+    TensorFlow only honours these before it runs its first op, so this must run
+    before the model is loaded. TFLite and ONNX serving never import TensorFlow here.
+    """
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+    tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+
+preprocess_executor = ThreadPoolExecutor(max_workers=PREPROCESS_THREADS, thread_name_prefix="preprocess")
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_THREADS, thread_name_prefix="inference")
+# The cascade's large model gets its own thread, so escalations never hold up the small model
+cascade_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cascade")
+# Caps how many uploads can be decoded (and held in memory) at once; created in
+# lifespan so it binds to the server's event loop
+preprocess_slots = None
+
+@asynccontextmanager
+async def lifespan(app):
+    global preprocess_slots
+    preprocess_slots = asyncio.Semaphore(PREPROCESS_MAX_PENDING)
+    
+    # uvicorn only starts accepting connections once this block finishes, so
+    # /health can't report ready before the model is loaded and warmed up
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(inference_executor, load_model)
+    await loop.run_in_executor(inference_executor, warm_up)
+    
+    await batcher.start()
+    print(f"Micro-batcher started (max batch size {BATCH_MAX_SIZE}, max delay {BATCH_MAX_DELAY_MS} ms)")
+    if cascade_batcher is not None:
+        await cascade_batcher.start()
+        print(f"Cascade enabled: predictions below {CASCADE_THRESHOLD:.2f} confidence go to {CASCADE_MODEL_PATH}")
+    record_phase("total", startup_start)
+    yield
+    await batcher.stop()
+    if cascade_batcher is not None:
+        await cascade_batcher.stop()
+    preprocess_executor.shutdown(wait=False)
+    inference_executor.shutdown(wait=False)
+    cascade_executor.shutdown(wait=False)
 
 # Initialize the FastAPI app
 app = FastAPI(
     title="Spare Parts Image Classifier API",
     description="API for classifying spare parts in images",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Add CORS middleware to allow cross-origin requests from any origin
@@ -28,49 +169,386 @@ app.add_middleware(
     expose_headers=["*"],  # Expose all headers
 )
 
+# Metrics served at /metrics in the Prometheus text format
+metrics_registry = Registry()
+STAGE_SECONDS = metrics_registry.histogram(
+    "spare_parts_stage_seconds", "Time spent in each stage of handling a prediction", ["stage"])
+REQUESTS_TOTAL = metrics_registry.counter(
+    "spare_parts_http_requests_total", "HTTP requests by route, method and status code", ["path", "method", "status"])
+REQUEST_SECONDS = metrics_registry.histogram(
+    "spare_parts_http_request_seconds", "End-to-end HTTP request latency by route", ["path"])
+REQUESTS_IN_FLIGHT = metrics_registry.gauge(
+    "spare_parts_http_requests_in_flight", "HTTP requests currently being handled")
+BATCH_SIZE = metrics_registry.histogram(
+    "spare_parts_batch_size", "Images per forward pass", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+CASCADE_PREDICTIONS = metrics_registry.counter(
+    "spare_parts_cascade_predictions_total", "Predictions by the cascade tier that answered them", ["tier"])
+CASCADE_SECONDS = metrics_registry.histogram(
+    "spare_parts_cascade_seconds", "Batching and model time per prediction by the cascade tier that answered it",
+    ["tier"])
+TTA_PREDICTIONS = metrics_registry.counter(
+    "spare_parts_tta_predictions_total", "Predictions averaged over augmented views")
+metrics_registry.counter(
+    "spare_parts_prediction_cache_hits_total", "Prediction cache hits",
+    function=lambda: prediction_cache.hits if prediction_cache else 0)
+metrics_registry.counter(
+    "spare_parts_prediction_cache_misses_total", "Prediction cache misses",
+    function=lambda: prediction_cache.misses if prediction_cache else 0)
+metrics_registry.gauge(
+    "spare_parts_prediction_cache_hit_ratio", "Share of prediction cache lookups that hit",
+    function=lambda: prediction_cache.stats()["hit_rate"] if prediction_cache else 0)
+metrics_registry.gauge(
+    "process_resident_memory_bytes", "Resident memory size in bytes", function=process_rss_bytes)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    REQUESTS_IN_FLIGHT.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        REQUESTS_IN_FLIGHT.dec()
+        # Label by route template rather than raw URL to keep the label set bounded
+        route = request.scope.get("route")
+        path = route.path if route is not None else "unmatched"
+        REQUESTS_TOTAL.inc(path=path, method=request.method, status=status)
+        REQUEST_SECONDS.observe(time.perf_counter() - start, path=path)
+
+def record_batch(batch_size, inference_time):
+    BATCH_SIZE.observe(batch_size)
+    STAGE_SECONDS.observe(inference_time, stage="inference")
+
+def record_cascade_batch(batch_size, inference_time):
+    STAGE_SECONDS.observe(inference_time, stage="cascade_inference")
+
+# Inference backend: 'keras' serves the .h5 model; 'savedmodel', 'tflite' and
+# 'onnx' serve an export produced by convert_model.py (see MODEL_PATH)
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "keras")
+DEFAULT_MODEL_PATHS = {
+    "keras": "improved_parts_modelv4.h5",
+    "savedmodel": "improved_parts_modelv4_savedmodel",
+    "tflite": "improved_parts_modelv4.tflite",
+    "onnx": "improved_parts_modelv4.onnx"
+}
+
 # Initialize the classifier globally for faster predictions
-model_path = "improved_parts_modelv4.h5"  # Updated path relative to container
+model_path = os.environ.get("MODEL_PATH", DEFAULT_MODEL_PATHS.get(INFERENCE_BACKEND))  # Updated path relative to container
 details_json_path = "Details.json"  # Updated path relative to container
-IMG_SIZE = (224, 224)  # Default model input size
 
-# Load part details from JSON file
-try:
-    with open(details_json_path, 'r') as f:
-        parts_details = json.load(f)
-    print(f"Parts details loaded from {details_json_path}")
-    
-    # Create a mapping from class indices to part names based on the index in the JSON
-    idx_to_class = {part["index"]: part["part_name"] for part in parts_details}
-    print(f"Created mapping for {len(idx_to_class)} classes from Details.json")
-except Exception as e:
-    print(f"Error loading parts details: {e}")
-    parts_details = []
-    idx_to_class = {}
+# Cascade: MODEL_PATH (e.g. a model trained with --model_choice mobilenet) answers
+# every request, and images it is less than CASCADE_THRESHOLD confident about are
+# sent on to the large CASCADE_MODEL_PATH, batched separately on its own thread
+CASCADE_MODEL_PATH = os.environ.get("CASCADE_MODEL_PATH")
+CASCADE_BACKEND = os.environ.get("CASCADE_BACKEND", "keras")
+CASCADE_THRESHOLD = float(os.environ.get("CASCADE_THRESHOLD", "0.8"))
+CASCADE_BATCH_MAX_SIZE = int(os.environ.get("CASCADE_BATCH_MAX_SIZE", str(BATCH_MAX_SIZE)))
+CASCADE_BATCH_MAX_DELAY_MS = float(os.environ.get("CASCADE_BATCH_MAX_DELAY_MS", str(BATCH_MAX_DELAY_MS)))
+IMG_SIZE = (224, 224)  # Default model input size
 
-# Track the loading time
-loading_start = time.time()
+# Load part details from JSON file, indexed by class index and reloaded when the file changes
+phase_start = time.perf_counter()
+catalog = PartCatalog(details_json_path, reload_interval=DETAILS_RELOAD_INTERVAL)
+record_phase("details_json", phase_start)
 
-# Initialize the classifier
+# Initialize the classifier; the model itself is loaded on server startup (see lifespan)
 classifier = ImprovedPartsClassifier(
     data_dir=None,  # Not needed for prediction
-    img_size=IMG_SIZE
+    img_size=IMG_SIZE,
+    precision=KERAS_PRECISION,
+    jit_compile=KERAS_JIT_COMPILE
 )
 
-# Load the model but without relying on the class indices from pkl
-try:
-    # Load the model directly using TensorFlow
-    if os.path.exists(model_path):
-        classifier.model = tf.keras.models.load_model(model_path)
-        # Override the classifier's idx_to_class with our JSON-based mapping
-        classifier.idx_to_class = idx_to_class
-        print("Model loaded successfully")
-    else:
-        raise FileNotFoundError(f"Model file {model_path} not found")
-except Exception as e:
-    raise RuntimeError(f"Failed to load model from {model_path}: {str(e)}")
+cascade_classifier = None
+if CASCADE_MODEL_PATH:
+    cascade_classifier = ImprovedPartsClassifier(
+        data_dir=None,
+        img_size=IMG_SIZE,
+        precision=KERAS_PRECISION if CASCADE_BACKEND == "keras" else "float32",
+        jit_compile=KERAS_JIT_COMPILE and CASCADE_BACKEND == "keras"
+    )
+# Predictions answered by each cascade tier, for /health
+cascade_counts = {"small": 0, "large": 0}
+
+# Set by load_model(); cache keys include it so a new model never serves stale outputs
+MODEL_VERSION = None
+
+embedding_index = None
+if EMBEDDING_INDEX_PATH:
+    embedding_index = EmbeddingIndex(EMBEDDING_INDEX_PATH, reduce=INDEX_REDUCE,
+                                     reload_interval=DETAILS_RELOAD_INTERVAL)
+# Length of the embedding appended to each model output row; set by load_model()
+EMBEDDING_DIM = 0
+
+def load_model():
+    """
+    Load the model into the configured inference backend
+    """
+    global MODEL_VERSION, EMBEDDING_DIM
+    
+    backends = {INFERENCE_BACKEND, CASCADE_BACKEND} if cascade_classifier is not None else {INFERENCE_BACKEND}
+    if backends & {"keras", "savedmodel"}:
+        phase_start = time.perf_counter()
+        configure_tensorflow()
+        record_phase("tensorflow_import", phase_start)
+    
+    # Load the model but without relying on the class indices from pkl
+    phase_start = time.perf_counter()
+    try:
+        if os.path.exists(model_path):
+            classifier.load_backend(INFERENCE_BACKEND, model_path, num_threads=TF_INTRA_OP_THREADS or None)
+            # Override the classifier's idx_to_class with our JSON-based mapping
+            classifier.idx_to_class = catalog.idx_to_class
+            print(f"Model loaded successfully ({INFERENCE_BACKEND} backend)")
+        else:
+            raise FileNotFoundError(f"Model file {model_path} not found")
+    except Exception as e:
+        raise RuntimeError(f"Failed to load model from {model_path}: {str(e)}")
+    record_phase("model_load", phase_start)
+    
+    cascade_version = ""
+    if cascade_classifier is not None:
+        phase_start = time.perf_counter()
+        if not os.path.exists(CASCADE_MODEL_PATH):
+            raise RuntimeError(f"Cascade model {CASCADE_MODEL_PATH} not found")
+        cascade_classifier.load_backend(CASCADE_BACKEND, CASCADE_MODEL_PATH, num_threads=TF_INTRA_OP_THREADS or None)
+        print(f"Cascade model loaded ({CASCADE_BACKEND} backend)")
+        record_phase("cascade_model_load", phase_start)
+        cascade_stat = os.stat(CASCADE_MODEL_PATH)
+        cascade_version = (f":cascade:{os.path.basename(CASCADE_MODEL_PATH)}:{cascade_stat.st_size}"
+                           f":{int(cascade_stat.st_mtime)}:{CASCADE_THRESHOLD}")
+    
+    if embedding_index is not None:
+        if INFERENCE_BACKEND != "keras":
+            raise RuntimeError("EMBEDDING_INDEX_PATH needs INFERENCE_BACKEND=keras")
+        EMBEDDING_DIM = classifier.embedding_dim
+        if embedding_index.dim is not None and embedding_index.dim != EMBEDDING_DIM:
+            raise RuntimeError(f"The embedding index at {EMBEDDING_INDEX_PATH} holds {embedding_index.dim}-d "
+                               f"embeddings, but the model produces {EMBEDDING_DIM}-d ones")
+        print(f"Embedding index loaded ({len(embedding_index)} references, {embedding_index.num_labels} classes)")
+    
+    model_stat = os.stat(model_path)
+    MODEL_VERSION = os.environ.get(
+        "MODEL_VERSION",
+        f"{INFERENCE_BACKEND}:{os.path.basename(model_path)}:{model_stat.st_size}:{int(model_stat.st_mtime)}"
+        f":{KERAS_PRECISION}{':embeddings' if embedding_index is not None else ''}{cascade_version}"
+    )
+
+def warm_up():
+    """
+    Run the model once at every batch size the batcher pads to, so graph tracing
+    and buffer allocation happen before the first real request
+    """
+    phase_start = time.perf_counter()
+    timings = batcher.warmup((*IMG_SIZE, 3))
+    for size, seconds in timings.items():
+        print(f"Warmup at batch size {size} took {seconds:.3f} seconds")
+    if cascade_batcher is not None:
+        for size, seconds in cascade_batcher.warmup((*IMG_SIZE, 3)).items():
+            print(f"Cascade warmup at batch size {size} took {seconds:.3f} seconds")
+        # The large model replaces the small model's probabilities, so both must score the same classes
+        image = np.zeros((1, *IMG_SIZE, 3), dtype=np.float32)
+        small_classes = classifier.predict_batch(image).shape[1]
+        large_classes = cascade_classifier.predict_batch(image).shape[1]
+        if small_classes != large_classes:
+            raise RuntimeError(f"The cascade model predicts {large_classes} classes, the main model {small_classes}")
+    record_phase("warmup", phase_start)
+
+prediction_cache = None
+if PREDICTION_CACHE_SIZE > 0:
+    prediction_cache = PredictionCache(
+        max_entries=PREDICTION_CACHE_SIZE,
+        ttl=PREDICTION_CACHE_TTL if PREDICTION_CACHE_TTL > 0 else None,
+        disk_path=PREDICTION_CACHE_PATH
+    )
+    print(f"Prediction cache enabled ({PREDICTION_CACHE_SIZE} entries, shared file: {PREDICTION_CACHE_PATH})")
+
+def model_outputs(images):
+    """
+    Forward pass behind the batcher and /predict_batch
+
+    With an embedding index, each row is the softmax output followed by the
+    image's embedding, so the index is consulted per request (see class_scores)
+    and cached rows stay valid when new parts are enrolled.
+    """
+    if embedding_index is None:
+        return classifier.predict_batch(images)
+    probabilities, embeddings = classifier.predict_with_embeddings(images)
+    return np.concatenate([probabilities, embeddings], axis=1)
+
+# One forward pass per chunk of up to PREDICT_BATCH_CHUNK_SIZE images (/predict_batch and /detect)
+def run_model(images):
+    outputs = []
+    for chunk_start in range(0, len(images), PREDICT_BATCH_CHUNK_SIZE):
+        chunk = images[chunk_start:chunk_start + PREDICT_BATCH_CHUNK_SIZE]
+        chunk_start_time = time.perf_counter()
+        outputs.append(model_outputs(chunk))
+        record_batch(len(chunk), time.perf_counter() - chunk_start_time)
+    return np.concatenate(outputs)
 
-loading_time = time.time() - loading_start
-print(f"Model loaded successfully in {loading_time:.2f} seconds")
+def class_scores(outputs, mode=PREDICT_MODE):
+    """
+    Class probabilities for model output rows under a prediction mode
+
+    Args:
+        outputs: One row or a (N, width) array from model_outputs
+        mode: 'softmax', 'index' or 'combined'
+
+    Returns:
+        Class probabilities with the same leading shape; index classes enrolled
+        after training extend past the softmax head's classes
+    """
+    if embedding_index is None:
+        return outputs
+    outputs = np.asarray(outputs)
+    rows = np.atleast_2d(outputs)
+    num_classes = rows.shape[1] - EMBEDDING_DIM
+    probabilities = rows[:, :num_classes]
+    embedding_index.maybe_reload()
+    # An empty index has nothing to say, so the head answers alone
+    if mode != "softmax" and len(embedding_index) > 0:
+        stage_start = time.perf_counter()
+        index_probabilities = similarity_probabilities(
+            embedding_index.similarities(rows[:, num_classes:], num_classes), INDEX_TEMPERATURE)
+        if mode == "index":
+            probabilities = index_probabilities
+        else:
+            probabilities = combine_probabilities(probabilities, index_probabilities, INDEX_WEIGHT)
+        STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="index_search")
+    return probabilities if outputs.ndim > 1 else probabilities[0]
+
+async def score_outputs(outputs, mode):
+    """
+    class_scores for a request handler, run off the event loop
+
+    With an embedding index, scoring may first reload an index saved by another
+    process and then multiplies against the reference matrix, neither of which
+    may stall the loop. It runs on the preprocessing pool rather than behind
+    the forward passes queued on the inference thread.
+    """
+    if embedding_index is None:
+        return outputs
+    return await asyncio.get_running_loop().run_in_executor(preprocess_executor, class_scores, outputs, mode)
+
+def check_mode(mode):
+    """
+    Resolve a request's mode parameter, rejecting modes this server can't answer
+    """
+    mode = mode or PREDICT_MODE
+    if mode not in PREDICT_MODES:
+        raise HTTPException(status_code=400, detail=f"mode must be one of {PREDICT_MODES}")
+    if mode != "softmax" and embedding_index is None:
+        raise HTTPException(status_code=400, detail=f"mode '{mode}' needs an embedding index (EMBEDDING_INDEX_PATH)")
+    return mode
+
+# All /predict calls share one batcher so concurrent requests run as one forward pass
+batcher = MicroBatcher(
+    model_outputs,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_delay=BATCH_MAX_DELAY_MS / 1000.0,
+    executor=inference_executor,
+    on_batch=record_batch
+)
+
+cascade_batcher = None
+if cascade_classifier is not None:
+    cascade_batcher = MicroBatcher(
+        cascade_classifier.predict_batch,
+        max_batch_size=CASCADE_BATCH_MAX_SIZE,
+        max_delay=CASCADE_BATCH_MAX_DELAY_MS / 1000.0,
+        executor=cascade_executor,
+        on_batch=record_cascade_batch
+    )
+
+def needs_escalation(outputs):
+    """
+    Which model output rows the small model is not confident enough about
+
+    Args:
+        outputs: (N, width) array from model_outputs
+
+    Returns:
+        Boolean array of shape (N,)
+    """
+    probabilities = outputs[:, :outputs.shape[1] - EMBEDDING_DIM]
+    return probabilities.max(axis=1) < CASCADE_THRESHOLD
+
+def escalated_outputs(outputs, large_probabilities):
+    """
+    Model output rows with the small model's probabilities replaced by the large model's
+
+    Any embedding columns stay, so the embedding index keeps working on escalated images.
+    """
+    if not EMBEDDING_DIM:
+        return large_probabilities
+    return np.concatenate([large_probabilities, outputs[:, outputs.shape[1] - EMBEDDING_DIM:]], axis=1)
+
+def needs_tta(outputs):
+    """
+    Which model output rows are unsure enough to be averaged over augmented views
+
+    Args:
+        outputs: (N, width) array from model_outputs (after any escalation)
+
+    Returns:
+        Boolean array of shape (N,)
+    """
+    if TTA_THRESHOLD <= 0:
+        return np.ones(len(outputs), dtype=bool)
+    probabilities = outputs[:, :outputs.shape[1] - EMBEDDING_DIM]
+    return probabilities.max(axis=1) < TTA_THRESHOLD
+
+async def refine_with_tta(image, prediction, escalated=False):
+    """
+    Average one prediction with the outputs for augmented views of its image
+
+    The views are submitted together, so they share a forward pass (with any
+    concurrent requests) on the batcher of the model that gave the prediction.
+
+    Args:
+        image: Preprocessed image of shape (*IMG_SIZE, 3)
+        prediction: Its model output row from submit()
+        escalated: Whether the cascade's large model answered it
+
+    Returns:
+        Model output row with the probabilities averaged over the original and its views
+    """
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    views = await loop.run_in_executor(preprocess_executor, augment, image[None], DEFAULT_VIEWS, False)
+    target = cascade_batcher if escalated else batcher
+    view_outputs = await asyncio.gather(*(target.submit(view) for view in views))
+    prediction = average_views(prediction[None], np.stack([row for row, _ in view_outputs]),
+                               len(prediction) - EMBEDDING_DIM)[0]
+    TTA_PREDICTIONS.inc()
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="tta")
+    return prediction
+
+async def submit(image):
+    """
+    Classify one preprocessed image through the batcher, and through the cascade's
+    large model as well when the small one is unsure
+
+    Returns:
+        row: Model output row for this image
+        stats: Batch stats from the small model's batcher, plus whether the image was escalated
+    """
+    start = time.perf_counter()
+    prediction, batch_stats = await batcher.submit(image)
+    if cascade_batcher is None:
+        return prediction, batch_stats
+    
+    tier = "small"
+    if needs_escalation(prediction[None])[0]:
+        tier = "large"
+        large_prediction, _ = await cascade_batcher.submit(image)
+        prediction = escalated_outputs(prediction[None], large_prediction[None])[0]
+    cascade_counts[tier] += 1
+    CASCADE_PREDICTIONS.inc(tier=tier)
+    CASCADE_SECONDS.observe(time.perf_counter() - start, tier=tier)
+    return prediction, {**batch_stats, "escalated": tier == "large"}
 
 # Response model
 class PredictionResponse(BaseModel):
@@ -78,6 +556,185 @@ class PredictionResponse(BaseModel):
     confidence: float
     processing_time: float
     part_details: dict = None
+    queue_wait: float = None
+    batch_size: int = None
+    cached: bool = False
+    escalated: bool = None
+    tta: bool = None
+
+class BatchPredictionItem(BaseModel):
+    filename: str
+    predicted_class: str = None
+    confidence: float = None
+    part_details: dict = None
+    cached: bool = False
+    escalated: bool = None
+    tta: bool = None
+    error: str = None
+
+class BatchPredictionResponse(BaseModel):
+    results: List[BatchPredictionItem]
+    processing_time: float
+    batch_size: int
+
+class Detection(BaseModel):
+    box: List[int]
+    predicted_class: str
+    confidence: float
+    part_details: dict = None
+
+class DetectionResponse(BaseModel):
+    detections: List[Detection]
+    image_size: List[int]
+    num_proposals: int
+    processing_time: float
+
+def decode_and_preprocess(contents, out=None):
+    """
+    Decode uploaded image bytes and turn them into a normalized model input
+
+    Runs on the preprocessing executor, never on the event loop.
+
+    Args:
+        contents: Raw bytes of the uploaded image file
+        out: Optional float32 array of shape (*IMG_SIZE, 3) to write into
+
+    Returns:
+        Float32 array of shape (*IMG_SIZE, 3), or None if the bytes are not a valid image
+    """
+    stage_start = time.perf_counter()
+    image = preprocessing.decode_image(contents, IMG_SIZE)
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="decode")
+    if image is None:
+        return None
+    
+    stage_start = time.perf_counter()
+    if out is None:
+        out = np.empty((*IMG_SIZE, 3), dtype=np.float32)
+    preprocessing.preprocess_into(image, out)
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="preprocess")
+    return out
+
+def prepare_detection(contents, proposals):
+    """
+    Decode an upload for detection and cut its candidate regions into one batch
+
+    Runs on the preprocessing executor.
+
+    Returns:
+        (float32 crops of shape (K, *IMG_SIZE, 3), (K, 4) boxes in the working
+        image, (y, x) scale to the original image, original (width, height)),
+        or None if the bytes are not a valid image
+    """
+    stage_start = time.perf_counter()
+    image, scale = detection.decode_for_detection(contents, IMG_SIZE, DETECT_SCALES, DETECT_MAX_SIDE)
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="decode")
+    if image is None:
+        return None
+    
+    stage_start = time.perf_counter()
+    boxes = detection.propose(image, proposals, DETECT_SCALES, DETECT_OVERLAP)
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="proposals")
+    
+    stage_start = time.perf_counter()
+    crops = detection.crop_batch(image, boxes, IMG_SIZE)
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="preprocess")
+    image_size = [round(image.shape[1] * scale[1]), round(image.shape[0] * scale[0])]
+    return crops, boxes, scale, image_size
+
+def extract_archive(contents):
+    """
+    Pull image files out of an uploaded zip or tar archive
+
+    Args:
+        contents: Raw bytes of the archive
+
+    Returns:
+        List of (filename, bytes) tuples in archive order, images only
+    """
+    entries = []
+    buffer = io.BytesIO(contents)
+    if zipfile.is_zipfile(buffer):
+        with zipfile.ZipFile(buffer) as archive:
+            for info in archive.infolist():
+                if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in IMAGE_EXTENSIONS:
+                    entries.append((info.filename, archive.read(info)))
+    else:
+        buffer.seek(0)
+        with tarfile.open(fileobj=buffer, mode="r:*") as archive:
+            for member in archive:
+                if member.isfile() and os.path.splitext(member.name)[1].lower() in IMAGE_EXTENSIONS:
+                    entries.append((member.name, archive.extractfile(member).read()))
+    return entries
+
+def lookup_cache(contents, tta=False):
+    """
+    Hash uploaded bytes and look them up in the prediction cache
+
+    Runs on the preprocessing executor since hashing large uploads takes a while.
+
+    Args:
+        contents: Raw bytes of the uploaded image file
+        tta: Whether the request asked for test-time augmentation, which is cached separately
+
+    Returns:
+        Tuple of (cache key, cached output or None)
+    """
+    version = f"{MODEL_VERSION}:tta{TTA_THRESHOLD}" if tta else MODEL_VERSION
+    key = prediction_cache.make_key(contents, version)
+    return key, prediction_cache.get(key)
+
+def describe_prediction(prediction):
+    """
+    Turn one row of model output into the class name, confidence and part details
+
+    Args:
+        prediction: Model output row (class probabilities)
+
+    Returns:
+        Dictionary with predicted_class, confidence and part_details
+    """
+    pred_idx = int(np.argmax(prediction))
+    return {
+        "predicted_class": catalog.name(pred_idx),
+        "confidence": float(prediction[pred_idx]),
+        "part_details": catalog.get(pred_idx)
+    }
+
+def prediction_json(prediction, **fields):
+    """
+    Serialize one prediction plus extra fields straight to JSON bytes
+
+    The part details are spliced in from the catalogue's pre-serialized payload
+    rather than encoded again.
+
+    Args:
+        prediction: Model output row (class probabilities)
+        **fields: Extra top-level fields (timings, filename, ...)
+
+    Returns:
+        JSON object as bytes
+    """
+    pred_idx = int(np.argmax(prediction))
+    body = dumps({
+        "predicted_class": catalog.name(pred_idx),
+        "confidence": float(prediction[pred_idx]),
+        **fields
+    })
+    return body[:-1] + b',"part_details":' + catalog.payload(pred_idx) + b'}'
+
+def prediction_response(prediction, **fields):
+    """
+    Response for /predict: raw JSON bytes with FAST_RESPONSES, otherwise a dict
+    that FastAPI validates against PredictionResponse
+    """
+    stage_start = time.perf_counter()
+    if FAST_RESPONSES:
+        response = Response(content=prediction_json(prediction, **fields), media_type="application/json")
+    else:
+        response = {**describe_prediction(prediction), **fields}
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="serialization")
+    return response
 
 @app.get("/")
 async def root():
@@ -87,16 +744,45 @@ async def root():
 async def health_check():
     return {
         "status": "healthy",
-        "model_loaded": classifier.model is not None,
+        "model_loaded": classifier.backend is not None,
         "model_path": model_path,
-        "details_json_loaded": len(parts_details) > 0,
-        "class_mapping_count": len(idx_to_class)
+        "inference_backend": INFERENCE_BACKEND,
+        "precision": KERAS_PRECISION,
+        "jit_compile": KERAS_JIT_COMPILE,
+        "model_version": MODEL_VERSION,
+        "warmup_batch_sizes": batcher.batch_sizes,
+        "startup_timings": startup_timings,
+        "details_json_loaded": len(catalog) > 0,
+        "class_mapping_count": len(catalog),
+        "prediction_cache": prediction_cache.stats() if prediction_cache else None,
+        "predict_mode": PREDICT_MODE,
+        "tta": {"enabled": TTA_ENABLED, "threshold": TTA_THRESHOLD, "views": len(DEFAULT_VIEWS)},
+        "cascade": {
+            "model_path": CASCADE_MODEL_PATH,
+            "backend": CASCADE_BACKEND,
+            "threshold": CASCADE_THRESHOLD,
+            "predictions": dict(cascade_counts),
+            "escalation_rate": cascade_counts["large"] / max(1, sum(cascade_counts.values()))
+        } if cascade_classifier is not None else None,
+        "embedding_index": embedding_index.stats() if embedding_index is not None else None
     }
 
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics_registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    if prediction_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **prediction_cache.stats()}
+
 @app.post("/predict", response_model=PredictionResponse)
-async def predict(file: UploadFile = File(...)):
+async def predict(file: UploadFile = File(...), mode: str = None, tta: bool = None):
     # Start the timer
     start_time = time.time()
+    mode = check_mode(mode)
+    tta = TTA_ENABLED if tta is None else tta
     
     # Check file extension
     file_extension = os.path.splitext(file.filename)[1].lower()
@@ -105,51 +791,443 @@ async def predict(file: UploadFile = File(...)):
     
     try:
         # Read the image file
+        stage_start = time.perf_counter()
         contents = await file.read()
-        image = cv2.imdecode(np.frombuffer(contents, np.uint8), cv2.IMREAD_COLOR)
+        STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="upload_read")
+        loop = asyncio.get_running_loop()
         
-        if image is None:
-            raise HTTPException(status_code=400, detail="Invalid image file")
-        
-        # Convert BGR to RGB
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
-        
-        # Resize to model input size
-        image_resized = cv2.resize(image_rgb, IMG_SIZE)
+        # Identical uploads skip decoding and inference entirely
+        cache_key = None
+        if prediction_cache is not None:
+            stage_start = time.perf_counter()
+            cache_key, cached = await loop.run_in_executor(preprocess_executor, lookup_cache, contents, tta)
+            STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="cache_lookup")
+            if cached is not None:
+                return prediction_response(await score_outputs(cached, mode),
+                                           processing_time=time.time() - start_time, cached=True)
         
-        # Normalize
-        image_normalized = image_resized / 255.0
+        # Decode and preprocess off the event loop
+        async with preprocess_slots:
+            image_normalized = await loop.run_in_executor(preprocess_executor, decode_and_preprocess, contents)
         
-        # Add batch dimension
-        image_batch = np.expand_dims(image_normalized, axis=0)
+        if image_normalized is None:
+            raise HTTPException(status_code=400, detail="Invalid image file")
         
-        # Make prediction
-        predictions = classifier.model.predict(image_batch)
-        pred_idx = np.argmax(predictions, axis=1)[0]
-        confidence = float(predictions[0][pred_idx])
+        # Make prediction (batched together with any concurrent requests)
+        prediction, batch_stats = await submit(image_normalized)
+        STAGE_SECONDS.observe(batch_stats["queue_wait"], stage="queue_wait")
         
-        # Get the class name from our JSON-based mapping
-        predicted_class = idx_to_class.get(int(pred_idx), f"Unknown Class {pred_idx}")
+        # Unsure predictions are averaged over augmented views of the image
+        augmented = tta and needs_tta(prediction[None])[0]
+        if augmented:
+            prediction = await refine_with_tta(image_normalized, prediction, batch_stats.get("escalated", False))
         
-        # Find matching part details directly from parts_details
-        part_details = None
-        for part in parts_details:
-            if part.get("index") == int(pred_idx):
-                part_details = part
-                break
+        if cache_key is not None:
+            await loop.run_in_executor(preprocess_executor, prediction_cache.put, cache_key, prediction)
         
         # Calculate processing time
         processing_time = time.time() - start_time
         
-        return {
-            "predicted_class": predicted_class,
-            "confidence": confidence,
-            "processing_time": processing_time,
-            "part_details": part_details
-        }
+        return prediction_response(
+            await score_outputs(prediction, mode),
+            processing_time=processing_time,
+            queue_wait=batch_stats["queue_wait"],
+            batch_size=batch_stats["batch_size"],
+            escalated=batch_stats.get("escalated"),
+            tta=bool(augmented) if tta else None
+        )
     
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during prediction: {str(e)}")
 
+@app.post("/predict_batch", response_model=BatchPredictionResponse)
+async def predict_batch(files: List[UploadFile] = File(None), archive: UploadFile = File(None), mode: str = None,
+                        tta: bool = None):
+    """
+    Classify many images in one request
+
+    Accepts either several `files` fields, an `archive` (zip or tar, optionally
+    compressed) of images, or both. Results come back in upload order, with a
+    per-item error instead of a prediction for anything that can't be decoded.
+    `mode` picks softmax, index or combined answers (default: PREDICT_MODE), and
+    `tta` averages unsure predictions over augmented views (default: TTA_ENABLED).
+    """
+    start_time = time.time()
+    mode = check_mode(mode)
+    tta = TTA_ENABLED if tta is None else tta
+    loop = asyncio.get_running_loop()
+    
+    # Gather (filename, bytes) pairs from plain uploads and from the archive
+    entries = []
+    stage_start = time.perf_counter()
+    for upload in files or []:
+        entries.append((upload.filename, await upload.read()))
+    
+    if archive is not None:
+        archive_extension = os.path.splitext(archive.filename)[1].lower()
+        if archive_extension not in ARCHIVE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="Invalid archive format. Please upload a zip or tar file.")
+        archive_contents = await archive.read()
+        try:
+            entries.extend(await loop.run_in_executor(preprocess_executor, extract_archive, archive_contents))
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid archive file: {str(e)}")
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="upload_read")
+    
+    if not entries:
+        raise HTTPException(status_code=400, detail="No images uploaded.")
+    if len(entries) > PREDICT_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many images: {len(entries)} (limit {PREDICT_BATCH_MAX_FILES}).")
+    
+    results = [{"filename": filename} for filename, _ in entries]
+    predictions_by_position = [None] * len(entries)
+    cache_keys = [None] * len(entries)
+    
+    # Decode every image in parallel on the preprocessing pool, each straight into its row of one batch buffer
+    async def decode(contents, out):
+        async with preprocess_slots:
+            return await loop.run_in_executor(preprocess_executor, decode_and_preprocess, contents, out)
+    
+    pending = []
+    for i, (filename, contents) in enumerate(entries):
+        if os.path.splitext(filename)[1].lower() not in IMAGE_EXTENSIONS:
+            results[i]["error"] = "Invalid file format. Please upload JPG or PNG images."
+            continue
+        if prediction_cache is not None:
+            cache_keys[i], cached = await loop.run_in_executor(preprocess_executor, lookup_cache, contents, tta)
+            if cached is not None:
+                predictions_by_position[i] = cached
+                results[i]["cached"] = True
+                continue
+        pending.append((i, contents))
+    
+    batch_buffer = preprocessing.allocate_batch(len(pending), IMG_SIZE)
+    decoded = await asyncio.gather(
+        *(decode(contents, batch_buffer[row]) for row, (_, contents) in enumerate(pending)),
+        return_exceptions=True
+    )
+    
+    # Compact the successfully decoded rows to the front of the buffer
+    valid_positions = []
+    for row, ((i, _), image) in enumerate(zip(pending, decoded)):
+        if isinstance(image, Exception):
+            results[i]["error"] = f"Error decoding image: {str(image)}"
+        elif image is None:
+            results[i]["error"] = "Invalid image file"
+        else:
+            if row != len(valid_positions):
+                batch_buffer[len(valid_positions)] = batch_buffer[row]
+            valid_positions.append(i)
+    valid_images = batch_buffer[:len(valid_positions)]
+    
+    # Rows the small model is unsure about go through the cascade's large model, on its own thread
+    def run_cascade_model(images):
+        outputs = []
+        for chunk_start in range(0, len(images), CASCADE_BATCH_MAX_SIZE):
+            chunk = images[chunk_start:chunk_start + CASCADE_BATCH_MAX_SIZE]
+            chunk_start_time = time.perf_counter()
+            outputs.append(cascade_classifier.predict_batch(chunk))
+            record_cascade_batch(len(chunk), time.perf_counter() - chunk_start_time)
+        return np.concatenate(outputs)
+    
+    if len(valid_images):
+        try:
+            predictions = await loop.run_in_executor(inference_executor, run_model, valid_images)
+            escalate = np.zeros(len(predictions), dtype=bool)
+            if cascade_classifier is not None:
+                escalate = needs_escalation(predictions)
+                if escalate.any():
+                    large_predictions = await loop.run_in_executor(
+                        cascade_executor, run_cascade_model, valid_images[escalate])
+                    predictions[escalate] = escalated_outputs(predictions[escalate], large_predictions)
+                for i, escalated in zip(valid_positions, escalate):
+                    results[i]["escalated"] = bool(escalated)
+                    cascade_counts["large" if escalated else "small"] += 1
+                    CASCADE_PREDICTIONS.inc(tier="large" if escalated else "small")
+            
+            if tta:
+                # The unsure images' views go through the model that answered them, all of one tier at once
+                augment_rows = needs_tta(predictions)
+                stage_start = time.perf_counter()
+                for tier_rows, executor, run in ((augment_rows & ~escalate, inference_executor, run_model),
+                                                 (augment_rows & escalate, cascade_executor, run_cascade_model)):
+                    if not tier_rows.any():
+                        continue
+                    views = await loop.run_in_executor(
+                        preprocess_executor, augment, valid_images[tier_rows], DEFAULT_VIEWS, False)
+                    view_outputs = await loop.run_in_executor(executor, run, views)
+                    predictions[tier_rows] = average_views(predictions[tier_rows], view_outputs,
+                                                           predictions.shape[1] - EMBEDDING_DIM)
+                if augment_rows.any():
+                    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="tta")
+                    TTA_PREDICTIONS.inc(int(augment_rows.sum()))
+                for i, augmented in zip(valid_positions, augment_rows):
+                    results[i]["tta"] = bool(augmented)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"Error during prediction: {str(e)}")
+        
+        new_cache_entries = []
+        for i, prediction in zip(valid_positions, predictions):
+            predictions_by_position[i] = prediction
+            if cache_keys[i] is not None:
+                new_cache_entries.append((cache_keys[i], prediction))
+        
+        def store_in_cache(entries):
+            for key, prediction in entries:
+                prediction_cache.put(key, prediction)
+        
+        if new_cache_entries:
+            await loop.run_in_executor(preprocess_executor, store_in_cache, new_cache_entries)
+    
+    # Every answered image, cached or not, is scored in one call
+    answered = [i for i, prediction in enumerate(predictions_by_position) if prediction is not None]
+    if answered:
+        scores = await score_outputs(np.stack([predictions_by_position[i] for i in answered]), mode)
+        for i, row in zip(answered, scores):
+            predictions_by_position[i] = row
+    summary = {
+        "processing_time": time.time() - start_time,
+        "batch_size": len(valid_images)
+    }
+    
+    stage_start = time.perf_counter()
+    if FAST_RESPONSES:
+        items = [
+            prediction_json(prediction, **result) if prediction is not None else dumps(result)
+            for result, prediction in zip(results, predictions_by_position)
+        ]
+        body = b'{"results":[' + b','.join(items) + b'],' + dumps(summary)[1:]
+        response = Response(content=body, media_type="application/json")
+    else:
+        for result, prediction in zip(results, predictions_by_position):
+            if prediction is not None:
+                result.update(describe_prediction(prediction))
+        response = {"results": results, **summary}
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="serialization")
+    return response
+
+@app.post("/detect", response_model=DetectionResponse)
+async def detect(file: UploadFile = File(...), proposals: str = None, min_confidence: float = None,
+                 mode: str = None):
+    """
+    Find every part in a shelf or bin photo
+
+    Candidate regions come from sliding windows at DETECT_SCALES, from the
+    outlines of the parts (`proposals=contours`), or both. All crops go through
+    the model in one batch, and the confident ones are returned after per-class
+    non-maximum suppression, with boxes as [x0, y0, x1, y1] in the uploaded
+    image's pixels.
+    """
+    start_time = time.time()
+    mode = check_mode(mode)
+    proposals = proposals or DETECT_PROPOSALS
+    if proposals not in detection.PROPOSAL_METHODS:
+        raise HTTPException(status_code=400, detail=f"proposals must be one of {list(detection.PROPOSAL_METHODS)}")
+    min_confidence = DETECT_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    
+    if os.path.splitext(file.filename)[1].lower() not in IMAGE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Invalid file format. Please upload JPG or PNG images.")
+    
+    stage_start = time.perf_counter()
+    contents = await file.read()
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="upload_read")
+    loop = asyncio.get_running_loop()
+    
+    async with preprocess_slots:
+        prepared = await loop.run_in_executor(preprocess_executor, prepare_detection, contents, proposals)
+    if prepared is None:
+        raise HTTPException(status_code=400, detail="Invalid image file")
+    crops, boxes, scale, image_size = prepared
+    
+    try:
+        outputs = await loop.run_in_executor(inference_executor, run_model, crops)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during prediction: {str(e)}")
+    
+    probabilities = await score_outputs(outputs, mode)
+    keep = detection.select_detections(boxes, probabilities, min_confidence, DETECT_IOU_THRESHOLD,
+                                       DETECT_MAX_DETECTIONS)
+    found = list(zip(detection.scale_boxes(boxes[keep], scale).tolist(), probabilities[keep]))
+    summary = {
+        "image_size": image_size,
+        "num_proposals": len(boxes),
+        "processing_time": time.time() - start_time
+    }
+    
+    stage_start = time.perf_counter()
+    if FAST_RESPONSES:
+        items = [prediction_json(prediction, box=box) for box, prediction in found]
+        body = b'{"detections":[' + b','.join(items) + b'],' + dumps(summary)[1:]
+        response = Response(content=body, media_type="application/json")
+    else:
+        response = {
+            "detections": [{"box": box, **describe_prediction(prediction)} for box, prediction in found],
+            **summary
+        }
+    STAGE_SECONDS.observe(time.perf_counter() - stage_start, stage="serialization")
+    return response
+
+@app.post("/index/enroll")
+async def enroll(class_index: int = Form(...), files: List[UploadFile] = File(...)):
+    """
+    Add reference photos of a part to the embedding index
+
+    A new part only needs an entry in Details.json with a fresh index and a few
+    photos posted here; it is recognised straight away in the index and combined
+    modes, without retraining. Photos of an existing class add to its references.
+    """
+    if embedding_index is None:
+        raise HTTPException(status_code=400, detail="No embedding index configured (EMBEDDING_INDEX_PATH)")
+    if class_index < 0:
+        raise HTTPException(status_code=400, detail="class_index must not be negative")
+    if len(files) > PREDICT_BATCH_MAX_FILES:
+        raise HTTPException(status_code=413, detail=f"Too many images: {len(files)} (limit {PREDICT_BATCH_MAX_FILES}).")
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    
+    contents = []
+    for upload in files:
+        if os.path.splitext(upload.filename)[1].lower() not in IMAGE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail=f"Invalid file format: {upload.filename}")
+        contents.append(await upload.read())
+    
+    # Each decode takes its own preprocessing slot, as in /predict_batch
+    async def decode(data, out):
+        async with preprocess_slots:
+            return await loop.run_in_executor(preprocess_executor, decode_and_preprocess, data, out)
+    
+    batch_buffer = preprocessing.allocate_batch(len(contents), IMG_SIZE)
+    decoded = await asyncio.gather(*(decode(data, batch_buffer[row]) for row, data in enumerate(contents)),
+                                   return_exceptions=True)
+    for upload, image in zip(files, decoded):
+        # A decoder error is a bad upload too, not a server failure
+        if image is None or isinstance(image, Exception):
+            raise HTTPException(status_code=400, detail=f"Invalid image file: {upload.filename}")
+    
+    def embed_and_add(images):
+        embedding_index.add(classifier.embed_batch(images), class_index)
+    
+    try:
+        await loop.run_in_executor(inference_executor, embed_and_add, batch_buffer)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    return {
+        "class_index": class_index,
+        "part_name": catalog.name(class_index),
+        "added": len(contents),
+        "references": embedding_index.count(class_index),
+        "index": embedding_index.stats(),
+        "processing_time": time.time() - start_time
+    }
+
+@app.websocket("/ws/predict")
+async def predict_stream(websocket: WebSocket, smoothing: float = 0.0, mode: str = None):
+    """
+    Classify a live stream of camera frames
+
+    The client sends JPEG/PNG frames as binary messages (or as base64 data URLs in
+    text messages). Only the newest frame is kept: anything that arrives while a
+    frame is being classified replaces the one waiting, so the stream never builds
+    a backlog. Each result is pushed back as a JSON message.
+
+    Args:
+        smoothing: Weight of the previous smoothed probabilities in an exponential
+                   moving average across frames (0 disables smoothing, must be < 1)
+        mode: softmax, index or combined answers (default: PREDICT_MODE)
+    """
+    await websocket.accept()
+    if not 0.0 <= smoothing < 1.0:
+        await websocket.close(code=1008, reason="smoothing must be in [0, 1)")
+        return
+    try:
+        mode = check_mode(mode)
+    except HTTPException as e:
+        await websocket.close(code=1008, reason=e.detail)
+        return
+    
+    loop = asyncio.get_running_loop()
+    latest = {"frame": None, "frame_id": 0, "dropped": 0}
+    frame_ready = asyncio.Event()
+    
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                if message.get("bytes") is not None:
+                    frame = message["bytes"]
+                elif message.get("text"):
+                    try:
+                        frame = base64.b64decode(message["text"].split(",", 1)[-1])
+                    except (binascii.Error, ValueError):
+                        # A malformed frame is reported and skipped; the stream carries on
+                        await websocket.send_json({"error": "invalid frame"})
+                        continue
+                else:
+                    continue
+                
+                # Overwrite a frame that hasn't been picked up yet instead of queueing behind it
+                if latest["frame"] is not None:
+                    latest["dropped"] += 1
+                latest["frame"] = frame
+                latest["frame_id"] += 1
+                frame_ready.set()
+        except WebSocketDisconnect:
+            return
+    
+    receiver = asyncio.create_task(receive_frames())
+    smoothed = None
+    try:
+        while True:
+            waiter = asyncio.create_task(frame_ready.wait())
+            done, _ = await asyncio.wait({waiter, receiver}, return_when=asyncio.FIRST_COMPLETED)
+            if receiver in done:
+                waiter.cancel()
+                if receiver.exception() is not None:
+                    print(f"WebSocket receiver failed: {receiver.exception()!r}")
+                break
+            
+            frame_ready.clear()
+            frame, frame_id = latest["frame"], latest["frame_id"]
+            latest["frame"] = None
+            start_time = time.time()
+            
+            try:
+                async with preprocess_slots:
+                    image_normalized = await loop.run_in_executor(preprocess_executor, decode_and_preprocess, frame)
+            except Exception:
+                image_normalized = None
+            if image_normalized is None:
+                await websocket.send_json({"frame_id": frame_id, "error": "Invalid image frame"})
+                continue
+            
+            prediction, batch_stats = await submit(image_normalized)
+            prediction = await score_outputs(prediction, mode)
+            if smoothing > 0:
+                # Enrolling a new part mid-stream widens the rows, which restarts the average
+                if smoothed is None or smoothed.shape != prediction.shape:
+                    smoothed = prediction
+                else:
+                    smoothed = smoothing * smoothed + (1.0 - smoothing) * prediction
+                prediction = smoothed
+            
+            await websocket.send_text(prediction_json(
+                prediction,
+                frame_id=frame_id,
+                dropped_frames=latest["dropped"],
+                processing_time=time.time() - start_time,
+                queue_wait=batch_stats["queue_wait"],
+                batch_size=batch_stats["batch_size"]
+            ).decode("utf-8"))
+    except (WebSocketDisconnect, RuntimeError):
+        # The client went away mid-send
+        pass
+    finally:
+        receiver.cancel()
+
 if __name__ == "__main__":
     uvicorn.run("api:app", host="0.0.0.0", port=8000, reload=True) 
\ No newline at end of file
@@ -0,0 +1,202 @@
+import asyncio
+import time
+import traceback
+import numpy as np
+
+
+def bucket_sizes(max_batch_size):
+    """
+    Batch sizes the batcher pads to: powers of two up to max_batch_size, plus max_batch_size
+
+    Keeping the set of shapes small means the model only ever traces (and warms up)
+    a handful of input signatures.
+    """
+    sizes = []
+    size = 1
+    while size < max_batch_size:
+        sizes.append(size)
+        size *= 2
+    sizes.append(max_batch_size)
+    return sizes
+
+
+class MicroBatcher:
+    def __init__(self, predict_fn, max_batch_size=16, max_delay=0.005, executor=None, pad_batches=True,
+                 on_batch=None):
+        """
+        Coalesce concurrent single-image requests into batched forward passes.
+
+        Requests wait in a queue until either max_batch_size items are pending
+        or the oldest one has waited max_delay seconds, then the whole group
+        runs through predict_fn as one batch and every caller gets its own row.
+
+        Args:
+            predict_fn: Callable taking a (N, H, W, 3) array and returning (N, C) outputs
+            max_batch_size: Largest batch handed to predict_fn (default: 16)
+            max_delay: Longest time in seconds a request waits for company (default: 5 ms)
+            executor: Executor the forward pass runs on (default: the loop's default executor)
+            pad_batches: Pad each batch with zeros up to the next size in batch_sizes
+            on_batch: Optional callback(batch_size, inference_time) run after every forward pass
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.executor = executor
+        self.pad_batches = pad_batches
+        self.on_batch = on_batch
+        self.batch_sizes = bucket_sizes(max_batch_size) if pad_batches else list(range(1, max_batch_size + 1))
+        self._queue = None
+        self._worker = None
+        # Reused for every padded batch; only one forward pass runs at a time
+        self._buffer = None
+
+    async def start(self):
+        """
+        Start the background task that drains the queue
+        """
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """
+        Stop the background task and fail any requests still waiting
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Batcher stopped"))
+
+    async def submit(self, image):
+        """
+        Queue a single preprocessed image and wait for its prediction
+
+        Args:
+            image: Preprocessed image array of shape (H, W, 3)
+
+        Returns:
+            row: Model output row for this image
+            stats: Dictionary with queue_wait (seconds) and batch_size
+        """
+        if self._worker is None:
+            raise RuntimeError("Batcher is not running")
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((image, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        """
+        Wait for the first request, then gather more until the batch is full
+        or the first request's deadline passes
+        """
+        first = await self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.max_delay
+
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                # Deadline reached: take whatever is already waiting, but don't block
+                if self._queue.empty():
+                    break
+                batch.append(self._queue.get_nowait())
+                continue
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        return batch
+
+    def _forward(self, images):
+        if not self.pad_batches:
+            return self.predict_fn(np.stack(images))
+
+        count = len(images)
+        padded_size = next(size for size in self.batch_sizes if size >= count)
+        if self._buffer is None or self._buffer.shape[1:] != images[0].shape or self._buffer.dtype != images[0].dtype:
+            self._buffer = np.zeros((self.max_batch_size, *images[0].shape), dtype=images[0].dtype)
+
+        batch = self._buffer[:padded_size]
+        np.stack(images, out=batch[:count])
+        batch[count:] = 0
+        return self.predict_fn(batch)[:count]
+
+    def warmup(self, input_shape, dtype=np.float32):
+        """
+        Run one forward pass at every batch size this batcher will use
+
+        Call before serving so graph tracing and memory allocation don't land on
+        the first real requests. Blocking; run it on the inference executor.
+
+        Args:
+            input_shape: Shape of a single input, e.g. (224, 224, 3)
+            dtype: Input dtype (default: float32)
+
+        Returns:
+            Dictionary mapping batch size to warmup time in seconds
+        """
+        timings = {}
+        for size in self.batch_sizes:
+            start = time.perf_counter()
+            self.predict_fn(np.zeros((size, *input_shape), dtype=dtype))
+            timings[size] = time.perf_counter() - start
+        return timings
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._process(batch)
+            except Exception as e:
+                # Never let one bad batch end the worker: every later submit() would hang
+                print(f"Micro-batcher error: {e!r}")
+                traceback.print_exc()
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    async def _process(self, batch):
+        # Drop requests whose callers have already gone away
+        batch = [item for item in batch if not item[1].done()]
+        if not batch:
+            return
+
+        loop = asyncio.get_running_loop()
+        batch_start = time.perf_counter()
+        images = [item[0] for item in batch]
+
+        try:
+            # Stack and run the blocking forward pass in a worker thread so the
+            # loop keeps accepting (and queueing) new requests in the meantime
+            outputs = await loop.run_in_executor(self.executor, self._forward, images)
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        inference_time = time.perf_counter() - batch_start
+        for i, (_, future, enqueued) in enumerate(batch):
+            if future.done():
+                continue
+            future.set_result((outputs[i], {
+                "queue_wait": batch_start - enqueued,
+                "batch_size": len(batch),
+                "inference_time": inference_time
+            }))
+
+        if self.on_batch is not None:
+            # A failing metrics hook must not affect the results already delivered
+            try:
+                self.on_batch(len(batch), inference_time)
+            except Exception as e:
+                print(f"Micro-batcher on_batch hook failed: {e!r}")
@@ -0,0 +1,365 @@
+import os
+import json
+import time
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import preprocessing
+
+SUITES = ['predict', 'batch', 'preprocess', 'pipeline', 'api']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the inference and training hot paths offline')
+    parser.add_argument('--output', type=str, default=None,
+                        help='JSON file to write the results to (default: benchmark-<commit>.json)')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='Earlier results JSON to compare against')
+    parser.add_argument('--suites', type=str, nargs='+', default=SUITES, choices=SUITES,
+                        help='Benchmarks to run')
+    parser.add_argument('--model_choice', type=str, default='resnet', choices=['resnet', 'efficientnet', 'mobilenet'],
+                        help='Architecture of the randomly initialized model')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Model input size')
+    parser.add_argument('--num_classes', type=int, default=10,
+                        help='Number of output classes of the benchmark model')
+    parser.add_argument('--num_images', type=int, default=64,
+                        help='Synthetic images generated for the run')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='Batch sizes to measure model throughput at')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 16],
+                        help='Concurrent clients for the /predict load test')
+    parser.add_argument('--requests', type=int, default=100,
+                        help='Requests per /predict measurement')
+    parser.add_argument('--repeats', type=int, default=20,
+                        help='Timed repetitions per model and preprocessing measurement')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the synthetic images and model weights')
+    return parser.parse_args()
+
+def metric(value, unit, better):
+    """
+    One result entry; better is 'lower' or 'higher', used when comparing runs
+    """
+    return {'value': float(value), 'unit': unit, 'better': better}
+
+def latency_metrics(name, seconds):
+    seconds = np.asarray(seconds) * 1000
+    return {
+        f'{name}.mean_ms': metric(seconds.mean(), 'ms', 'lower'),
+        f'{name}.p50_ms': metric(np.percentile(seconds, 50), 'ms', 'lower'),
+        f'{name}.p95_ms': metric(np.percentile(seconds, 95), 'ms', 'lower')
+    }
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def make_images(image_dir, num_images, num_classes, rng):
+    """
+    Write synthetic JPEGs (smooth gradients plus noise, at camera-like sizes) into class folders
+
+    Returns:
+        List of image paths
+    """
+    paths = []
+    sizes = [(768, 1024), (1200, 1600), (480, 640)]
+    for i in range(num_images):
+        height, width = sizes[i % len(sizes)]
+        class_dir = os.path.join(image_dir, f'class_{i % num_classes:03d}')
+        os.makedirs(class_dir, exist_ok=True)
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        image = gradient + rng.normal(0, 20, (height, width, 3)).astype(np.float32) + rng.uniform(0, 100, 3)
+        path = os.path.join(class_dir, f'image_{i:05d}.jpg')
+        cv2.imwrite(path, np.clip(image, 0, 255).astype(np.uint8), [cv2.IMWRITE_JPEG_QUALITY, 90])
+        paths.append(path)
+    return paths
+
+def build_benchmark_model(args, work_dir):
+    """
+    Build the production architecture with random weights and save it, so no download is needed
+
+    Returns:
+        (model path, class map path)
+    """
+    import pickle
+    import tensorflow as tf
+    from improved_parts_classifier import ImprovedPartsClassifier
+
+    tf.keras.utils.set_random_seed(args.seed)
+    classifier = ImprovedPartsClassifier(data_dir=None, img_size=(args.img_size, args.img_size),
+                                         model_choice=args.model_choice)
+    classifier.class_names = [f'class_{i:03d}' for i in range(args.num_classes)]
+    classifier.class_indices = {name: i for i, name in enumerate(classifier.class_names)}
+    classifier.build_model(weights=None)
+
+    model_path = os.path.join(work_dir, 'benchmark_model.h5')
+    class_map_path = os.path.join(work_dir, 'benchmark_class_indices.pkl')
+    classifier.model.save(model_path)
+    with open(class_map_path, 'wb') as f:
+        pickle.dump(classifier.class_indices, f)
+    return model_path, class_map_path
+
+def load_classifier(args, model_path, class_map_path):
+    from improved_parts_classifier import ImprovedPartsClassifier
+    classifier = ImprovedPartsClassifier(data_dir=None, img_size=(args.img_size, args.img_size))
+    if not classifier.load_model(model_path=model_path, class_map_path=class_map_path):
+        raise RuntimeError(f"Could not load the benchmark model from {model_path}")
+    return classifier
+
+def bench_predict(classifier, paths, repeats):
+    """
+    Single-image ImprovedPartsClassifier.predict latency (read, decode, preprocess, forward pass)
+    """
+    classifier.predict(paths[0])  # Trace the batch-of-one graph first
+    timings = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        classifier.predict(paths[i % len(paths)])
+        timings.append(time.perf_counter() - start)
+    return latency_metrics('predict', timings)
+
+def bench_batch(classifier, batch_sizes, repeats):
+    """
+    Forward-pass throughput at each batch size, on preprocessed inputs
+    """
+    results = {}
+    for batch_size in batch_sizes:
+        batch = np.random.default_rng(batch_size).random((batch_size, *classifier.img_size, 3), dtype=np.float32)
+        classifier.predict_batch(batch)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            classifier.predict_batch(batch)
+        seconds = (time.perf_counter() - start) / repeats
+        results[f'batch.{batch_size}.images_per_second'] = metric(batch_size / seconds, 'images/s', 'higher')
+        results[f'batch.{batch_size}.ms_per_batch'] = metric(seconds * 1000, 'ms', 'lower')
+    return results
+
+def bench_preprocess(paths, img_size, repeats):
+    """
+    Per-image cost of each preprocessing stage on the synthetic JPEGs
+    """
+    stages = {'read': [], 'decode': [], 'resize_normalize': [], 'total': []}
+    out = np.empty((*img_size, 3), dtype=np.float32)
+    for i in range(repeats * 4):
+        path = paths[i % len(paths)]
+        start = time.perf_counter()
+        with open(path, 'rb') as f:
+            contents = f.read()
+        read_done = time.perf_counter()
+        image = preprocessing.decode_image(contents, img_size)
+        decode_done = time.perf_counter()
+        preprocessing.preprocess_into(image, out)
+        end = time.perf_counter()
+        stages['read'].append(read_done - start)
+        stages['decode'].append(decode_done - read_done)
+        stages['resize_normalize'].append(end - decode_done)
+        stages['total'].append(end - start)
+    return {f'preprocess.{stage}.mean_ms': metric(np.mean(seconds) * 1000, 'ms', 'lower')
+            for stage, seconds in stages.items()}
+
+def bench_pipeline(image_dir, img_size, work_dir, batch_size=16, epochs=2):
+    """
+    Training input pipeline images/sec: ImageDataGenerator, tf.data and packed shards
+
+    Each loader is read for a few epochs with augmentation on; later epochs
+    show the effect of the tf.data cache.
+    """
+    from tensorflow.keras.preprocessing.image import ImageDataGenerator
+    from data_pipeline import build_datasets, build_packed_datasets
+    from pack_dataset import pack_dataset
+
+    def images_per_second(make_epoch_batches):
+        count = 0
+        start = time.perf_counter()
+        for _ in range(epochs):
+            for images, _ in make_epoch_batches():
+                count += len(images)
+        return count / (time.perf_counter() - start)
+
+    generator = ImageDataGenerator(rescale=1./255, rotation_range=30, width_shift_range=0.15,
+                                   height_shift_range=0.15, shear_range=0.15, zoom_range=0.2,
+                                   brightness_range=[0.8, 1.2], horizontal_flip=True, fill_mode='nearest')
+    flow = generator.flow_from_directory(image_dir, target_size=img_size, batch_size=batch_size,
+                                         class_mode='categorical', shuffle=True)
+    steps = int(np.ceil(flow.samples / batch_size))
+
+    def generator_epoch():
+        for _ in range(steps):
+            yield next(flow)
+
+    train_dataset = build_datasets(image_dir, img_size, batch_size, validation_split=0.0, cache='memory')[0]
+    packed_dir = os.path.join(work_dir, 'packed')
+    pack_dataset(image_dir, packed_dir, img_size=img_size, validation_split=0.0)
+    packed_dataset = build_packed_datasets(packed_dir, img_size, batch_size)[0]
+
+    return {
+        'pipeline.generator.images_per_second': metric(images_per_second(generator_epoch), 'images/s', 'higher'),
+        'pipeline.tfdata.images_per_second': metric(images_per_second(lambda: train_dataset), 'images/s', 'higher'),
+        'pipeline.packed.images_per_second': metric(images_per_second(lambda: packed_dataset), 'images/s', 'higher')
+    }
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def start_server(model_path):
+    """
+    Start api.py in this process on a free port, with the benchmark model and no prediction cache
+
+    Returns:
+        (uvicorn server, its thread, base URL)
+    """
+    import uvicorn
+    os.environ['INFERENCE_BACKEND'] = 'keras'
+    os.environ['MODEL_PATH'] = model_path
+    # Every request must reach the model, or the load test would only measure the cache
+    os.environ['PREDICTION_CACHE_SIZE'] = '0'
+    import api
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(api.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("The API server failed to start")
+        time.sleep(0.1)
+    return server, thread, f'http://127.0.0.1:{port}'
+
+def bench_api(model_path, paths, concurrency_levels, num_requests):
+    """
+    /predict end-to-end latency, and requests per second under concurrent clients
+    """
+    import requests
+
+    uploads = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            uploads.append((os.path.basename(path), f.read()))
+
+    server, thread, base_url = start_server(model_path)
+    results = {}
+    try:
+        def post(i, session):
+            name, contents = uploads[i % len(uploads)]
+            start = time.perf_counter()
+            response = session.post(f'{base_url}/predict', files={'file': (name, contents, 'image/jpeg')})
+            response.raise_for_status()
+            return time.perf_counter() - start
+
+        with requests.Session() as session:
+            post(0, session)
+            timings = [post(i, session) for i in range(num_requests)]
+        results.update(latency_metrics('api.predict', timings))
+
+        for clients in concurrency_levels:
+            local = threading.local()
+
+            def client_post(i):
+                if not hasattr(local, 'session'):
+                    local.session = requests.Session()
+                return post(i, local.session)
+
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                start = time.perf_counter()
+                timings = list(executor.map(client_post, range(num_requests)))
+                elapsed = time.perf_counter() - start
+            results[f'api.concurrency_{clients}.requests_per_second'] = metric(num_requests / elapsed, 'req/s', 'higher')
+            results[f'api.concurrency_{clients}.p95_ms'] = metric(np.percentile(timings, 95) * 1000, 'ms', 'lower')
+    finally:
+        server.should_exit = True
+        thread.join(timeout=30)
+    return results
+
+def compare(results, baseline):
+    """
+    Print each metric next to the baseline run, marking changes of more than 5%
+    """
+    print(f"\nComparison with {baseline['meta']['commit']} ({baseline['meta']['timestamp']}):")
+    print(f"{'metric':<48}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, current in results['results'].items():
+        previous = baseline['results'].get(name)
+        if previous is None or previous['value'] == 0:
+            print(f"{name:<48}{'-':>12}{current['value']:>12.2f}")
+            continue
+        change = current['value'] / previous['value'] - 1
+        improved = change > 0 if current['better'] == 'higher' else change < 0
+        flag = '' if abs(change) < 0.05 else ('  better' if improved else '  WORSE')
+        print(f"{name:<48}{previous['value']:>12.2f}{current['value']:>12.2f}{change:>+9.1%}{flag}")
+
+def main():
+    args = parse_args()
+    commit = git_commit()
+    # Both resolved against the caller's directory before the chdir below
+    output_path = os.path.abspath(args.output or f'benchmark-{commit}.json')
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    # api.py reads Details.json relative to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    img_size = (args.img_size, args.img_size)
+    rng = np.random.default_rng(args.seed)
+
+    results = {}
+    with tempfile.TemporaryDirectory(prefix='parts_benchmark_') as work_dir:
+        image_dir = os.path.join(work_dir, 'images')
+        paths = make_images(image_dir, args.num_images, args.num_classes, rng)
+        print(f"Generated {len(paths)} synthetic images")
+
+        if 'preprocess' in args.suites:
+            print("Benchmarking preprocessing...")
+            results.update(bench_preprocess(paths, img_size, args.repeats))
+
+        if {'predict', 'batch', 'api'} & set(args.suites):
+            print(f"Building a randomly initialized {args.model_choice} model...")
+            model_path, class_map_path = build_benchmark_model(args, work_dir)
+            classifier = load_classifier(args, model_path, class_map_path)
+            if 'predict' in args.suites:
+                print("Benchmarking predict()...")
+                results.update(bench_predict(classifier, paths, args.repeats))
+            if 'batch' in args.suites:
+                print("Benchmarking batch throughput...")
+                results.update(bench_batch(classifier, args.batch_sizes, args.repeats))
+            if 'api' in args.suites:
+                print("Benchmarking the /predict endpoint...")
+                results.update(bench_api(model_path, paths, args.concurrency, args.requests))
+
+        if 'pipeline' in args.suites:
+            print("Benchmarking training input pipelines...")
+            results.update(bench_pipeline(image_dir, img_size, work_dir))
+
+    import tensorflow as tf
+    report = {
+        'meta': {
+            'commit': commit,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'tensorflow': tf.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'args': vars(args)
+        },
+        'results': results
+    }
+
+    for name, entry in results.items():
+        print(f"{name:<48}{entry['value']:>12.2f} {entry['unit']}")
+
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output_path}")
+
+    if compare_path:
+        with open(compare_path) as f:
+            compare(report, json.load(f))
+
+if __name__ == '__main__':
+    main()
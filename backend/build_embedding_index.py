@@ -0,0 +1,130 @@
+import os
+import json
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from improved_parts_classifier import ImprovedPartsClassifier
+from embedding_index import EmbeddingIndex
+from pack_dataset import IMAGE_EXTENSIONS
+import preprocessing
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Enrol reference photos of parts into an embedding index')
+    parser.add_argument('--index_dir', type=str, default='embedding_index',
+                        help='Directory of the embedding index (created if missing, appended to otherwise)')
+    parser.add_argument('--model_path', type=str, default='improved_parts_modelv4.h5',
+                        help='Path to the trained Keras model the embeddings come from')
+    parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the class indices file')
+    parser.add_argument('--details_json', type=str, default='Details.json',
+                        help='Part details; folders that are not training classes are matched to a part_name here')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='Directory with one folder of reference photos per part')
+    parser.add_argument('--class_index', type=int, default=None,
+                        help='Enrol --images as this class index (its index in Details.json)')
+    parser.add_argument('--images', type=str, nargs='+', default=[],
+                        help='Reference photos of the part given by --class_index')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Images per forward pass')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Threads decoding images in parallel')
+    return parser.parse_args()
+
+def folder_labels(data_dir, class_indices, details_json_path):
+    """
+    Class index of each class folder: its training class index, otherwise the
+    index of the Details.json part with the same part_name
+
+    Returns:
+        List of (folder path, class index) pairs
+    """
+    part_indices = {}
+    if details_json_path and os.path.exists(details_json_path):
+        with open(details_json_path) as f:
+            part_indices = {part['part_name']: int(part['index']) for part in json.load(f)}
+
+    pairs = []
+    for name in sorted(os.listdir(data_dir)):
+        folder = os.path.join(data_dir, name)
+        if not os.path.isdir(folder):
+            continue
+        if name in class_indices:
+            pairs.append((folder, class_indices[name]))
+        elif name in part_indices:
+            pairs.append((folder, part_indices[name]))
+        else:
+            print(f"Skipping {folder}: not a training class or a part_name in {details_json_path}")
+    return pairs
+
+def embed_files(classifier, paths, batch_size, num_workers):
+    """
+    Embed image files in batches, decoding each batch in parallel
+
+    Returns:
+        (embeddings of shape (N, dim), positions in paths of the N images that decoded)
+    """
+    embeddings = []
+    kept = []
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            chunk = paths[start:start + batch_size]
+            batch = preprocessing.allocate_batch(len(chunk), classifier.img_size)
+
+            def decode(row):
+                classifier.preprocess_image(chunk[row], out=batch[row])
+
+            rows = []
+            for row, future in enumerate([executor.submit(decode, row) for row in range(len(chunk))]):
+                try:
+                    future.result()
+                    rows.append(row)
+                except Exception as e:
+                    print(f"Skipping {chunk[row]}: {e}")
+            if rows:
+                embeddings.append(classifier.embed_batch(batch[rows]))
+                kept.extend(start + row for row in rows)
+    if not embeddings:
+        return None, kept
+    return np.concatenate(embeddings), kept
+
+def main():
+    args = parse_args()
+    if args.data_dir is None and (args.class_index is None or not args.images):
+        print("Give either --data_dir, or --class_index with --images")
+        return
+
+    classifier = ImprovedPartsClassifier(
+        data_dir=None,
+        img_size=(args.img_size, args.img_size)
+    )
+    if not classifier.load_model(model_path=args.model_path, class_map_path=args.class_map_path):
+        print("Failed to load model. Exiting.")
+        return
+
+    paths, labels = [], []
+    if args.class_index is not None:
+        paths.extend(args.images)
+        labels.extend([args.class_index] * len(args.images))
+    if args.data_dir is not None:
+        for folder, class_index in folder_labels(args.data_dir, classifier.class_indices, args.details_json):
+            for root, _, filenames in sorted(os.walk(folder)):
+                files = [os.path.join(root, f) for f in sorted(filenames) if f.lower().endswith(IMAGE_EXTENSIONS)]
+                paths.extend(files)
+                labels.extend([class_index] * len(files))
+
+    print(f"Embedding {len(paths)} reference images...")
+    embeddings, kept = embed_files(classifier, paths, args.batch_size, args.num_workers)
+    if embeddings is None:
+        print("No images could be read. Exiting.")
+        return
+
+    index = EmbeddingIndex(args.index_dir)
+    index.add(embeddings, np.asarray(labels, dtype=np.int32)[kept])
+    stats = index.stats()
+    print(f"Index at {args.index_dir} now holds {stats['references']} references for {stats['classes']} classes "
+          f"(revision {stats['revision']})")
+
+if __name__ == '__main__':
+    main()
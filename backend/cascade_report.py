@@ -0,0 +1,136 @@
+import json
+import time
+import argparse
+import numpy as np
+from improved_parts_classifier import ImprovedPartsClassifier
+from precision_report import load_images
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Per-tier latency and accuracy of a small/large model cascade')
+    parser.add_argument('--small_model_path', type=str, required=True,
+                        help='Model that answers every request (e.g. trained with --model_choice mobilenet)')
+    parser.add_argument('--large_model_path', type=str, required=True,
+                        help='Model that low-confidence images are escalated to')
+    parser.add_argument('--small_backend', type=str, default='keras', choices=['keras', 'savedmodel', 'tflite', 'onnx'],
+                        help='Inference backend of the small model')
+    parser.add_argument('--large_backend', type=str, default='keras', choices=['keras', 'savedmodel', 'tflite', 'onnx'],
+                        help='Inference backend of the large model')
+    parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the class indices file (shared by both models)')
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help='Validation directory with one folder per class')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='Images per forward pass (use the server\'s BATCH_MAX_SIZE)')
+    parser.add_argument('--max_images', type=int, default=1000,
+                        help='Evaluate on at most this many images')
+    parser.add_argument('--timing_batches', type=int, default=20,
+                        help='Forward passes timed per model')
+    parser.add_argument('--thresholds', type=float, nargs='+',
+                        default=[0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.99],
+                        help='Escalation thresholds (CASCADE_THRESHOLD values) to report')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional JSON file to write the report to')
+    return parser.parse_args()
+
+def load(model_path, backend, class_map_path, img_size):
+    classifier = ImprovedPartsClassifier(data_dir=None, img_size=img_size)
+    if not classifier.load_model(model_path=model_path, class_map_path=class_map_path, backend=backend):
+        raise RuntimeError(f"Could not load {model_path}")
+    return classifier
+
+def measure(classifier, images, batch_size, timing_batches):
+    """
+    Predict every image, then time single-image and full-batch forward passes
+
+    Returns:
+        (probabilities, seconds per image at batch size 1, seconds per image at batch_size)
+    """
+    probabilities = np.concatenate([
+        classifier.predict_batch(images[start:start + batch_size])
+        for start in range(0, len(images), batch_size)
+    ])
+
+    timings = []
+    for size in (1, batch_size):
+        batch = images[:size]
+        classifier.predict_batch(batch)
+        start = time.perf_counter()
+        for _ in range(timing_batches):
+            classifier.predict_batch(batch)
+        timings.append((time.perf_counter() - start) / timing_batches / len(batch))
+    return probabilities, timings[0], timings[1]
+
+def accuracy(predictions, labels):
+    labelled = labels >= 0
+    return float(np.mean(predictions[labelled] == labels[labelled])) if labelled.any() else None
+
+def main():
+    args = parse_args()
+    img_size = (args.img_size, args.img_size)
+
+    small = load(args.small_model_path, args.small_backend, args.class_map_path, img_size)
+    large = load(args.large_model_path, args.large_backend, args.class_map_path, img_size)
+    images, labels = load_images(small, args.data_dir, args.max_images)
+    print(f"Comparing on {len(images)} images from {args.data_dir}")
+
+    tiers = {}
+    outputs = {}
+    for name, classifier in (('small', small), ('large', large)):
+        print(f"Measuring the {name} model...")
+        probabilities, single_seconds, batched_seconds = measure(classifier, images, args.batch_size,
+                                                                 args.timing_batches)
+        outputs[name] = probabilities
+        tiers[name] = {
+            'model_path': args.small_model_path if name == 'small' else args.large_model_path,
+            'accuracy': accuracy(np.argmax(probabilities, axis=1), labels),
+            'ms_per_image': single_seconds * 1000,
+            'ms_per_image_batched': batched_seconds * 1000
+        }
+
+    small_top1 = np.argmax(outputs['small'], axis=1)
+    large_top1 = np.argmax(outputs['large'], axis=1)
+    confidence = outputs['small'].max(axis=1)
+    thresholds = []
+    for threshold in sorted(args.thresholds):
+        escalate = confidence < threshold
+        rate = float(escalate.mean())
+        # Every image pays for the small model, escalated ones for the large model as well
+        thresholds.append({
+            'threshold': threshold,
+            'escalation_rate': rate,
+            'accuracy': accuracy(np.where(escalate, large_top1, small_top1), labels),
+            'small_tier_accuracy': accuracy(small_top1[~escalate], labels[~escalate]),
+            'large_tier_accuracy': accuracy(large_top1[escalate], labels[escalate]),
+            'ms_per_image': tiers['small']['ms_per_image'] + rate * tiers['large']['ms_per_image'],
+            'ms_per_image_batched': (tiers['small']['ms_per_image_batched']
+                                     + rate * tiers['large']['ms_per_image_batched'])
+        })
+
+    def show(value, width, spec='.4f'):
+        return f"{value:>{width}{spec}}" if value is not None else f"{'-':>{width}}"
+
+    print(f"\n{'tier':<12}{'accuracy':>10}{'ms/img':>10}{'ms/img batched':>16}")
+    for name, tier in tiers.items():
+        print(f"{name:<12}{show(tier['accuracy'], 10)}{tier['ms_per_image']:>10.2f}{tier['ms_per_image_batched']:>16.2f}")
+    print(f"\n{'threshold':<12}{'escalated':>10}{'accuracy':>10}{'small acc':>11}{'large acc':>11}"
+          f"{'ms/img':>10}{'ms/img batched':>16}")
+    for row in thresholds:
+        print(f"{row['threshold']:<12}{row['escalation_rate']:>10.1%}{show(row['accuracy'], 10)}"
+              f"{show(row['small_tier_accuracy'], 11)}{show(row['large_tier_accuracy'], 11)}"
+              f"{row['ms_per_image']:>10.2f}{row['ms_per_image_batched']:>16.2f}")
+
+    report = {
+        'num_images': len(images),
+        'batch_size': args.batch_size,
+        'tiers': tiers,
+        'thresholds': thresholds
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+import os
+import glob
+import json
+import zlib
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def iter_image_paths(image_dir, recursive=True):
+    """
+    Lazily yield image file paths under a directory
+
+    Uses os.scandir and never builds the full file list, so memory stays flat
+    however many images the directory holds.
+
+    Args:
+        image_dir: Directory to search
+        recursive: Whether to descend into subdirectories
+    """
+    pending_dirs = [image_dir]
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        subdirs = []
+        with os.scandir(current_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    yield entry.path
+        if recursive:
+            pending_dirs.extend(subdirs)
+
+
+def write_manifest(image_dir, manifest_path, recursive=True):
+    """
+    Write every image path under a directory to a manifest file, one per line
+
+    Returns:
+        Number of paths written
+    """
+    count = 0
+    with open(manifest_path, 'w') as f:
+        for image_path in iter_image_paths(image_dir, recursive=recursive):
+            f.write(image_path + "\n")
+            count += 1
+    return count
+
+
+def read_manifest(manifest_path):
+    """
+    Lazily yield the image paths listed in a manifest file (blank lines are skipped)
+    """
+    with open(manifest_path) as f:
+        for line in f:
+            image_path = line.rstrip("\n")
+            if image_path:
+                yield image_path
+
+
+def in_shard(image_path, num_shards, shard_index):
+    """
+    Whether an image belongs to a shard
+
+    Assignment hashes the path, so it doesn't depend on manifest order and every
+    process computes the same split independently.
+    """
+    return zlib.crc32(image_path.encode("utf-8")) % num_shards == shard_index
+
+
+def shard_output_path(output_path, num_shards, shard_index):
+    """
+    Per-shard output path, e.g. results.jsonl -> results.shard-00002-of-00004.jsonl
+    """
+    if num_shards <= 1:
+        return output_path
+    root, extension = os.path.splitext(output_path)
+    return f"{root}.shard-{shard_index:05d}-of-{num_shards:05d}{extension}"
+
+
+class JSONLResultWriter:
+    def __init__(self, output_path):
+        """
+        Append results to a JSON Lines file, one object per image
+
+        Args:
+            output_path: Path of the .jsonl file (appended to if it exists)
+        """
+        self.output_path = output_path
+        self._file = None
+
+    def done_paths(self):
+        """
+        Image paths already recorded in the output, so a rerun can skip them
+
+        Images recorded with an error are not included, so a rerun retries them.
+        """
+        done = set()
+        if not os.path.exists(self.output_path):
+            return done
+        with open(self.output_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    if record.get('error') is None:
+                        done.add(record['image'])
+                except (ValueError, KeyError):
+                    # A crash can leave a partial last line; that image is simply redone
+                    continue
+        return done
+
+    def _drop_partial_line(self):
+        """
+        Truncate the file after its last complete line, so new records never
+        get appended to the fragment an interrupted run left behind
+        """
+        if not os.path.exists(self.output_path):
+            return
+        with open(self.output_path, 'r+b') as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                start = max(0, position - 65536)
+                f.seek(start)
+                chunk = f.read(position - start)
+                newline = chunk.rfind(b"\n")
+                if newline != -1:
+                    position = start + newline + 1
+                    break
+                position = start
+            if position != end:
+                f.truncate(position)
+
+    def write(self, records):
+        """
+        Append a batch of result records and make sure they reach the disk
+        """
+        if self._file is None:
+            self._drop_partial_line()
+            self._file = open(self.output_path, 'a')
+        for record in records:
+            self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ParquetResultWriter:
+    def __init__(self, output_path, rows_per_file=256):
+        """
+        Write results as a directory of Parquet part files
+
+        Each flush writes a new, complete part file, so a crash never leaves a
+        half-written file behind and finished parts are never rewritten. Parts
+        are numbered after the highest existing one and published without
+        overwriting, so several writers can share one output directory.
+
+        Args:
+            output_path: Directory to hold the part files (created if missing)
+            rows_per_file: Number of buffered results that triggers writing a part file;
+                           at most this many results are lost if the process dies
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("Parquet output needs pyarrow: pip install pyarrow")
+        self._pa = pyarrow
+        self._pq = pyarrow.parquet
+        self.output_path = output_path
+        self.rows_per_file = rows_per_file
+        self._rows = []
+        os.makedirs(output_path, exist_ok=True)
+
+    def _part_files(self):
+        return sorted(glob.glob(os.path.join(self.output_path, 'part-*.parquet')))
+
+    def done_paths(self):
+        done = set()
+        for part_file in self._part_files():
+            table = self._pq.read_table(part_file, columns=['image', 'error'])
+            done.update(image for image, error in zip(table.column('image').to_pylist(),
+                                                     table.column('error').to_pylist()) if error is None)
+        return done
+
+    def write(self, records):
+        self._rows.extend(records)
+        if len(self._rows) >= self.rows_per_file:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        columns = {
+            'image': [row['image'] for row in self._rows],
+            'prediction': [row.get('prediction') for row in self._rows],
+            'confidence': [row.get('confidence') for row in self._rows],
+            'error': [row.get('error') for row in self._rows]
+        }
+        # Write under a temporary name private to this process, then publish it
+        # whole, so readers only ever see complete files
+        temp_file = os.path.join(self.output_path, f".part-{os.getpid()}-{id(self)}.parquet.tmp")
+        self._pq.write_table(self._pa.table(columns), temp_file)
+        try:
+            part_number = self._next_part_number()
+            while True:
+                part_file = os.path.join(self.output_path, f"part-{part_number:05d}.parquet")
+                try:
+                    # Unlike os.replace, a hard link fails rather than overwrite a part
+                    # another writer on the same directory has just published
+                    os.link(temp_file, part_file)
+                    break
+                except FileExistsError:
+                    part_number += 1
+        finally:
+            os.remove(temp_file)
+        self._rows = []
+
+    def _next_part_number(self):
+        """
+        One past the highest existing part number, so gaps left by failed parts are never refilled
+        """
+        numbers = [os.path.basename(part_file)[len('part-'):-len('.parquet')] for part_file in self._part_files()]
+        return max((int(number) for number in numbers if number.isdigit()), default=-1) + 1
+
+    def close(self):
+        self._flush()
+
+
+def open_writer(output_path, rows_per_file=256):
+    """
+    Pick a result writer from the output path: a directory ending in .parquet
+    gets Parquet part files (of rows_per_file results each), anything else is
+    written as JSON Lines
+    """
+    if output_path.rstrip('/').endswith('.parquet'):
+        return ParquetResultWriter(output_path, rows_per_file=rows_per_file)
+    return JSONLResultWriter(output_path)
+
+
+def iter_records(output_path):
+    """
+    Lazily yield result records from a .jsonl file or a .parquet directory
+    """
+    if output_path.rstrip('/').endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for part_file in sorted(glob.glob(os.path.join(output_path, 'part-*.parquet'))):
+            for batch in pq.ParquetFile(part_file).iter_batches():
+                yield from batch.to_pylist()
+        return
+
+    with open(output_path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def merge_outputs(input_paths, output_path, chunk_size=10000):
+    """
+    Merge shard outputs into a single output, keeping the first result per image
+
+    A successful result wins over error records for the same image (a retried
+    image has both); images that only ever failed keep their first error.
+
+    Args:
+        input_paths: Shard output paths (.jsonl files or .parquet directories)
+        output_path: Merged output path (.jsonl file or .parquet directory)
+        chunk_size: Number of records written at a time
+
+    Returns:
+        Number of results written
+    """
+    writer = open_writer(output_path, rows_per_file=chunk_size)
+    seen = writer.done_paths()
+    errors = {}
+    written = 0
+    chunk = []
+    try:
+        for input_path in input_paths:
+            for record in iter_records(input_path):
+                if record['image'] in seen:
+                    continue
+                if record.get('error') is not None:
+                    errors.setdefault(record['image'], record)
+                    continue
+                seen.add(record['image'])
+                chunk.append(record)
+                if len(chunk) >= chunk_size:
+                    writer.write(chunk)
+                    written += len(chunk)
+                    chunk = []
+        chunk.extend(record for image, record in errors.items() if image not in seen)
+        writer.write(chunk)
+        written += len(chunk)
+    finally:
+        writer.close()
+    return written
@@ -0,0 +1,236 @@
+import os
+import sys
+import json
+import random
+import argparse
+import tempfile
+import numpy as np
+import tensorflow as tf
+from improved_parts_classifier import ImprovedPartsClassifier
+from inference_backends import load_backend
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Export a trained Keras model to SavedModel, TFLite or ONNX for CPU serving')
+    parser.add_argument('--model_path', type=str, default='improved_parts_model.h5',
+                        help='Path to the trained Keras model')
+    parser.add_argument('--format', type=str, default='tflite', choices=['savedmodel', 'tflite', 'onnx'],
+                        help='Export format')
+    parser.add_argument('--quantize', type=str, default='none', choices=['none', 'float16', 'int8'],
+                        help='Quantization mode (float16 is TFLite only; savedmodel is never quantized)')
+    parser.add_argument('--output_path', type=str, default=None,
+                        help='Where to write the exported model (default: model path with new extension)')
+    parser.add_argument('--calibration_dir', type=str, default=None,
+                        help='Training directory to sample int8 calibration images from')
+    parser.add_argument('--num_calibration_samples', type=int, default=200,
+                        help='Number of calibration images to use for int8 quantization')
+    parser.add_argument('--check_dir', type=str, default=None,
+                        help='Validation directory used to compare the export against the Keras model')
+    parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Class indices file, used to report accuracy when check_dir has class folders')
+    parser.add_argument('--check_only', action='store_true',
+                        help='Skip conversion and only run the drift check on an existing export')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    return parser.parse_args()
+
+def list_images(directory):
+    """
+    Recursively list image files under a directory, in a stable order
+    """
+    image_paths = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                image_paths.append(os.path.join(root, name))
+    return sorted(image_paths)
+
+def path_size(path):
+    """
+    Size in bytes of a file, or of everything under a directory
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, files in os.walk(path) for name in files)
+
+def calibration_samples(classifier, calibration_dir, num_samples, seed=42):
+    """
+    Yield preprocessed calibration images sampled across the whole training directory
+    """
+    image_paths = list_images(calibration_dir)
+    random.Random(seed).shuffle(image_paths)
+    for image_path in image_paths[:num_samples]:
+        yield np.expand_dims(classifier.preprocess_image(image_path), axis=0)
+
+def export_tflite(model, output_path, quantize, samples=None):
+    """
+    Convert a Keras model to a TFLite flatbuffer
+
+    Args:
+        model: Keras model to convert
+        output_path: Path of the .tflite file to write
+        quantize: 'none', 'float16' or 'int8'
+        samples: Iterable of calibration batches, required for 'int8'
+    """
+    # Going through a SavedModel keeps the batch dimension dynamic in the flatbuffer
+    with tempfile.TemporaryDirectory() as saved_model_dir:
+        model.export(saved_model_dir)
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+
+        if quantize == 'float16':
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.target_spec.supported_types = [tf.float16]
+        elif quantize == 'int8':
+            if samples is None:
+                raise ValueError("int8 quantization needs --calibration_dir")
+            calibration = list(samples)
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+            converter.representative_dataset = lambda: ([sample] for sample in calibration)
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+            # Keep float input/output so callers don't need to know the quantization params
+            converter.inference_input_type = tf.float32
+            converter.inference_output_type = tf.float32
+
+        tflite_model = converter.convert()
+
+    with open(output_path, 'wb') as f:
+        f.write(tflite_model)
+
+def export_onnx(model, output_path, quantize, img_size, samples=None):
+    """
+    Convert a Keras model to ONNX, optionally with static int8 quantization
+
+    Args:
+        model: Keras model to convert
+        output_path: Path of the .onnx file to write
+        quantize: 'none' or 'int8'
+        img_size: Model input size as (height, width)
+        samples: Iterable of calibration batches, required for 'int8'
+    """
+    try:
+        import tf2onnx
+    except ImportError:
+        raise ImportError("ONNX export needs tf2onnx: pip install tf2onnx onnxruntime")
+
+    if quantize == 'float16':
+        raise ValueError("float16 quantization is only supported for TFLite exports")
+
+    input_signature = (tf.TensorSpec((None, *img_size, 3), tf.float32, name='input'),)
+    float_path = output_path if quantize == 'none' else output_path + '.float.onnx'
+    tf2onnx.convert.from_keras(model, input_signature=input_signature, opset=13, output_path=float_path)
+
+    if quantize == 'int8':
+        if samples is None:
+            raise ValueError("int8 quantization needs --calibration_dir")
+        from onnxruntime.quantization import CalibrationDataReader, QuantType, quantize_static
+
+        class CalibrationReader(CalibrationDataReader):
+            def __init__(self, batches):
+                self._batches = iter(batches)
+
+            def get_next(self):
+                batch = next(self._batches, None)
+                return None if batch is None else {'input': batch}
+
+        quantize_static(float_path, output_path, CalibrationReader(samples),
+                        weight_type=QuantType.QInt8, activation_type=QuantType.QUInt8)
+        os.remove(float_path)
+
+def check_drift(classifier, backend, check_dir, batch_size=32):
+    """
+    Compare an exported backend against the Keras model on a validation folder
+
+    Args:
+        classifier: Classifier with the Keras model loaded
+        backend: Exported inference backend to compare
+        check_dir: Directory of validation images (class folders enable accuracy numbers)
+        batch_size: Number of images per forward pass
+
+    Returns:
+        Dictionary with agreement and probability difference metrics
+    """
+    image_paths = list_images(check_dir)
+    if not image_paths:
+        raise ValueError(f"No images found in {check_dir}")
+
+    keras_top1, export_top1, labels = [], [], []
+    max_abs_diff = 0.0
+    sum_abs_diff = 0.0
+    for start in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[start:start + batch_size]
+        images = np.stack([classifier.preprocess_image(path) for path in batch_paths])
+        keras_probs = np.asarray(classifier.model.predict_on_batch(images))
+        export_probs = backend.predict(images)
+
+        diff = np.abs(keras_probs - export_probs)
+        max_abs_diff = max(max_abs_diff, float(diff.max()))
+        sum_abs_diff += float(diff.mean(axis=1).sum())
+        keras_top1.append(np.argmax(keras_probs, axis=1))
+        export_top1.append(np.argmax(export_probs, axis=1))
+        for path in batch_paths:
+            labels.append(classifier.class_indices.get(os.path.basename(os.path.dirname(path)), -1))
+
+    keras_top1 = np.concatenate(keras_top1)
+    export_top1 = np.concatenate(export_top1)
+    labels = np.array(labels)
+
+    report = {
+        'num_images': len(image_paths),
+        'top1_agreement': float(np.mean(keras_top1 == export_top1)),
+        'mean_abs_prob_diff': sum_abs_diff / len(image_paths),
+        'max_abs_prob_diff': max_abs_diff
+    }
+
+    # Accuracy only makes sense when the folder names match known classes
+    labelled = labels >= 0
+    if labelled.any():
+        report['labelled_images'] = int(labelled.sum())
+        report['keras_accuracy'] = float(np.mean(keras_top1[labelled] == labels[labelled]))
+        report['export_accuracy'] = float(np.mean(export_top1[labelled] == labels[labelled]))
+    return report
+
+def main():
+    args = parse_args()
+    img_size = (args.img_size, args.img_size)
+
+    classifier = ImprovedPartsClassifier(data_dir=None, img_size=img_size)
+    if not classifier.load_model(model_path=args.model_path, class_map_path=args.class_map_path):
+        print("Failed to load model. Exiting.")
+        sys.exit(1)
+
+    if args.format == 'savedmodel':
+        default_output_path = os.path.splitext(args.model_path)[0] + '_savedmodel'
+    else:
+        default_output_path = os.path.splitext(args.model_path)[0] + f'.{args.format}'
+    output_path = args.output_path or default_output_path
+
+    if not args.check_only:
+        samples = None
+        if args.calibration_dir:
+            samples = calibration_samples(classifier, args.calibration_dir, args.num_calibration_samples)
+
+        print(f"Exporting {args.model_path} to {args.format} (quantization: {args.quantize})...")
+        if args.format == 'savedmodel':
+            if args.quantize != 'none':
+                raise ValueError("SavedModel exports can't be quantized; use --format tflite or onnx")
+            # A traced serving function loads much faster than the .h5 and needs no Keras at serve time
+            classifier.model.export(output_path)
+        elif args.format == 'tflite':
+            export_tflite(classifier.model, output_path, args.quantize, samples)
+        else:
+            export_onnx(classifier.model, output_path, args.quantize, img_size, samples)
+
+        original_size = os.path.getsize(args.model_path) / 1e6
+        export_size = path_size(output_path) / 1e6
+        print(f"Exported model saved to {output_path} ({export_size:.1f} MB, Keras model {original_size:.1f} MB)")
+
+    if args.check_dir:
+        print(f"Checking accuracy drift on {args.check_dir}...")
+        backend = load_backend(args.format, output_path)
+        report = check_drift(classifier, backend, args.check_dir)
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,314 @@
+import os
+import math
+import numpy as np
+import tensorflow as tf
+from pack_dataset import list_class_files, read_index, iter_packed_chunks, split_size
+
+# The training augmentation used with ImageDataGenerator in load_data
+DEFAULT_AUGMENTATION = {
+    'rotation_range': 30,         # degrees
+    'width_shift_range': 0.15,    # fraction of the width
+    'height_shift_range': 0.15,   # fraction of the height
+    'shear_range': 0.15,          # degrees, as ImageDataGenerator interprets it
+    'zoom_range': 0.2,
+    'brightness_range': (0.8, 1.2),
+    'horizontal_flip': True
+}
+
+
+def decode_and_resize(path, img_size):
+    """
+    Read and decode one image file into a uint8 RGB tensor of shape (*img_size, 3)
+
+    tf.io.decode_image ignores the EXIF orientation tag, as does the Keras
+    ImageDataGenerator this replaces (PIL without exif_transpose), so both
+    train on rotated phone photos as stored. Serving and pack_dataset.py decode
+    with OpenCV, which applies the tag; pack datasets of such photos so training
+    sees them the way they are served.
+    """
+    image = tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False)
+    image = tf.image.resize(image, img_size)
+    return tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+
+
+def random_transforms(batch_size, height, width, rotation_range=0, width_shift_range=0, height_shift_range=0,
+                      shear_range=0, zoom_range=0, horizontal_flip=False, **_):
+    """
+    Random affine transforms for a batch, as ImageProjectiveTransform parameters
+
+    Rotation, shift, shear, zoom and the horizontal flip are composed into one
+    3x3 matrix per image (mapping output pixels to input pixels, about the
+    image centre), so the whole batch is warped in a single op.
+
+    Returns:
+        Float32 tensor of shape (batch_size, 8)
+    """
+    n = [batch_size]
+    width_f = tf.cast(width, tf.float32)
+    height_f = tf.cast(height, tf.float32)
+    zeros = tf.zeros(n)
+    ones = tf.ones(n)
+
+    def matrices(*rows):
+        return tf.reshape(tf.stack(rows, axis=1), [batch_size, 3, 3])
+
+    theta = tf.random.uniform(n, -rotation_range, rotation_range) * (math.pi / 180)
+    rotation = matrices(tf.cos(theta), -tf.sin(theta), zeros,
+                        tf.sin(theta), tf.cos(theta), zeros,
+                        zeros, zeros, ones)
+
+    tx = tf.random.uniform(n, -width_shift_range, width_shift_range) * width_f
+    ty = tf.random.uniform(n, -height_shift_range, height_shift_range) * height_f
+    shift = matrices(ones, zeros, tx,
+                     zeros, ones, ty,
+                     zeros, zeros, ones)
+
+    shear = tf.random.uniform(n, -shear_range, shear_range) * (math.pi / 180)
+    shear_matrix = matrices(ones, -tf.sin(shear), zeros,
+                            zeros, tf.cos(shear), zeros,
+                            zeros, zeros, ones)
+
+    zx = tf.random.uniform(n, 1 - zoom_range, 1 + zoom_range)
+    zy = tf.random.uniform(n, 1 - zoom_range, 1 + zoom_range)
+    zoom = matrices(zx, zeros, zeros,
+                    zeros, zy, zeros,
+                    zeros, zeros, ones)
+
+    flip_sign = ones
+    if horizontal_flip:
+        flip_sign = tf.where(tf.random.uniform(n) < 0.5, -ones, ones)
+    flip = matrices(flip_sign, zeros, zeros,
+                    zeros, ones, zeros,
+                    zeros, zeros, ones)
+
+    # Transforms act about the centre of the image
+    cx = (width_f - 1) / 2
+    cy = (height_f - 1) / 2
+    to_centre = matrices(ones, zeros, -cx * ones, zeros, ones, -cy * ones, zeros, zeros, ones)
+    from_centre = matrices(ones, zeros, cx * ones, zeros, ones, cy * ones, zeros, zeros, ones)
+
+    transform = from_centre @ rotation @ shift @ shear_matrix @ zoom @ flip @ to_centre
+    return tf.reshape(transform, [batch_size, 9])[:, :8]
+
+
+def augment_batch(images, augmentation=DEFAULT_AUGMENTATION):
+    """
+    Apply random augmentation to a whole batch of float images in [0, 1]
+
+    Args:
+        images: Float32 tensor of shape (N, H, W, 3)
+        augmentation: Augmentation ranges (see DEFAULT_AUGMENTATION)
+
+    Returns:
+        Augmented float32 tensor of the same shape, still in [0, 1]
+    """
+    shape = tf.shape(images)
+    batch_size, height, width = shape[0], shape[1], shape[2]
+
+    transforms = random_transforms(batch_size, height, width, **augmentation)
+    images = tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=tf.stack([height, width]),
+        fill_value=0.0,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST'
+    )
+
+    brightness_range = augmentation.get('brightness_range')
+    if brightness_range:
+        factors = tf.random.uniform([batch_size, 1, 1, 1], brightness_range[0], brightness_range[1])
+        images = tf.clip_by_value(images * factors, 0.0, 1.0)
+    return images
+
+
+def shard_for_worker(dataset, num_shards, shard_index):
+    """
+    Keep every num_shards-th element for this worker and turn off tf.distribute auto-sharding
+
+    Sharding by hand before the decode means each worker only reads and decodes
+    its own images, and with auto-sharding off the distribution strategy uses
+    the per-worker dataset as is.
+    """
+    if num_shards <= 1:
+        return dataset
+    options = tf.data.Options()
+    options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+    return dataset.shard(num_shards, shard_index).with_options(options)
+
+
+def make_dataset(files, labels, num_classes, img_size, batch_size, training=False, cache=None,
+                 augmentation=DEFAULT_AUGMENTATION, seed=None, num_shards=1, shard_index=0, soft_targets=None):
+    """
+    Build a tf.data pipeline yielding (images, one-hot labels) batches
+
+    Files are read and decoded in parallel, the resized uint8 images are
+    optionally cached (so later epochs skip the JPEG decode entirely), and
+    augmentation runs on whole batches before an autotuned prefetch.
+
+    Args:
+        files: Image paths
+        labels: Class index of each image
+        num_classes: Number of classes (for the one-hot labels)
+        img_size: Model input size as (height, width)
+        batch_size: Batch size
+        training: Shuffle and augment (training set) or not (validation set)
+        cache: None for no cache, 'memory' to cache in RAM, or a file path prefix
+               to cache on disk
+        augmentation: Augmentation ranges used when training
+        seed: Optional shuffle seed
+        num_shards: Number of workers the data is split between
+        shard_index: This worker's index
+        soft_targets: Optional (len(files), num_classes) teacher probabilities;
+                      the targets are then [one-hot labels | soft targets]
+
+    Returns:
+        tf.data.Dataset
+    """
+    autotune = tf.data.AUTOTUNE
+    columns = (tf.constant(list(files), dtype=tf.string), tf.constant(list(labels), dtype=tf.int32))
+    if soft_targets is not None:
+        columns += (tf.constant(soft_targets, dtype=tf.float32),)
+    dataset = tf.data.Dataset.from_tensor_slices(columns)
+    dataset = shard_for_worker(dataset, num_shards, shard_index)
+    dataset = dataset.map(
+        lambda path, *targets: (decode_and_resize(path, img_size), *targets),
+        num_parallel_calls=autotune,
+        deterministic=not training
+    )
+
+    if cache == 'memory':
+        dataset = dataset.cache()
+    elif cache:
+        os.makedirs(os.path.dirname(os.path.abspath(cache)), exist_ok=True)
+        dataset = dataset.cache(cache)
+
+    if training:
+        dataset = dataset.shuffle(max(1, len(files) // num_shards), seed=seed, reshuffle_each_iteration=True)
+    return batch_for_model(dataset, num_classes, batch_size, training, augmentation)
+
+
+def batch_for_model(dataset, num_classes, batch_size, training=False, augmentation=DEFAULT_AUGMENTATION):
+    """
+    Batch (uint8 image, label) elements into normalized, optionally augmented model inputs
+    """
+    autotune = tf.data.AUTOTUNE
+    dataset = dataset.batch(batch_size)
+
+    def to_model_input(images, batch_labels, *soft_targets):
+        images = tf.cast(images, tf.float32) * (1.0 / 255)
+        if training and augmentation:
+            images = augment_batch(images, augmentation)
+        targets = tf.one_hot(batch_labels, num_classes)
+        if soft_targets:
+            targets = tf.concat([targets, soft_targets[0]], axis=-1)
+        return images, targets
+
+    dataset = dataset.map(to_model_input, num_parallel_calls=autotune)
+    return dataset.prefetch(autotune)
+
+
+def build_datasets(data_dir, img_size, batch_size, validation_split=0.2, cache=None,
+                   augmentation=DEFAULT_AUGMENTATION, seed=None, num_shards=1, shard_index=0, soft_targets=None):
+    """
+    Training and validation pipelines over a class-folder dataset
+
+    Args:
+        cache: None, 'memory', or a path prefix; on disk the training and
+               validation caches get '.train' and '.val' suffixes
+        num_shards: Number of workers the data is split between
+        shard_index: This worker's index
+        soft_targets: Optional (train, val) teacher probabilities, in the file
+                      order of pack_dataset.list_class_files, for distillation
+
+    Returns:
+        (train_dataset, val_dataset, class_indices, train_samples, val_samples)
+    """
+    class_indices, train_files, train_labels, val_files, val_labels = list_class_files(data_dir, validation_split)
+    num_classes = len(class_indices)
+
+    def cache_for(suffix):
+        if not cache or cache == 'memory':
+            return cache
+        if num_shards > 1:
+            suffix += f'.worker{shard_index}'
+        return cache + suffix
+
+    train_soft_targets, val_soft_targets = soft_targets if soft_targets is not None else (None, None)
+    train_dataset = make_dataset(train_files, train_labels, num_classes, img_size, batch_size,
+                                 training=True, cache=cache_for('.train'), augmentation=augmentation, seed=seed,
+                                 num_shards=num_shards, shard_index=shard_index, soft_targets=train_soft_targets)
+    val_dataset = make_dataset(val_files, val_labels, num_classes, img_size, batch_size,
+                               training=False, cache=cache_for('.val'), num_shards=num_shards, shard_index=shard_index,
+                               soft_targets=val_soft_targets)
+    return train_dataset, val_dataset, class_indices, len(train_files), len(val_files)
+
+
+def make_packed_dataset(packed_dir, index, splits, batch_size, training=False, augmentation=DEFAULT_AUGMENTATION,
+                        shuffle_buffer=2048, seed=None, num_shards=1, shard_index=0):
+    """
+    Build a tf.data pipeline over shards written by pack_dataset.py
+
+    Shards are memory-mapped and read front to back in chunks, so an epoch is a
+    handful of sequential reads instead of thousands of file opens and JPEG
+    decodes. When training, the shard order is reshuffled every epoch and a
+    shuffle buffer mixes images across neighbouring chunks.
+
+    Args:
+        packed_dir: Directory of the packed dataset
+        index: Its index (see pack_dataset.read_index)
+        splits: Names of the splits to read, e.g. ('train',) or ('train', 'val')
+        batch_size: Batch size
+        training: Shuffle and augment (training set) or not
+        augmentation: Augmentation ranges used when training
+        shuffle_buffer: Images held in the shuffle buffer when training
+        seed: Optional seed for the shard order and shuffle buffer
+        num_shards: Number of workers the data is split between; every worker
+                    reads the (cheap, sequential) shards and keeps its own images
+        shard_index: This worker's index
+
+    Returns:
+        tf.data.Dataset
+    """
+    shards = [shard for split in splits for shard in index['splits'].get(split, [])]
+    height, width = index['img_size']
+    num_classes = len(index['class_indices'])
+    rng = None
+    if training:
+        # Workers shard the same stream, so they must all shuffle the shard order identically
+        rng = np.random.default_rng(seed if seed is not None or num_shards <= 1 else 0)
+
+    def chunks():
+        return iter_packed_chunks(packed_dir, shards, rng=rng)
+
+    dataset = tf.data.Dataset.from_generator(
+        chunks,
+        output_signature=(
+            tf.TensorSpec(shape=(None, height, width, 3), dtype=tf.uint8),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32)
+        )
+    )
+    dataset = shard_for_worker(dataset.unbatch(), num_shards, shard_index)
+    if training:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return batch_for_model(dataset, num_classes, batch_size, training, augmentation)
+
+
+def build_packed_datasets(packed_dir, img_size, batch_size, augmentation=DEFAULT_AUGMENTATION, seed=None,
+                          num_shards=1, shard_index=0):
+    """
+    Training and validation pipelines over a packed dataset (the split was fixed at packing time)
+
+    Returns:
+        (train_dataset, val_dataset, class_indices, train_samples, val_samples)
+    """
+    index = read_index(packed_dir)
+    if tuple(index['img_size']) != tuple(img_size):
+        raise ValueError(f"{packed_dir} was packed at {index['img_size']}, but the model expects {list(img_size)}")
+
+    train_dataset = make_packed_dataset(packed_dir, index, ('train',), batch_size, training=True,
+                                        augmentation=augmentation, seed=seed,
+                                        num_shards=num_shards, shard_index=shard_index)
+    val_dataset = make_packed_dataset(packed_dir, index, ('val',), batch_size,
+                                      num_shards=num_shards, shard_index=shard_index)
+    return train_dataset, val_dataset, index['class_indices'], split_size(index, 'train'), split_size(index, 'val')
@@ -0,0 +1,266 @@
+import math
+import numpy as np
+import cv2
+import preprocessing
+
+PROPOSAL_METHODS = ('windows', 'contours', 'both')
+
+# Window sides as fractions of the image's short side: the whole shelf, a few bins, single parts
+DEFAULT_SCALES = (1.0, 0.6, 0.35)
+
+
+def decode_for_detection(contents, img_size, scales=DEFAULT_SCALES, max_side=1024):
+    """
+    Decode image bytes at the lowest resolution that still gives the smallest
+    window the model's full input resolution
+
+    JPEGs are decoded at 1/2, 1/4 or 1/8 scale where that is enough (see
+    preprocessing.decode_image), and anything still longer than max_side is
+    shrunk once, so every crop is cut from a small image however large the upload.
+
+    Args:
+        contents: Raw bytes of the image file
+        img_size: Model input size as (height, width)
+        scales: Window scales that will be proposed
+        max_side: Longest side of the working image
+
+    Returns:
+        (BGR uint8 image, (y, x) factors from its pixels to the original image's),
+        or (None, None) if the bytes are not a valid image
+    """
+    needed = int(math.ceil(max(img_size) / min(scales)))
+    image = preprocessing.decode_image(contents, (needed, needed))
+    if image is None:
+        return None, None
+    height, width = image.shape[:2]
+    original = preprocessing.peek_image_size(contents) or (height, width)
+    if (original[0] > original[1]) != (height > width):
+        original = original[::-1]  # Decoding applied an EXIF rotation
+
+    factor = max_side / max(height, width)
+    if factor < 1:
+        image = cv2.resize(image, (max(1, round(width * factor)), max(1, round(height * factor))),
+                           interpolation=cv2.INTER_AREA)
+    return image, (original[0] / image.shape[0], original[1] / image.shape[1])
+
+
+def window_starts(length, side, stride):
+    """
+    Start offsets of windows of the given side along one axis, the last one flush with the edge
+    """
+    if side >= length:
+        return np.array([0])
+    starts = np.arange(0, length - side + 1, stride)
+    if starts[-1] != length - side:
+        starts = np.append(starts, length - side)
+    return starts
+
+
+def sliding_window_boxes(height, width, scales=DEFAULT_SCALES, overlap=0.5):
+    """
+    Square windows tiling the image at several scales
+
+    Args:
+        height, width: Image size
+        scales: Window sides as fractions of the image's short side
+        overlap: Fraction by which neighbouring windows overlap
+
+    Returns:
+        Int32 array of shape (K, 4) of (x0, y0, x1, y1) boxes
+    """
+    boxes = []
+    for scale in scales:
+        side = max(1, min(height, width, int(round(min(height, width) * scale))))
+        stride = max(1, int(side * (1 - overlap)))
+        xs, ys = np.meshgrid(window_starts(width, side, stride), window_starts(height, side, stride))
+        corners = np.stack([xs.ravel(), ys.ravel()], axis=1)
+        boxes.append(np.concatenate([corners, corners + side], axis=1))
+    return np.concatenate(boxes).astype(np.int32)
+
+
+def contour_boxes(image, min_area=0.005, max_area=0.9, margin=0.1, max_boxes=64, work_side=320):
+    """
+    Boxes around the outlines found by an edge pass over a thumbnail of the image
+
+    Parts on a plain shelf or bin floor stand out by their edges; dilating the
+    edge map joins each part's outline into one blob whose bounding box is a
+    proposal. This costs a few milliseconds however large the image is.
+
+    Args:
+        image: BGR uint8 image
+        min_area, max_area: Smallest and largest box kept, as fractions of the image area
+        margin: Fraction of each box's size added on every side, so crops include the part's edges
+        max_boxes: Keep at most this many boxes, largest first
+        work_side: Longest side of the thumbnail the edges are found on
+
+    Returns:
+        Int32 array of shape (K, 4) of (x0, y0, x1, y1) boxes
+    """
+    height, width = image.shape[:2]
+    factor = min(1.0, work_side / max(height, width))
+    small = image
+    if factor < 1:
+        small = cv2.resize(image, (max(1, round(width * factor)), max(1, round(height * factor))),
+                           interpolation=cv2.INTER_AREA)
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_BGR2GRAY), (5, 5), 0)
+    edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((5, 5), np.uint8), iterations=2)
+    contours = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+    if not contours:
+        return np.zeros((0, 4), dtype=np.int32)
+
+    rects = np.array([cv2.boundingRect(contour) for contour in contours], dtype=np.float64) / factor
+    areas = rects[:, 2] * rects[:, 3] / (height * width)
+    rects = rects[(areas >= min_area) & (areas <= max_area)]
+    rects = rects[np.argsort(-rects[:, 2] * rects[:, 3], kind='stable')[:max_boxes]]
+
+    x, y, w, h = rects.T
+    boxes = np.stack([x - margin * w, y - margin * h, x + w * (1 + margin), y + h * (1 + margin)], axis=1)
+    boxes = np.clip(np.round(boxes), 0, [width, height, width, height])
+    return boxes.astype(np.int32)
+
+
+def propose(image, method='windows', scales=DEFAULT_SCALES, overlap=0.5):
+    """
+    Candidate boxes for an image
+
+    Args:
+        image: BGR uint8 image
+        method: 'windows' (sliding_window_boxes), 'contours' (contour_boxes) or 'both'
+        scales: Window scales for 'windows' and 'both'
+        overlap: Window overlap for 'windows' and 'both'
+
+    Returns:
+        Int32 array of shape (K, 4) of (x0, y0, x1, y1) boxes; never empty, since
+        the whole image is proposed when nothing else is
+    """
+    if method not in PROPOSAL_METHODS:
+        raise ValueError(f"method must be one of {PROPOSAL_METHODS}, got '{method}'")
+    height, width = image.shape[:2]
+    boxes = []
+    if method in ('windows', 'both'):
+        boxes.append(sliding_window_boxes(height, width, scales, overlap))
+    if method in ('contours', 'both'):
+        boxes.append(contour_boxes(image))
+    boxes = np.concatenate(boxes)
+    if len(boxes) == 0:
+        return np.array([[0, 0, width, height]], dtype=np.int32)
+    return boxes
+
+
+def crop_batch(image, boxes, target_size, out=None):
+    """
+    Cut every box out of an image, resized and normalized into one batch buffer
+
+    Each crop is a slice of the decoded image, i.e. a view: the resize reads
+    it in place and preprocess_into writes the result straight into its row,
+    so no crop is ever copied on its own.
+
+    Args:
+        image: BGR uint8 image
+        boxes: (K, 4) array of (x0, y0, x1, y1) boxes
+        target_size: Model input size as (height, width)
+        out: Optional float32 array of shape (K, *target_size, 3)
+
+    Returns:
+        Float32 array of shape (K, *target_size, 3)
+    """
+    if out is None:
+        out = preprocessing.allocate_batch(len(boxes), target_size)
+    for row, (x0, y0, x1, y1) in enumerate(boxes):
+        preprocessing.preprocess_into(image[y0:y1, x0:x1], out[row])
+    return out
+
+
+def non_max_suppression(boxes, scores, iou_threshold=0.4, max_detections=None):
+    """
+    Greedy non-maximum suppression
+
+    Args:
+        boxes: (K, 4) array of (x0, y0, x1, y1) boxes
+        scores: (K,) array of scores
+        iou_threshold: Boxes overlapping a higher-scoring kept box by more than this IoU are dropped
+        max_detections: Stop after keeping this many boxes
+
+    Returns:
+        Int64 array of the kept boxes' indices, highest score first
+    """
+    boxes = np.asarray(boxes, dtype=np.float64)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-np.asarray(scores), kind='stable')
+    keep = []
+    while order.size and (max_detections is None or len(keep) < max_detections):
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = np.clip(np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0]), 0, None)
+        height = np.clip(np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1]), 0, None)
+        intersection = width * height
+        iou = intersection / np.maximum(areas[best] + areas[rest] - intersection, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def select_detections(boxes, probabilities, min_confidence=0.5, iou_threshold=0.4, max_detections=20):
+    """
+    Pick the boxes to report from the classifier's outputs for every proposal
+
+    The classifier has no background class, so a crop only counts as a part
+    when its top probability reaches min_confidence. Suppression is per class:
+    overlapping boxes with different labels are both kept.
+
+    Args:
+        boxes: (K, 4) array of proposals
+        probabilities: (K, num_classes) class probabilities of their crops
+        min_confidence: Lowest top probability reported
+        iou_threshold: IoU above which a same-class box is suppressed
+        max_detections: Report at most this many boxes
+
+    Returns:
+        Int64 array of indices into boxes, most confident first
+    """
+    labels = np.argmax(probabilities, axis=1)
+    confidences = probabilities[np.arange(len(labels)), labels]
+    candidates = np.flatnonzero(confidences >= min_confidence)
+    if len(candidates) == 0:
+        return candidates
+    # Shifting each class into its own coordinate range lets one NMS pass handle every class
+    offsets = (labels[candidates] * (int(boxes.max()) + 1))[:, None]
+    keep = non_max_suppression(boxes[candidates] + offsets, confidences[candidates], iou_threshold, max_detections)
+    return candidates[keep]
+
+
+def scale_boxes(boxes, scale):
+    """
+    Map boxes from the working image to the original image's pixels
+
+    Args:
+        boxes: (K, 4) array of (x0, y0, x1, y1) boxes
+        scale: (y, x) factors from decode_for_detection
+
+    Returns:
+        Int array of shape (K, 4)
+    """
+    factors = np.array([scale[1], scale[0], scale[1], scale[0]])
+    return np.round(np.asarray(boxes) * factors).astype(int)
+
+
+def detect(image, predict_batch, target_size, method='windows', scales=DEFAULT_SCALES, overlap=0.5,
+           min_confidence=0.5, iou_threshold=0.4, max_detections=20):
+    """
+    Find the parts in one decoded image
+
+    Every proposal's crop goes through predict_batch in a single batch.
+
+    Args:
+        image: BGR uint8 image (e.g. from decode_for_detection)
+        predict_batch: Function mapping a (K, *target_size, 3) batch to (K, num_classes) probabilities
+        target_size: Model input size as (height, width)
+        method, scales, overlap: Proposal settings (see propose)
+        min_confidence, iou_threshold, max_detections: Selection settings (see select_detections)
+
+    Returns:
+        (kept boxes in the image's pixels, their class probabilities, number of proposals)
+    """
+    boxes = propose(image, method, scales, overlap)
+    probabilities = np.asarray(predict_batch(crop_batch(image, boxes, target_size)))
+    keep = select_detections(boxes, probabilities, min_confidence, iou_threshold, max_detections)
+    return boxes[keep], probabilities[keep], len(boxes)
@@ -0,0 +1,131 @@
+import os
+import json
+import hashlib
+import numpy as np
+import tensorflow as tf
+from data_pipeline import make_dataset
+
+
+def soft_target_key(teacher_model_path, files, img_size):
+    """
+    Cache key for a teacher's outputs on a list of files: changes when the
+    teacher file, the file list or the input size does
+    """
+    stat = os.stat(teacher_model_path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{os.path.abspath(teacher_model_path)}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+    digest.update(f"{img_size[0]}x{img_size[1]}".encode())
+    for path in files:
+        digest.update(path.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def compute_soft_targets(teacher, files, img_size, batch_size=64):
+    """
+    Run the teacher over un-augmented images once
+
+    Images are decoded exactly as the training pipeline decodes them, so the
+    student is trained against the outputs for the inputs it sees.
+
+    Returns:
+        Float32 array of shape (len(files), teacher classes)
+    """
+    dataset = make_dataset(files, [0] * len(files), 1, img_size, batch_size, training=False)
+    outputs = [teacher.predict_batch(images.numpy()) for images, _ in dataset]
+    return np.concatenate(outputs).astype(np.float32)
+
+
+def load_soft_targets(teacher_model_path, teacher_class_map_path, files, class_indices, img_size,
+                      cache_dir='soft_target_cache', batch_size=64):
+    """
+    Teacher probabilities for every file, computed on the first call and read from disk after that
+
+    Args:
+        teacher_model_path: Trained Keras model of the teacher
+        teacher_class_map_path: The teacher's pickled class indices
+        files: Image paths, in the order the student's datasets use
+        class_indices: The student's class indices; the teacher's columns are
+                       reordered to match them
+        img_size: Model input size as (height, width)
+        cache_dir: Directory the targets are cached in
+        batch_size: Images per teacher forward pass
+
+    Returns:
+        Float32 array of shape (len(files), len(class_indices))
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    key = soft_target_key(teacher_model_path, files, img_size)
+    cache_path = os.path.join(cache_dir, f"soft_targets-{key}.npy")
+    meta_path = os.path.join(cache_dir, f"soft_targets-{key}.json")
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            teacher_classes = json.load(f)['class_indices']
+        targets = np.load(cache_path)
+        print(f"Loaded teacher soft targets for {len(files)} images from {cache_path}")
+    else:
+        from improved_parts_classifier import ImprovedPartsClassifier
+
+        teacher = ImprovedPartsClassifier(data_dir=None, img_size=img_size)
+        if not teacher.load_model(model_path=teacher_model_path, class_map_path=teacher_class_map_path):
+            raise RuntimeError(f"Could not load the teacher model {teacher_model_path}")
+        print(f"Computing teacher soft targets for {len(files)} images...")
+        targets = compute_soft_targets(teacher, files, img_size, batch_size)
+        teacher_classes = teacher.class_indices
+
+        tmp_path = cache_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, targets)
+        os.replace(tmp_path, cache_path)
+        # Written last, so an interrupted run never leaves a cache that looks complete
+        with open(meta_path, 'w') as f:
+            json.dump({'teacher_model_path': teacher_model_path, 'num_files': len(files),
+                       'class_indices': teacher_classes}, f)
+        print(f"Cached teacher soft targets in {cache_path}")
+
+    missing = sorted(set(class_indices) - set(teacher_classes))
+    if missing:
+        raise ValueError(f"The teacher was not trained on these classes: {missing}")
+    columns = [teacher_classes[name] for name, _ in sorted(class_indices.items(), key=lambda item: item[1])]
+    return np.ascontiguousarray(targets[:, columns])
+
+
+def distillation_loss(num_classes, temperature=4.0, alpha=0.7):
+    """
+    Keras loss for targets packed as [one-hot labels | teacher probabilities]
+
+    The teacher and student distributions are both softened by the temperature
+    and compared with the KL divergence (scaled by temperature squared, so its
+    gradients stay comparable to the hard-label term), then mixed with the
+    ordinary cross-entropy on the true labels.
+
+    Args:
+        num_classes: Number of classes (width of each half of the targets)
+        temperature: Softening temperature; higher values expose more of the
+                     teacher's similarity structure between classes
+        alpha: Weight of the teacher term (1 - alpha goes to the hard labels)
+    """
+    def distillation_loss(y_true, y_pred):
+        y_pred = tf.cast(y_pred, tf.float32)
+        hard = y_true[:, :num_classes]
+        teacher = y_true[:, num_classes:]
+        # Both models end in a softmax, so log-probabilities are logits up to a constant
+        student_log_probs = tf.nn.log_softmax(tf.math.log(tf.clip_by_value(y_pred, 1e-7, 1.0)) / temperature)
+        teacher_log_probs = tf.nn.log_softmax(tf.math.log(tf.clip_by_value(teacher, 1e-7, 1.0)) / temperature)
+        kl = tf.reduce_sum(tf.exp(teacher_log_probs) * (teacher_log_probs - student_log_probs), axis=-1)
+        cross_entropy = tf.keras.losses.categorical_crossentropy(hard, y_pred)
+        return alpha * temperature ** 2 * kl + (1 - alpha) * cross_entropy
+
+    return distillation_loss
+
+
+def hard_label_accuracy(num_classes):
+    """
+    Accuracy against the one-hot half of distillation targets, logged as 'accuracy'
+    so checkpoints and early stopping keep monitoring val_accuracy
+    """
+    def accuracy(y_true, y_pred):
+        return tf.keras.metrics.categorical_accuracy(y_true[:, :num_classes], y_pred)
+
+    return accuracy
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from improved_parts_classifier import ImprovedPartsClassifier
+from pack_dataset import list_class_files
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare a distilled student model with its teacher')
+    parser.add_argument('--teacher_model_path', type=str, required=True,
+                        help='Path to the teacher model')
+    parser.add_argument('--teacher_class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the teacher\'s class indices file')
+    parser.add_argument('--student_model_path', type=str, required=True,
+                        help='Path to the student model')
+    parser.add_argument('--student_class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the student\'s class indices file')
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help='Directory with one folder per class')
+    parser.add_argument('--validation_split', type=float, default=0.0,
+                        help='Only use the validation split of data_dir as used in training (0 uses every image)')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Images per forward pass for the throughput measurement')
+    parser.add_argument('--max_images', type=int, default=1000,
+                        help='Evaluate on at most this many images')
+    parser.add_argument('--timing_runs', type=int, default=20,
+                        help='Timed forward passes per measurement')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional JSON file to write the report to')
+    return parser.parse_args()
+
+def file_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+def load_labelled_images(classifier, data_dir, validation_split, max_images):
+    """
+    Preprocess a deterministic sample of labelled images once, shared by both models
+
+    Returns:
+        (float32 images of shape (N, H, W, 3), class folder name of each image)
+    """
+    class_indices, files, labels, val_files, val_labels = list_class_files(data_dir, validation_split)
+    if validation_split > 0:
+        files, labels = val_files, val_labels
+    names = {index: name for name, index in class_indices.items()}
+
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(files))[:max_images]
+    images = np.empty((len(order), *classifier.img_size, 3), dtype=np.float32)
+    for row, i in enumerate(order):
+        classifier.preprocess_image(files[i], images[row])
+    return images, [names[labels[i]] for i in order]
+
+def measure_model(classifier, model_path, images, class_names, batch_size, timing_runs):
+    """
+    Size, CPU latency, throughput and accuracy of one model
+
+    Returns:
+        Dictionary of measurements
+    """
+    probabilities = np.concatenate([
+        classifier.predict_batch(images[start:start + batch_size])
+        for start in range(0, len(images), batch_size)
+    ])
+    predicted = [name for name, _ in classifier.decode_predictions(probabilities)]
+
+    def time_batch(batch):
+        classifier.predict_batch(batch)
+        times = []
+        for _ in range(timing_runs):
+            start = time.perf_counter()
+            classifier.predict_batch(batch)
+            times.append(time.perf_counter() - start)
+        return float(np.median(times))
+
+    single_seconds = time_batch(images[:1])
+    batch = images[:batch_size]
+    batch_seconds = time_batch(batch)
+    return {
+        'model_path': model_path,
+        'params': int(classifier.model.count_params()),
+        'size_mb': file_size(model_path) / 2 ** 20,
+        'latency_ms': single_seconds * 1000,
+        'images_per_second': len(batch) / batch_seconds,
+        'accuracy': float(np.mean([p == t for p, t in zip(predicted, class_names)])),
+        'probabilities': probabilities
+    }
+
+def compare_models(teacher, teacher_model_path, student, student_model_path, images, class_names,
+                   batch_size=32, timing_runs=20):
+    """
+    Measure teacher and student on the same images
+
+    Returns:
+        Report with 'teacher' and 'student' measurements, the student/teacher
+        ratios and their top-1 agreement
+    """
+    report = {'num_images': len(images), 'batch_size': batch_size}
+    for name, classifier, model_path in (('teacher', teacher, teacher_model_path),
+                                         ('student', student, student_model_path)):
+        print(f"Measuring the {name}...")
+        report[name] = measure_model(classifier, model_path, images, class_names, batch_size, timing_runs)
+
+    teacher_top1 = [name for name, _ in teacher.decode_predictions(report['teacher'].pop('probabilities'))]
+    student_top1 = [name for name, _ in student.decode_predictions(report['student'].pop('probabilities'))]
+    report['top1_agreement'] = float(np.mean([t == s for t, s in zip(teacher_top1, student_top1)]))
+    report['student_vs_teacher'] = {
+        'params': report['student']['params'] / report['teacher']['params'],
+        'size': report['student']['size_mb'] / report['teacher']['size_mb'],
+        'latency': report['student']['latency_ms'] / report['teacher']['latency_ms'],
+        'throughput': report['student']['images_per_second'] / report['teacher']['images_per_second'],
+        'accuracy_delta': report['student']['accuracy'] - report['teacher']['accuracy']
+    }
+    return report
+
+def print_comparison(report):
+    teacher, student, ratios = report['teacher'], report['student'], report['student_vs_teacher']
+    print(f"\n{'':<20}{'teacher':>14}{'student':>14}{'student/teacher':>17}")
+    print(f"{'parameters':<20}{teacher['params']:>14,}{student['params']:>14,}{ratios['params']:>16.2f}x")
+    print(f"{'size (MB)':<20}{teacher['size_mb']:>14.1f}{student['size_mb']:>14.1f}{ratios['size']:>16.2f}x")
+    print(f"{'latency (ms)':<20}{teacher['latency_ms']:>14.2f}{student['latency_ms']:>14.2f}{ratios['latency']:>16.2f}x")
+    print(f"{'throughput (img/s)':<20}{teacher['images_per_second']:>14.1f}{student['images_per_second']:>14.1f}"
+          f"{ratios['throughput']:>16.2f}x")
+    print(f"{'accuracy':<20}{teacher['accuracy']:>14.4f}{student['accuracy']:>14.4f}{ratios['accuracy_delta']:>+17.4f}")
+    print(f"Top-1 agreement on {report['num_images']} images: {report['top1_agreement']:.4f}")
+
+def write_comparison(report, output_path):
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {output_path}")
+
+def main():
+    args = parse_args()
+    img_size = (args.img_size, args.img_size)
+
+    models = []
+    for model_path, class_map_path in ((args.teacher_model_path, args.teacher_class_map_path),
+                                       (args.student_model_path, args.student_class_map_path)):
+        classifier = ImprovedPartsClassifier(data_dir=None, img_size=img_size)
+        if not classifier.load_model(model_path=model_path, class_map_path=class_map_path):
+            raise RuntimeError(f"Could not load {model_path}")
+        models.append(classifier)
+    teacher, student = models
+
+    images, class_names = load_labelled_images(student, args.data_dir, args.validation_split, args.max_images)
+    report = compare_models(teacher, args.teacher_model_path, student, args.student_model_path, images, class_names,
+                            batch_size=args.batch_size, timing_runs=args.timing_runs)
+    print_comparison(report)
+    if args.output:
+        write_comparison(report, args.output)
+
+if __name__ == '__main__':
+    main()
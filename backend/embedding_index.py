@@ -0,0 +1,352 @@
+import os
+import json
+import time
+import threading
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: enrolments are only serialized within one process
+    fcntl = None
+
+INDEX_FILE = 'index.json'
+LOCK_FILE = 'index.lock'
+# Format 1 kept the arrays in these fixed names; format 2 names them per revision in index.json
+REFERENCES_FILE = 'references.npy'
+LABELS_FILE = 'labels.npy'
+INDEX_FORMAT_VERSION = 2
+READABLE_FORMAT_VERSIONS = (1, 2)
+REDUCTIONS = ['centroid', 'nearest']
+
+
+def normalize(embeddings):
+    """
+    L2-normalize embeddings row by row, so a dot product is a cosine similarity
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+
+def similarity_probabilities(similarities, temperature=0.05):
+    """
+    Turn per-class cosine similarities into probabilities with a temperature softmax
+
+    Args:
+        similarities: Array of shape (N, C); classes without references are -inf
+        temperature: Lower values make the distribution sharper
+
+    Returns:
+        Float32 array of shape (N, C) whose rows sum to 1
+    """
+    logits = similarities / temperature
+    logits = logits - np.max(logits, axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return (exp / exp.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def combine_probabilities(probabilities, index_probabilities, weight=0.5):
+    """
+    Weighted average of the softmax head's and the index's class probabilities
+
+    Classes only the index knows (enrolled after training) are past the end of
+    the softmax output and get their probability from the index alone.
+
+    Args:
+        probabilities: Softmax output of shape (N, num_classes)
+        index_probabilities: Index output of shape (N, C), C may be larger
+        weight: Share of the index (0 is the softmax alone, 1 the index alone)
+
+    Returns:
+        Float32 array of shape (N, max(num_classes, C))
+    """
+    width = max(probabilities.shape[1], index_probabilities.shape[1])
+    combined = np.zeros((len(probabilities), width), dtype=np.float32)
+    combined[:, :probabilities.shape[1]] += (1 - weight) * probabilities
+    combined[:, :index_probabilities.shape[1]] += weight * index_probabilities
+    return combined
+
+
+class EmbeddingIndex:
+    def __init__(self, index_dir, reduce='centroid', reload_interval=None):
+        """
+        Nearest-neighbour index of reference embeddings per class, kept on disk.
+
+        References are L2-normalized, so a query is scored against every class
+        with one matrix multiply. 'centroid' compares against the normalized mean
+        embedding of each class, an (num_labels, dim) matrix that stays small
+        even with thousands of classes; 'nearest' takes the best match over all
+        of a class's references, multiplying against the memory-mapped
+        reference matrix instead.
+
+        Files in index_dir: references-<revision>.npy (N, dim) float32,
+        labels-<revision>.npy (N,) int32 class indices and index.json with the
+        dimension, count, a revision that changes on every enrolment and the
+        names of that revision's two array files.
+
+        Args:
+            index_dir: Directory holding the index (created on the first save)
+            reduce: 'centroid' or 'nearest'
+            reload_interval: If set, minimum seconds between checks for an index
+                             saved by another process (see maybe_reload)
+        """
+        if reduce not in REDUCTIONS:
+            raise ValueError(f"reduce must be one of {REDUCTIONS}, got '{reduce}'")
+        self.index_dir = index_dir
+        self.reduce = reduce
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._mtime = None
+        self.revision = 0
+        self.dim = None
+        self._labels_file = None
+        # (references, labels, order, starts, counts, centroids) is swapped as a
+        # whole so searches never see a half-updated index
+        self._state = None
+        if os.path.isfile(os.path.join(index_dir, INDEX_FILE)):
+            self.load()
+
+    def load(self):
+        """
+        (Re)load the index from disk, memory-mapping the reference matrix
+        """
+        with open(os.path.join(self.index_dir, INDEX_FILE)) as f:
+            meta = json.load(f)
+        if meta.get('format_version') not in READABLE_FORMAT_VERSIONS:
+            raise ValueError(f"{self.index_dir} was written with an unsupported format version")
+
+        labels_file = meta.get('labels', LABELS_FILE)
+        references = np.load(os.path.join(self.index_dir, meta.get('references', REFERENCES_FILE)), mmap_mode='r')
+        reference_labels = np.load(os.path.join(self.index_dir, labels_file))
+        if len(references) != meta['count'] or len(reference_labels) != meta['count']:
+            raise ValueError(f"{self.index_dir} is inconsistent: index.json lists {meta['count']} references, "
+                             f"the files hold {len(references)} embeddings and {len(reference_labels)} labels")
+        self.dim = meta['dim']
+        self._labels_file = labels_file
+        self.revision = meta['revision']
+        self._mtime = os.path.getmtime(os.path.join(self.index_dir, INDEX_FILE))
+        self._state = self._build_state(references, reference_labels)
+
+    def _build_state(self, references, reference_labels, chunk_size=8192):
+        labels, positions = np.unique(reference_labels, return_inverse=True)
+        positions = positions.astype(np.int64)
+
+        # Per-class sums, accumulated chunk by chunk so the memmap is read once
+        sums = np.zeros((len(labels), references.shape[1]), dtype=np.float64)
+        for start in range(0, len(positions), chunk_size):
+            chunk_positions = positions[start:start + chunk_size]
+            order = np.argsort(chunk_positions, kind='stable')
+            sorted_positions = chunk_positions[order]
+            unique_positions, starts = np.unique(sorted_positions, return_index=True)
+            chunk = np.asarray(references[start:start + chunk_size])[order]
+            sums[unique_positions] += np.add.reduceat(chunk, starts, axis=0)
+
+        # Column order grouping the references by class, for the per-class max in 'nearest'
+        order = np.argsort(positions, kind='stable')
+        counts = np.bincount(positions, minlength=len(labels))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        return references, labels.astype(np.int64), order, starts, counts, normalize(sums)
+
+    def maybe_reload(self):
+        """
+        Reload the index if another process saved a newer one (at most once per reload_interval)
+        """
+        if self.reload_interval is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._last_check < self.reload_interval:
+                return
+            self._last_check = now
+            try:
+                mtime = os.path.getmtime(os.path.join(self.index_dir, INDEX_FILE))
+            except OSError:
+                return
+            if mtime != self._mtime:
+                try:
+                    self.load()
+                except (OSError, ValueError) as e:
+                    # Caught between another process's writes; keep serving the loaded index
+                    print(f"Embedding index reload failed, will retry: {e}")
+
+    def __len__(self):
+        return 0 if self._state is None else len(self._state[0])
+
+    @property
+    def num_labels(self):
+        return 0 if self._state is None else len(self._state[1])
+
+    def label_space(self):
+        """
+        Width of the class-index space the index scores (largest enrolled class index + 1)
+        """
+        return 0 if self._state is None else int(self._state[1][-1]) + 1
+
+    def count(self, label):
+        """
+        Number of references enrolled for a class index
+        """
+        if self._state is None:
+            return 0
+        _, labels, _, _, counts, _ = self._state
+        position = np.searchsorted(labels, label)
+        return int(counts[position]) if position < len(labels) and labels[position] == label else 0
+
+    def add(self, embeddings, labels):
+        """
+        Enrol reference embeddings and save the index
+
+        The reference matrix is rewritten with the new rows appended (copied in
+        chunks, never loaded whole) to files named after the new revision, and
+        index.json, which names them, is swapped in last with os.replace. Readers
+        in other processes therefore see either the old revision or the new one,
+        never one revision's references with another's labels. The previous
+        revision's files are kept for readers still loading them. Enrol many
+        classes in one call where possible, since every call rewrites the file.
+
+        Writers in several processes (e.g. uvicorn workers) take an exclusive
+        lock on index.lock and first load any revision another process saved
+        since, so no enrolment is lost.
+
+        Args:
+            embeddings: Array of shape (N, dim), e.g. from a few photos of a part
+            labels: Class index of each embedding (its index in Details.json), or
+                    a single class index for all of them
+        """
+        embeddings = normalize(np.atleast_2d(embeddings))
+        labels = np.broadcast_to(np.asarray(labels, dtype=np.int32), (len(embeddings),))
+        os.makedirs(self.index_dir, exist_ok=True)
+        with self._lock, self._exclusive_lock():
+            self._load_if_newer()
+            if self.dim is not None and embeddings.shape[1] != self.dim:
+                raise ValueError(f"Embedding dimension {embeddings.shape[1]} does not match the index ({self.dim})")
+            self.dim = embeddings.shape[1]
+
+            if self._state is None:
+                old_references = np.zeros((0, self.dim), dtype=np.float32)
+                old_labels = np.zeros(0, dtype=np.int32)
+            else:
+                old_references = self._state[0]
+                old_labels = np.load(os.path.join(self.index_dir, self._labels_file))
+            count = len(old_labels) + len(embeddings)
+            revision = self.revision + 1
+            references_file = f"references-{revision}.npy"
+            labels_file = f"labels-{revision}.npy"
+
+            references_tmp = os.path.join(self.index_dir, references_file + '.tmp')
+            out = np.lib.format.open_memmap(references_tmp, mode='w+', dtype=np.float32, shape=(count, self.dim))
+            for start in range(0, len(old_labels), 8192):
+                stop = min(start + 8192, len(old_labels))
+                out[start:stop] = old_references[start:stop]
+            out[len(old_labels):] = embeddings
+            out.flush()
+            del out
+            labels = np.concatenate([old_labels, labels])
+            labels_tmp = os.path.join(self.index_dir, labels_file + '.tmp')
+            with open(labels_tmp, 'wb') as f:
+                np.save(f, labels)
+
+            os.replace(references_tmp, os.path.join(self.index_dir, references_file))
+            os.replace(labels_tmp, os.path.join(self.index_dir, labels_file))
+            # Written last: until it is replaced, readers keep loading the previous revision's files
+            index_tmp = os.path.join(self.index_dir, INDEX_FILE + '.tmp')
+            with open(index_tmp, 'w') as f:
+                json.dump({
+                    'format_version': INDEX_FORMAT_VERSION,
+                    'dim': self.dim,
+                    'count': count,
+                    'revision': revision,
+                    'references': references_file,
+                    'labels': labels_file
+                }, f, indent=2)
+            os.replace(index_tmp, os.path.join(self.index_dir, INDEX_FILE))
+            # No other writer can publish while the lock is held, so nothing newer exists
+            self._remove_stale_files(keep=(revision, self.revision))
+
+            references = np.load(os.path.join(self.index_dir, references_file), mmap_mode='r')
+            self.revision = revision
+            self._labels_file = labels_file
+            self._state = self._build_state(references, labels)
+            self._mtime = os.path.getmtime(os.path.join(self.index_dir, INDEX_FILE))
+
+    @contextlib.contextmanager
+    def _exclusive_lock(self):
+        """
+        Hold an exclusive lock on index_dir shared by every process writing to it
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.index_dir, LOCK_FILE), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _load_if_newer(self):
+        """
+        Load the saved index if another process saved a revision this one hasn't seen
+        """
+        index_path = os.path.join(self.index_dir, INDEX_FILE)
+        if not os.path.isfile(index_path):
+            return
+        with open(index_path) as f:
+            revision = json.load(f).get('revision')
+        if self._state is None or revision != self.revision:
+            self.load()
+
+    def _remove_stale_files(self, keep):
+        """
+        Delete array files of revisions other than those in keep (including format 1's fixed names)
+        """
+        keep_files = {f"{prefix}-{revision}.npy" for prefix in ('references', 'labels') for revision in keep}
+        for name in os.listdir(self.index_dir):
+            if name.endswith('.npy') and name.startswith(('references', 'labels')) and name not in keep_files:
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except OSError:
+                    pass
+
+    def similarities(self, queries, num_classes=0):
+        """
+        Cosine similarity of each query to each class
+
+        Args:
+            queries: Embeddings of shape (N, dim); normalized here
+            num_classes: Minimum width of the output, e.g. the softmax head's
+                         number of classes
+
+        Returns:
+            Float32 array of shape (N, max(num_classes, label_space())), with
+            -inf for classes that have no references
+        """
+        queries = normalize(queries)
+        width = max(num_classes, self.label_space())
+        out = np.full((len(queries), width), -np.inf, dtype=np.float32)
+        if self._state is None:
+            return out
+        references, labels, order, starts, _, centroids = self._state
+
+        if self.reduce == 'centroid':
+            out[:, labels] = queries @ centroids.T
+        else:
+            scores = queries @ np.asarray(references).T
+            out[:, labels] = np.maximum.reduceat(scores[:, order], starts, axis=1)
+        return out
+
+    def stats(self):
+        """
+        Counts for health checks
+        """
+        return {
+            'references': len(self),
+            'classes': self.num_labels,
+            'dim': self.dim,
+            'revision': self.revision,
+            'reduce': self.reduce
+        }
@@ -0,0 +1,58 @@
+import argparse
+from improved_parts_classifier import ImprovedPartsClassifier
+from evaluation import print_report
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Evaluate a trained model with per-class metrics')
+    parser.add_argument('--test_dir', type=str, required=True,
+                        help='Directory with one folder per class, or a dataset packed by pack_dataset.py')
+    parser.add_argument('--model_path', type=str, default='improved_parts_model.h5',
+                        help='Path to the trained model')
+    parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the class indices file')
+    parser.add_argument('--backend', type=str, default='keras', choices=['keras', 'savedmodel', 'tflite', 'onnx'],
+                        help='Inference backend to run the model with')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Thread count for the tflite and onnx backends')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='Images per forward pass')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Threads decoding images in parallel')
+    parser.add_argument('--top_k', type=int, nargs='+', default=[1, 3, 5],
+                        help='Values of k to report top-k accuracy for')
+    parser.add_argument('--worst', type=int, default=10,
+                        help='Number of lowest-F1 classes to print')
+    parser.add_argument('--output', type=str, default='evaluation_report.json',
+                        help='JSON file to write the full report to')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    
+    classifier = ImprovedPartsClassifier(
+        data_dir=None,
+        img_size=(args.img_size, args.img_size)
+    )
+    loaded = classifier.load_model(
+        model_path=args.model_path,
+        class_map_path=args.class_map_path,
+        backend=args.backend,
+        num_threads=args.num_threads
+    )
+    if not loaded:
+        print("Failed to load model. Exiting.")
+        return
+    
+    report = classifier.evaluate_detailed(
+        test_dir=args.test_dir,
+        batch_size=args.batch_size,
+        top_k=args.top_k,
+        num_workers=args.num_workers,
+        report_path=args.output
+    )
+    print_report(report, worst=args.worst)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import json
+import numpy as np
+
+
+class EvaluationAccumulator:
+    def __init__(self, num_classes, top_k=(1, 3, 5)):
+        """
+        Streaming classification metrics over batches of model outputs.
+
+        Only the confusion matrix, top-k hit counts and the summed loss are kept,
+        so memory doesn't grow with the size of the test set.
+
+        Args:
+            num_classes: Number of classes the model predicts
+            top_k: Values of k to report top-k accuracy for
+        """
+        self.num_classes = num_classes
+        self.top_k = tuple(k for k in sorted(set(top_k)) if k <= num_classes)
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.top_k_hits = np.zeros(len(self.top_k), dtype=np.int64)
+        self.loss_sum = 0.0
+        self.count = 0
+
+    def update(self, probabilities, labels):
+        """
+        Add a batch of results
+
+        Args:
+            probabilities: Array of shape (N, num_classes)
+            labels: Integer array of shape (N,) with the true class indices
+        """
+        probabilities = np.asarray(probabilities, dtype=np.float32)
+        labels = np.asarray(labels, dtype=np.int64)
+        if len(labels) == 0:
+            return
+
+        predictions = np.argmax(probabilities, axis=1)
+        self.confusion += np.bincount(
+            labels * self.num_classes + predictions,
+            minlength=self.num_classes * self.num_classes
+        ).reshape(self.num_classes, self.num_classes)
+
+        # A label is in the top k when fewer than k classes score strictly higher
+        true_scores = probabilities[np.arange(len(labels)), labels]
+        rank = np.sum(probabilities > true_scores[:, None], axis=1)
+        self.top_k_hits += np.sum(rank[None, :] < np.asarray(self.top_k)[:, None], axis=1)
+
+        self.loss_sum += float(-np.log(np.clip(true_scores, 1e-7, 1.0)).sum())
+        self.count += len(labels)
+
+    def report(self, class_names=None):
+        """
+        Metrics over everything added so far
+
+        Args:
+            class_names: Optional list of class names, indexed by class index
+
+        Returns:
+            Dictionary with overall accuracy, loss, top-k accuracy, macro and
+            weighted averages, per-class precision/recall/F1/support and the
+            confusion matrix (rows are true classes, columns predictions)
+        """
+        confusion = self.confusion
+        true_positives = np.diag(confusion).astype(np.float64)
+        support = confusion.sum(axis=1)
+        predicted = confusion.sum(axis=0)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(predicted > 0, true_positives / predicted, 0.0)
+            recall = np.where(support > 0, true_positives / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+        if class_names is None:
+            class_names = [f"Class {i}" for i in range(self.num_classes)]
+        count = max(self.count, 1)
+        present = support > 0
+        weights = support / count
+
+        def averages(values):
+            return {
+                'macro': float(values[present].mean()) if present.any() else 0.0,
+                'weighted': float((values * weights).sum())
+            }
+
+        return {
+            'num_samples': int(self.count),
+            'accuracy': float(true_positives.sum() / count),
+            'loss': self.loss_sum / count,
+            'top_k_accuracy': {str(k): float(hits / count) for k, hits in zip(self.top_k, self.top_k_hits)},
+            'precision': averages(precision),
+            'recall': averages(recall),
+            'f1': averages(f1),
+            'per_class': [
+                {
+                    'index': i,
+                    'class': class_names[i],
+                    'precision': float(precision[i]),
+                    'recall': float(recall[i]),
+                    'f1': float(f1[i]),
+                    'support': int(support[i])
+                }
+                for i in range(self.num_classes)
+            ],
+            'confusion_matrix': confusion.tolist()
+        }
+
+
+def print_report(report, worst=10):
+    """
+    Print the headline metrics and the classes with the lowest F1
+    """
+    print(f"Samples: {report['num_samples']}")
+    print(f"Accuracy: {report['accuracy']:.4f}  Loss: {report['loss']:.4f}")
+    for k, accuracy in report['top_k_accuracy'].items():
+        print(f"Top-{k} accuracy: {accuracy:.4f}")
+    print(f"Macro F1: {report['f1']['macro']:.4f}  Weighted F1: {report['f1']['weighted']:.4f}")
+
+    classes = sorted((c for c in report['per_class'] if c['support'] > 0), key=lambda c: c['f1'])[:worst]
+    if classes:
+        print(f"\n{'class':<40}{'precision':>10}{'recall':>10}{'f1':>10}{'support':>9}")
+        for c in classes:
+            print(f"{c['class'][:39]:<40}{c['precision']:>10.3f}{c['recall']:>10.3f}{c['f1']:>10.3f}{c['support']:>9}")
+
+
+def write_report(report, report_path):
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Evaluation report written to {report_path}")
@@ -1,21 +1,42 @@
 import os
+import math
 import numpy as np
-import tensorflow as tf
-from tensorflow.keras.applications import ResNet50V2, EfficientNetV2L
-from tensorflow.keras.models import Model
-from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout
-from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
-from keras.optimizers import Adam
-import matplotlib.pyplot as plt
 import pickle
-from pathlib import Path
-from tqdm import tqdm
-import cv2
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from inference_backends import KerasBackend, load_backend
+from embedding_index import normalize
+from tta import DEFAULT_VIEWS, augment, average_views
+import preprocessing
+import detection
+
+# TensorFlow training utilities and matplotlib are imported inside the methods
+# that need them, so serving (api.py) only pays for what inference uses
+
+# Keras releases whose private trainer internals the multi-worker workaround
+# (ImprovedPartsClassifier._multi_worker_keras) was verified against
+MULTI_WORKER_KERAS_VERSIONS = ('3.9.',)
+
+
+def check_multi_worker_keras():
+    """
+    Refuse to train with several workers on a Keras release the workaround hasn't been verified on
+    """
+    import keras
+    
+    if not keras.__version__.startswith(MULTI_WORKER_KERAS_VERSIONS):
+        raise RuntimeError(
+            f"Multi-worker training patches Keras internals verified only on Keras "
+            f"{', '.join(version + 'x' for version in MULTI_WORKER_KERAS_VERSIONS)}, "
+            f"but Keras {keras.__version__} is installed. Install the version pinned in "
+            f"requirements.txt, or check the patches in _multi_worker_keras against it."
+        )
 
 
 class ImprovedPartsClassifier:
-    def __init__(self, data_dir, img_size=(224, 224), batch_size=16, model_choice='resnet'):
+    def __init__(self, data_dir, img_size=(224, 224), batch_size=16, model_choice='resnet',
+                 precision='float32', jit_compile=False, strategy=None, head_units=(1024, 512)):
         """
         Initialize the improved spare part classifier.
         
@@ -23,20 +44,73 @@ class ImprovedPartsClassifier:
             data_dir: Directory containing class folders with images
             img_size: Input image size for the model (default: 224x224)
             batch_size: Batch size for training (default: 16)
-            model_choice: Base model to use ('resnet', 'efficientnet')
+            model_choice: Base model to use ('resnet', 'efficientnet', or 'mobilenet'
+                          for a small, fast model, e.g. the first tier of a cascade)
+            precision: 'float32', or 'mixed_bfloat16' to compute in bfloat16 with
+                       float32 weights (worth it on CPUs with AVX512-BF16/AMX)
+            jit_compile: XLA-compile training steps and, with the keras backend,
+                         inference
+            strategy: Optional tf.distribute.MultiWorkerMirroredStrategy (one
+                      replica per worker process) to train data-parallel with;
+                      batch_size is then per worker
+            head_units: Sizes of the Dense layers in the classification head
+                        (default: 1024 and 512); smaller heads suit distilled students
         """
         self.data_dir = data_dir
         self.img_size = img_size
         self.batch_size = batch_size
         self.model_choice = model_choice
+        self.precision = precision
+        self.jit_compile = jit_compile
+        self.strategy = strategy
+        self.head_units = tuple(head_units)
+        self.distillation = None
+        self.num_workers = 1
+        self.worker_index = 0
+        if strategy is not None:
+            self.num_workers = strategy.num_replicas_in_sync
+            self.worker_index = strategy.cluster_resolver.task_id or 0
+        if self.num_workers > 1:
+            check_multi_worker_keras()
         self.model = None
+        self.backend = None
         self.class_names = []
         self.class_indices = {}
         
-    def load_data(self, validation_split=0.2):
+    def load_data(self, validation_split=0.2, loader='generator', cache=None):
         """
         Load and preprocess image data from directories
+        
+        If data_dir is a dataset packed by pack_dataset.py, its shards are read
+        through tf.data whatever the loader, and the split chosen at packing time
+        is used.
+        
+        Args:
+            validation_split: Fraction of each class held out for validation
+            loader: 'generator' for ImageDataGenerator.flow_from_directory, or
+                    'tfdata' for the parallel tf.data pipeline in data_pipeline.py
+            cache: With the tfdata loader, None, 'memory', or a file path prefix
+                   to cache decoded images on disk
         """
+        from pack_dataset import is_packed
+        
+        self.validation_split = validation_split
+        if self.distillation is not None:
+            if is_packed(self.data_dir):
+                raise ValueError("Distillation needs a class-folder dataset, not a packed one")
+            if loader != 'tfdata':
+                print("Distillation feeds the teacher's soft targets through tf.data; using the tfdata loader")
+                loader = 'tfdata'
+        if self.num_workers > 1 and loader != 'tfdata' and not is_packed(self.data_dir):
+            print("Distributed training shards the data through tf.data; using the tfdata loader")
+            loader = 'tfdata'
+        if is_packed(self.data_dir) or loader == 'tfdata':
+            return self._load_data_tfdata(validation_split, cache)
+        if loader != 'generator':
+            raise ValueError("loader must be 'generator' or 'tfdata'")
+        
+        from tensorflow.keras.preprocessing.image import ImageDataGenerator
+        
         print("Loading and preparing data...")
         
         # Get class names from directory structure
@@ -92,69 +166,313 @@ class ImprovedPartsClassifier:
         # Reverse the dictionary to map indices to class names
         self.idx_to_class = {v: k for k, v in self.class_indices.items()}
         
-        print(f"Prepared {self.train_generator.samples} training samples")
-        print(f"Prepared {self.validation_generator.samples} validation samples")
+        self.train_samples = self.train_generator.samples
+        self.validation_samples = self.validation_generator.samples
+        # The generators loop forever, so Keras needs to be told where an epoch ends
+        self.steps_per_epoch = self.train_samples // self.batch_size
+        self.validation_steps = self.validation_samples // self.batch_size
+        
+        print(f"Prepared {self.train_samples} training samples")
+        print(f"Prepared {self.validation_samples} validation samples")
         
         return self.train_generator, self.validation_generator
+    
+    def _load_data_tfdata(self, validation_split, cache):
+        """
+        Load data through tf.data (same classes, split and augmentation as the generator loader)
+        """
+        from data_pipeline import build_datasets, build_packed_datasets
+        from pack_dataset import is_packed
+        
+        if is_packed(self.data_dir):
+            print(f"Loading packed dataset from {self.data_dir}...")
+            (self.train_generator, self.validation_generator, self.class_indices,
+             self.train_samples, self.validation_samples) = build_packed_datasets(
+                self.data_dir,
+                self.img_size,
+                self.batch_size,
+                num_shards=self.num_workers,
+                shard_index=self.worker_index
+            )
+        else:
+            print("Loading and preparing data (tf.data)...")
+            soft_targets = None
+            if self.distillation is not None:
+                soft_targets = self._soft_targets(validation_split)
+            (self.train_generator, self.validation_generator, self.class_indices,
+             self.train_samples, self.validation_samples) = build_datasets(
+                self.data_dir,
+                self.img_size,
+                self.batch_size,
+                validation_split=validation_split,
+                cache=cache,
+                num_shards=self.num_workers,
+                shard_index=self.worker_index,
+                soft_targets=soft_targets
+            )
+        self.class_names = list(self.class_indices.keys())
+        self.idx_to_class = {v: k for k, v in self.class_indices.items()}
+        # The datasets end after one pass, which is exactly one epoch
+        self.steps_per_epoch = None
+        self.validation_steps = None
+        if self.num_workers > 1:
+            # Every worker must run the same number of steps, or the gradient
+            # all-reduce waits forever on the worker that ran out; so repeat the
+            # shards and stop each epoch at the smallest shard's batch count
+            self.steps_per_epoch = max(1, (self.train_samples // self.num_workers) // self.batch_size)
+            self.validation_steps = max(1, (self.validation_samples // self.num_workers) // self.batch_size)
+            # Keras treats each batch under the strategy as the global batch and
+            # hands every worker 1/num_workers of it, so regroup the repeated
+            # stream into global batches to keep batch_size per worker
+            global_batch_size = self.batch_size * self.num_workers
+            self.train_generator = self.train_generator.repeat().rebatch(global_batch_size)
+            self.validation_generator = self.validation_generator.repeat().rebatch(global_batch_size)
+            print(f"Worker {self.worker_index + 1}/{self.num_workers}: {self.steps_per_epoch} steps per epoch "
+                  f"of {self.batch_size} images per worker")
+        
+        print(f"Found {len(self.class_names)} classes")
+        print(f"Prepared {self.train_samples} training samples")
+        print(f"Prepared {self.validation_samples} validation samples")
+        
+        return self.train_generator, self.validation_generator
+        
+    def distill_from(self, teacher_model_path, teacher_class_map_path='improved_class_indices.pkl',
+                     temperature=4.0, alpha=0.7, cache_dir='soft_target_cache'):
+        """
+        Train this model as a student of an already trained classifier
+        
+        Call before load_data. The teacher's probabilities for every training
+        and validation image are computed once (without augmentation) and
+        cached in cache_dir, so training never runs the teacher; the student
+        learns from those soft targets mixed with the true labels (see
+        distillation.distillation_loss).
         
-    def build_model(self):
+        Args:
+            teacher_model_path: Trained Keras model to distill
+            teacher_class_map_path: The teacher's class indices
+            temperature: Softening temperature for both distributions
+            alpha: Weight of the teacher's targets against the true labels
+            cache_dir: Directory the teacher's outputs are cached in
+        """
+        self.distillation = {
+            'teacher_model_path': teacher_model_path,
+            'teacher_class_map_path': teacher_class_map_path,
+            'temperature': temperature,
+            'alpha': alpha,
+            'cache_dir': cache_dir
+        }
+    
+    def _soft_targets(self, validation_split):
+        """
+        The teacher's (train, val) soft targets, in the file order build_datasets uses
+        """
+        from pack_dataset import list_class_files
+        from distillation import load_soft_targets
+        
+        class_indices, train_files, _, val_files, _ = list_class_files(self.data_dir, validation_split)
+        targets = load_soft_targets(
+            self.distillation['teacher_model_path'],
+            self.distillation['teacher_class_map_path'],
+            train_files + val_files,
+            class_indices,
+            self.img_size,
+            cache_dir=self.distillation['cache_dir']
+        )
+        return targets[:len(train_files)], targets[len(train_files):]
+    
+    def _loss_and_metrics(self):
+        """
+        Loss and metrics to compile the full model with: cross-entropy on the
+        labels, or the distillation loss when training as a student
+        """
+        if self.distillation is None:
+            return {'loss': 'categorical_crossentropy', 'metrics': ['accuracy']}
+        from distillation import distillation_loss, hard_label_accuracy
+        
+        num_classes = len(self.class_names)
+        return {
+            'loss': distillation_loss(num_classes, self.distillation['temperature'], self.distillation['alpha']),
+            'metrics': [hard_label_accuracy(num_classes)]
+        }
+    
+    def build_model(self, weights='imagenet'):
         """
         Build a transfer learning model using ResNet50V2 or EfficientNetV2L as base
+        
+        Args:
+            weights: Base model weights, 'imagenet' or None for random
+                     initialization (e.g. offline benchmarks)
         """
-        print(f"Building model with {self.model_choice} as base...")
+        from keras.optimizers import Adam
+        from keras import mixed_precision
+        
+        print(f"Building model with {self.model_choice} as base ({self.precision})...")
         num_classes = len(self.class_names)
         
+        # Layers pick up the global policy when they are created, so set it only
+        # while building this model
+        previous_policy = mixed_precision.global_policy()
+        mixed_precision.set_global_policy(self.precision)
+        try:
+            # Under a distribution strategy, variables (and optimizer slots) must be created in its scope
+            with self._scope():
+                self._build_layers(num_classes, weights)
+                
+                # Compile the model
+                self.model.compile(
+                    optimizer=Adam(learning_rate=0.001),
+                    jit_compile=self.jit_compile,
+                    **self._loss_and_metrics()
+                )
+        finally:
+            mixed_precision.set_global_policy(previous_policy)
+        
+        print(f"Model built with {len(self.class_names)} output classes")
+        return self.model
+    
+    @contextlib.contextmanager
+    def _multi_worker_keras(self):
+        """
+        Work around Keras 3 failing in fit() and evaluate() under MultiWorkerMirroredStrategy
+        
+        Before training, Keras builds the model's metrics from the first batch,
+        which it gets by reducing the distributed batch with strategy.reduce;
+        that raises for a nested (images, labels) batch spread over several
+        workers. Only the batch's structure and shapes matter there, so this
+        worker's own replica of the batch is used instead.
+        
+        After every step Keras then averages the metric values over the workers
+        along axis 0, which raises for the scalar values every metric returns,
+        so scalars are averaged as a whole.
+        
+        Both patch private Keras code (checked by check_multi_worker_keras), so
+        they only apply with several workers and are undone when the block exits.
+        """
+        if self.num_workers <= 1:
+            yield
+            return
+        
+        import tensorflow as tf
+        from keras.src.backend.tensorflow import trainer
+        
+        model = self.model
+        maybe_symbolic_build = model._maybe_symbolic_build
+        reduce_per_replica = trainer.reduce_per_replica
+        
+        def build_from_local_batch(iterator=None, data_batch=None):
+            if iterator is not None:
+                for _, it in iterator:
+                    data_batch = tf.nest.map_structure(
+                        lambda value: model.distribute_strategy.experimental_local_results(value)[0], next(it))
+                    break
+            return maybe_symbolic_build(data_batch=data_batch)
+        
+        def reduce_scalars_per_replica(values, strategy, reduction):
+            if reduction in ('auto', 'mean') and trainer._collective_all_reduce_multi_worker(strategy):
+                def reduce(value):
+                    rank = strategy.experimental_local_results(value)[0].shape.rank
+                    return strategy.reduce('MEAN', value, axis=0 if rank else None)
+                return tf.nest.map_structure(reduce, values)
+            return reduce_per_replica(values, strategy, reduction)
+        
+        model._maybe_symbolic_build = build_from_local_batch
+        trainer.reduce_per_replica = reduce_scalars_per_replica
+        try:
+            yield
+        finally:
+            trainer.reduce_per_replica = reduce_per_replica
+            del model._maybe_symbolic_build
+    
+    def _scope(self):
+        return self.strategy.scope() if self.strategy is not None else contextlib.nullcontext()
+    
+    @property
+    def is_chief(self):
+        """
+        Whether this process writes checkpoints and the final model (always true without a strategy)
+        """
+        return self.worker_index == 0
+    
+    def _build_layers(self, num_classes, weights='imagenet'):
+        from tensorflow.keras.applications import ResNet50V2, EfficientNetV2L, MobileNetV2
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.layers import Dense, GlobalAveragePooling2D, Dropout, Input
+        
         # Create base pre-trained model
         if self.model_choice == 'resnet':
-            base_model = ResNet50V2(weights='imagenet', include_top=False, input_shape=(*self.img_size, 3))
+            base_model = ResNet50V2(weights=weights, include_top=False, input_shape=(*self.img_size, 3))
         elif self.model_choice == 'efficientnet':
-            base_model = EfficientNetV2L(weights='imagenet', include_top=False, input_shape=(*self.img_size, 3))
+            base_model = EfficientNetV2L(weights=weights, include_top=False, input_shape=(*self.img_size, 3))
+        elif self.model_choice == 'mobilenet':
+            base_model = MobileNetV2(weights=weights, include_top=False, input_shape=(*self.img_size, 3))
         else:
-            raise ValueError("model_choice must be 'resnet' or 'efficientnet'")
+            raise ValueError("model_choice must be 'resnet', 'efficientnet' or 'mobilenet'")
         
         # Freeze the base model layers
         for layer in base_model.layers:
             layer.trainable = False
             
         # Add custom classification head
-        x = base_model.output
-        x = GlobalAveragePooling2D()(x)
-        x = Dense(1024, activation='relu')(x)
-        x = Dropout(0.5)(x)  # Higher dropout to prevent overfitting
-        x = Dense(512, activation='relu')(x)
-        x = Dropout(0.3)(x)
-        predictions = Dense(num_classes, activation='softmax')(x)
+        features = GlobalAveragePooling2D()(base_model.output)
+        head_layers = []
+        for i, units in enumerate(self.head_units):
+            head_layers.append(Dense(units, activation='relu'))
+            head_layers.append(Dropout(0.5 if i == 0 else 0.3))  # Higher dropout first to prevent overfitting
+        # The softmax always runs in float32, whatever the policy
+        head_layers.append(Dense(num_classes, activation='softmax', dtype='float32'))
+        x = features
+        for layer in head_layers:
+            x = layer(x)
+        predictions = x
         
         # Create the final model
         self.model = Model(inputs=base_model.input, outputs=predictions)
+        self.backend = None
+        
+        # The backbone up to the pooled features, and the head on its own; both
+        # share their layers (and weights) with self.model
+        self.feature_extractor = Model(inputs=base_model.input, outputs=features)
+        self._joint_model = None
+        feature_input = Input(shape=features.shape[1:])
+        x = feature_input
+        for layer in head_layers:
+            x = layer(x)
+        self.head_model = Model(inputs=feature_input, outputs=x)
         
         # Store the base model for later use in fine-tuning
         self.base_model = base_model
-        
-        # Compile the model
-        self.model.compile(
-            optimizer=Adam(learning_rate=0.001),
-            loss='categorical_crossentropy',
-            metrics=['accuracy']
-        )
-        
-        print(f"Model built with {len(self.class_names)} output classes")
-        return self.model
     
-    def train(self, epochs=15, fine_tune_epochs=15):
+    def train(self, epochs=15, fine_tune_epochs=15, callbacks=None, feature_cache_dir=None, feature_variants=1):
         """
         Train the model with a two-phase approach: feature extraction and fine-tuning
         
         Args:
             epochs: Number of initial training epochs (feature extraction phase)
             fine_tune_epochs: Number of fine-tuning epochs
+            callbacks: Optional extra Keras callbacks for both phases
+            feature_cache_dir: If set, phase 1 trains only the head on backbone
+                               features cached in this directory (see cache_features)
+            feature_variants: Augmented passes over the training set stored in the cache
         """
+        from tensorflow.keras.callbacks import ModelCheckpoint, EarlyStopping, ReduceLROnPlateau
+        from keras.optimizers import Adam
+        
+        if feature_cache_dir and self.num_workers > 1:
+            raise ValueError("The feature cache can't be used with distributed training")
+        if feature_cache_dir and self.distillation is not None:
+            raise ValueError("The feature cache trains on hard labels only; it can't be used for distillation")
         if self.model is None:
             self.build_model()
             
         # Set up callbacks
+        # Every worker runs the same callbacks so they all stop on the same epoch
+        # (the monitored metrics are already averaged across workers), but only
+        # the chief's checkpoint goes to the real path
+        checkpoint_path = 'improved_model_checkpoint.h5'
+        if not self.is_chief:
+            checkpoint_path = os.path.join(tempfile.mkdtemp(prefix=f'worker{self.worker_index}_'), checkpoint_path)
         checkpoint = ModelCheckpoint(
-            'improved_model_checkpoint.h5',
+            checkpoint_path,
             monitor='val_accuracy',
             save_best_only=True,
             mode='max',
@@ -177,18 +495,28 @@ class ImprovedPartsClassifier:
             verbose=1
         )
         
-        callbacks = [checkpoint, early_stopping, reduce_lr]
+        callbacks = [checkpoint, early_stopping, reduce_lr] + list(callbacks or [])
         
         # Phase 1: Train with frozen base model (feature extraction)
-        print("Phase 1: Training with frozen base model (feature extraction)...")
-        history = self.model.fit(
-            self.train_generator,
-            steps_per_epoch=self.train_generator.samples // self.batch_size,
-            validation_data=self.validation_generator,
-            validation_steps=self.validation_generator.samples // self.batch_size,
-            epochs=epochs,
-            callbacks=callbacks
-        )
+        if feature_cache_dir:
+            print("Phase 1: Training the head on cached backbone features...")
+            history = self.train_head_on_features(
+                feature_cache_dir,
+                epochs=epochs,
+                variants=feature_variants,
+                callbacks=[early_stopping, reduce_lr] + list(callbacks or [])
+            )
+        else:
+            print("Phase 1: Training with frozen base model (feature extraction)...")
+            with self._multi_worker_keras():
+                history = self.model.fit(
+                    self.train_generator,
+                    steps_per_epoch=self.steps_per_epoch,
+                    validation_data=self.validation_generator,
+                    validation_steps=self.validation_steps,
+                    epochs=epochs,
+                    callbacks=callbacks
+                )
         
         # Phase 2: Fine-tuning - unfreeze some layers and train with lower learning rate
         print("Phase 2: Fine-tuning with selected layers unfrozen...")
@@ -198,38 +526,164 @@ class ImprovedPartsClassifier:
             # For ResNet, unfreeze the last conv block (stage 5)
             for layer in self.base_model.layers[-30:]:  # Last 30 layers (approximately last block for ResNet50V2)
                 layer.trainable = True
+        elif self.model_choice == 'mobilenet':
+            # For MobileNetV2, unfreeze the last two inverted residual blocks and the final conv
+            for layer in self.base_model.layers[-21:]:
+                layer.trainable = True
         else:
             # For EfficientNet, unfreeze the last few blocks
             for layer in self.base_model.layers[-50:]:  # Last 50 layers
                 layer.trainable = True
         
         # Recompile with much lower learning rate for fine-tuning
-        self.model.compile(
-            optimizer=Adam(learning_rate=1e-5),  # Much lower learning rate
-            loss='categorical_crossentropy',
-            metrics=['accuracy']
-        )
+        with self._scope():
+            self.model.compile(
+                optimizer=Adam(learning_rate=1e-5),  # Much lower learning rate
+                jit_compile=self.jit_compile,
+                **self._loss_and_metrics()
+            )
         
         # Print model summary after unfreezing
         self.model.summary()
         
         # Continue training with fine-tuning
-        fine_tune_history = self.model.fit(
-            self.train_generator,
-            steps_per_epoch=self.train_generator.samples // self.batch_size,
-            validation_data=self.validation_generator,
-            validation_steps=self.validation_generator.samples // self.batch_size,
-            epochs=fine_tune_epochs,
-            callbacks=callbacks
-        )
+        with self._multi_worker_keras():
+            fine_tune_history = self.model.fit(
+                self.train_generator,
+                steps_per_epoch=self.steps_per_epoch,
+                validation_data=self.validation_generator,
+                validation_steps=self.validation_steps,
+                epochs=fine_tune_epochs,
+                callbacks=callbacks
+            )
         
         # Combine histories
         combined_history = {}
         for key in history.history:
-            combined_history[key] = history.history[key] + fine_tune_history.history[key]
+            combined_history[key] = history.history[key] + fine_tune_history.history.get(key, [])
             
         return type('History', (), {'history': combined_history})
     
+    def _extract_features(self, data, num_samples, features_out, labels_out, offset=0):
+        """
+        Run one pass of a data loader through the frozen backbone into preallocated arrays
+        
+        Returns:
+            Number of rows written
+        """
+        batches = iter(data)
+        written = 0
+        while written < num_samples:
+            # Generators loop forever, so stop after exactly one pass
+            images, labels = next(batches)
+            take = min(len(labels), num_samples - written)
+            features = self.feature_extractor.predict_on_batch(np.asarray(images)[:take])
+            features_out[offset + written:offset + written + take] = np.asarray(features)
+            labels_out[offset + written:offset + written + take] = np.argmax(np.asarray(labels)[:take], axis=1)
+            written += take
+        return written
+    
+    def cache_features(self, cache_dir, variants=1):
+        """
+        Run the frozen backbone over the data once and store the pooled features
+        
+        Features go to memory-mapped .npy files in cache_dir: variants passes over
+        the (augmented) training set and one pass over the validation set. A cache
+        built for the same backbone, image size, sample counts and variants is
+        reused as is, so only the first run pays for the backbone.
+        
+        Args:
+            cache_dir: Directory for the cache files
+            variants: Number of augmented passes over the training set to store
+            
+        Returns:
+            (train_features, train_labels, val_features, val_labels) as memory-mapped arrays
+        """
+        import json
+        
+        if self.model is None:
+            self.build_model()
+        os.makedirs(cache_dir, exist_ok=True)
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        paths = {name: os.path.join(cache_dir, f"{name}.npy")
+                 for name in ('train_features', 'train_labels', 'val_features', 'val_labels')}
+        meta = {
+            'model_choice': self.model_choice,
+            'img_size': list(self.img_size),
+            'train_samples': self.train_samples,
+            'validation_samples': self.validation_samples,
+            'variants': variants,
+            'class_indices': self.class_indices
+        }
+        
+        try:
+            with open(meta_path) as f:
+                cached = json.load(f) == meta
+        except (OSError, ValueError):
+            cached = False
+        
+        if cached and all(os.path.exists(path) for path in paths.values()):
+            print(f"Using cached features from {cache_dir}")
+            return tuple(np.load(paths[name], mmap_mode='r')
+                         for name in ('train_features', 'train_labels', 'val_features', 'val_labels'))
+        
+        feature_dim = self.feature_extractor.output_shape[-1]
+        train_rows = self.train_samples * variants
+        train_features = np.lib.format.open_memmap(paths['train_features'], mode='w+', dtype=np.float32,
+                                                   shape=(train_rows, feature_dim))
+        train_labels = np.lib.format.open_memmap(paths['train_labels'], mode='w+', dtype=np.int32,
+                                                 shape=(train_rows,))
+        val_features = np.lib.format.open_memmap(paths['val_features'], mode='w+', dtype=np.float32,
+                                                 shape=(self.validation_samples, feature_dim))
+        val_labels = np.lib.format.open_memmap(paths['val_labels'], mode='w+', dtype=np.int32,
+                                               shape=(self.validation_samples,))
+        
+        for variant in range(variants):
+            print(f"Extracting training features (pass {variant + 1}/{variants})...")
+            self._extract_features(self.train_generator, self.train_samples, train_features, train_labels,
+                                   offset=variant * self.train_samples)
+        print("Extracting validation features...")
+        self._extract_features(self.validation_generator, self.validation_samples, val_features, val_labels)
+        
+        for array in (train_features, train_labels, val_features, val_labels):
+            array.flush()
+        # Written last, so an interrupted extraction is never mistaken for a complete cache
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        print(f"Cached {train_rows} training and {self.validation_samples} validation feature vectors in {cache_dir}")
+        return train_features, train_labels, val_features, val_labels
+    
+    def train_head_on_features(self, cache_dir, epochs=15, variants=1, callbacks=None):
+        """
+        Phase 1 on cached features: train only the classification head
+        
+        The head shares its layers with self.model, so afterwards the full model
+        carries the trained head, exactly as if phase 1 had run end to end.
+        
+        Returns:
+            Keras History of the head training
+        """
+        from keras.optimizers import Adam
+        
+        train_features, train_labels, val_features, val_labels = self.cache_features(cache_dir, variants)
+        num_classes = len(self.class_names)
+        
+        self.head_model.compile(
+            optimizer=Adam(learning_rate=0.001),
+            loss='categorical_crossentropy',
+            metrics=['accuracy'],
+            jit_compile=self.jit_compile
+        )
+        return self.head_model.fit(
+            np.asarray(train_features),
+            np.eye(num_classes, dtype=np.float32)[train_labels],
+            batch_size=self.batch_size,
+            validation_data=(np.asarray(val_features), np.eye(num_classes, dtype=np.float32)[val_labels]),
+            epochs=epochs,
+            shuffle=True,
+            callbacks=callbacks
+        )
+    
     def save_model(self, model_path='improved_parts_model.h5', class_map_path='improved_class_indices.pkl'):
         """
         Save the trained model and class indices
@@ -238,8 +692,9 @@ class ImprovedPartsClassifier:
             print("No model to save. Please train the model first.")
             return False
             
-        # Save model
-        self.model.save(model_path)
+        # Save model; a distilled student is saved without its training config,
+        # so loading it doesn't need the custom distillation loss
+        self.model.save(model_path, include_optimizer=self.distillation is None)
         
         # Save class indices
         with open(class_map_path, 'wb') as f:
@@ -249,14 +704,21 @@ class ImprovedPartsClassifier:
         print(f"Class indices saved to {class_map_path}")
         return True
     
-    def load_model(self, model_path='improved_parts_model.h5', class_map_path='improved_class_indices.pkl'):
+    def load_model(self, model_path='improved_parts_model.h5', class_map_path='improved_class_indices.pkl',
+                   backend='keras', num_threads=None):
         """
         Load a trained model and class indices
+        
+        Args:
+            model_path: Path to the model file (.h5 for keras, .tflite or .onnx for the others)
+            class_map_path: Path to the pickled class indices
+            backend: Inference backend to run the model with ('keras', 'tflite', 'onnx')
+            num_threads: Optional thread count for the tflite and onnx backends
         """
         # Load the model
         try:
-            self.model = tf.keras.models.load_model(model_path)
-            print(f"Model loaded from {model_path}")
+            self.load_backend(backend, model_path, num_threads)
+            print(f"Model loaded from {model_path} ({backend} backend)")
         except Exception as e:
             print(f"Error loading model: {e}")
             return False
@@ -275,40 +737,213 @@ class ImprovedPartsClassifier:
             
         return True
     
-    def predict(self, image_path):
+    def load_backend(self, backend, model_path, num_threads=None):
+        """
+        Load the model into a specific inference backend
+        
+        The Keras backend also sets self.model, so training-side methods keep working.
+        """
+        self.backend = load_backend(backend, model_path, num_threads,
+                                    precision=self.precision, jit_compile=self.jit_compile)
+        if isinstance(self.backend, KerasBackend):
+            self.model = self.backend.model
+            self.feature_extractor = None
+            self._joint_model = None
+        return self.backend
+    
+    def _embedding_models(self):
+        """
+        Models from the input to the pooled features, and to (features, probabilities)
+        
+        Built from the GlobalAveragePooling2D layer of self.model, so they work
+        the same for a freshly built model and one loaded from disk.
+        """
+        from tensorflow.keras.models import Model
+        from tensorflow.keras.layers import GlobalAveragePooling2D
+        
+        if self.model is None:
+            raise ValueError("Embeddings need a Keras model (train one, or load with the keras backend)")
+        if getattr(self, '_joint_model', None) is None:
+            pooling = [layer for layer in self.model.layers if isinstance(layer, GlobalAveragePooling2D)]
+            if not pooling:
+                raise ValueError("The model has no GlobalAveragePooling2D layer to take embeddings from")
+            features = pooling[-1].output
+            self.feature_extractor = Model(inputs=self.model.input, outputs=features)
+            self._joint_model = Model(inputs=self.model.input, outputs=[features, self.model.output])
+        return self.feature_extractor, self._joint_model
+    
+    @property
+    def embedding_dim(self):
+        """
+        Length of the embeddings embed_batch returns
+        """
+        feature_extractor, _ = self._embedding_models()
+        return int(feature_extractor.output_shape[-1])
+    
+    def embed_batch(self, images):
+        """
+        Pooled backbone features of a batch of preprocessed images
+        
+        Args:
+            images: Float32 array of shape (N, *img_size, 3)
+            
+        Returns:
+            Float32 array of shape (N, embedding_dim), L2-normalized
+        """
+        feature_extractor, _ = self._embedding_models()
+        return normalize(feature_extractor.predict_on_batch(images))
+    
+    def predict_with_embeddings(self, images):
+        """
+        Class probabilities and embeddings from a single forward pass
+        
+        Args:
+            images: Float32 array of shape (N, *img_size, 3)
+            
+        Returns:
+            (probabilities of shape (N, num_classes), L2-normalized embeddings of shape (N, embedding_dim))
+        """
+        _, joint_model = self._embedding_models()
+        embeddings, probabilities = joint_model.predict_on_batch(images)
+        return np.asarray(probabilities, dtype=np.float32), normalize(embeddings)
+    
+    def preprocess_image(self, image_path, out=None):
+        """
+        Load an image from disk as a normalized model input
+        
+        Args:
+            image_path: Path to the image file
+            out: Optional float32 array of shape (*img_size, 3) to write into,
+                 e.g. one row of a batch buffer
+            
+        Returns:
+            Float32 array of shape (*img_size, 3) scaled to [0, 1]
+        """
+        img = preprocessing.preprocess_file(image_path, self.img_size, out=out)
+        if img is None:
+            raise ValueError(f"Could not read image {image_path}")
+        return img
+    
+    def predict_batch(self, images):
+        """
+        Run a batch of preprocessed images through the model
+        
+        Args:
+            images: Float32 array of shape (N, *img_size, 3)
+            
+        Returns:
+            Array of shape (N, num_classes) with class probabilities
+        """
+        if self.backend is not None:
+            return self.backend.predict(images)
+        return np.asarray(self.model.predict_on_batch(images))
+    
+    def predict_batch_tta(self, images, views=DEFAULT_VIEWS, threshold=None):
+        """
+        Test-time augmentation: average the predictions for each image and its
+        flipped, cropped and rotated views
+        
+        Args:
+            images: Float32 array of shape (N, *img_size, 3)
+            views: Sequence of tta.View to average with the original
+            threshold: If set, run a plain first pass and only augment images
+                       whose top confidence is below it
+            
+        Returns:
+            Array of shape (N, num_classes) with class probabilities
+        """
+        if threshold is None:
+            # Originals and views go through the model together in a single forward pass
+            outputs = self.predict_batch(augment(images, views)).reshape(len(images), len(views) + 1, -1)
+            return outputs.mean(axis=1)
+        
+        probabilities = np.array(self.predict_batch(images), dtype=np.float32)
+        uncertain = np.flatnonzero(probabilities.max(axis=1) < threshold)
+        if len(uncertain):
+            view_outputs = self.predict_batch(augment(images[uncertain], views, include_original=False))
+            probabilities[uncertain] = average_views(probabilities[uncertain], view_outputs)
+        return probabilities
+    
+    def predict(self, image_path, tta=False, tta_threshold=None):
         """
         Predict the class of a single image
         
         Args:
             image_path: Path to the image file
+            tta: Average over augmented views of the image (see predict_batch_tta)
+            tta_threshold: With tta, only augment when the plain prediction's
+                           confidence is below this
             
         Returns:
             predicted_class: The predicted class name
             confidence: The confidence score for the prediction
         """
-        if self.model is None:
+        if self.model is None and self.backend is None:
             print("No model loaded. Please load or train a model first.")
             return None, 0
             
         # Load and preprocess the image
-        img = cv2.imread(image_path)
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)  # Convert BGR to RGB
-        img = cv2.resize(img, self.img_size)  # Resize to model input size
-        img = img / 255.0  # Normalize
+        img = self.preprocess_image(image_path)
         img = np.expand_dims(img, axis=0)  # Add batch dimension
         
         # Make prediction
-        predictions = self.model.predict(img)
-        pred_idx = np.argmax(predictions, axis=1)[0]
-        confidence = predictions[0][pred_idx]
-        
-        # Get the class name
-        if self.idx_to_class and pred_idx in self.idx_to_class:
-            predicted_class = self.idx_to_class[pred_idx]
+        if tta:
+            predictions = self.predict_batch_tta(img, threshold=tta_threshold)
         else:
-            predicted_class = f"Class {pred_idx}"
+            predictions = self.predict_batch(img)
+        return self.decode_predictions(predictions)[0]
+    
+    def detect(self, image_path, proposals='windows', min_confidence=0.5, iou_threshold=0.4, max_detections=20):
+        """
+        Find every part in a photo of a shelf or bin
+        
+        Candidate regions (sliding windows and/or contours, see detection.propose)
+        are classified in one batch and filtered by confidence and per-class
+        non-maximum suppression.
+        
+        Args:
+            image_path: Path to the image file
+            proposals: 'windows', 'contours' or 'both'
+            min_confidence: Lowest confidence reported
+            iou_threshold: Overlap above which a box of the same class is suppressed
+            max_detections: Report at most this many parts
             
-        return predicted_class, float(confidence)
+        Returns:
+            List of (predicted_class, confidence, (x0, y0, x1, y1)) tuples in the
+            original image's pixels, most confident first
+        """
+        with open(image_path, 'rb') as f:
+            contents = f.read()
+        image, scale = detection.decode_for_detection(contents, self.img_size)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        
+        boxes, probabilities, _ = detection.detect(
+            image, self.predict_batch, self.img_size, method=proposals,
+            min_confidence=min_confidence, iou_threshold=iou_threshold, max_detections=max_detections)
+        return [
+            (predicted_class, confidence, tuple(int(v) for v in box))
+            for (predicted_class, confidence), box in zip(self.decode_predictions(probabilities),
+                                                          detection.scale_boxes(boxes, scale))
+        ]
+    
+    def decode_predictions(self, predictions):
+        """
+        Map a batch of model outputs to class names and confidences
+        
+        Args:
+            predictions: Array of shape (N, num_classes) with class probabilities
+            
+        Returns:
+            List of (predicted_class, confidence) tuples
+        """
+        pred_indices = np.argmax(predictions, axis=1)
+        confidences = predictions[np.arange(len(pred_indices)), pred_indices]
+        idx_to_class = getattr(self, 'idx_to_class', None) or {}
+        return [
+            (idx_to_class.get(int(pred_idx), f"Class {pred_idx}"), float(confidence))
+            for pred_idx, confidence in zip(pred_indices, confidences)
+        ]
     
     def evaluate(self, test_dir=None):
         """
@@ -323,16 +958,43 @@ class ImprovedPartsClassifier:
         if self.model is None:
             print("No model loaded. Please load or train a model first.")
             return None
-            
+        
+        with self._multi_worker_keras():
+            return self._evaluate(test_dir)
+    
+    def _evaluate(self, test_dir):
         if test_dir is None:
             print("Evaluating on validation set...")
-            metrics = self.model.evaluate(
-                self.validation_generator,
-                steps=self.validation_generator.samples // self.batch_size + 1
-            )
+            if self.num_workers > 1:
+                # The shards repeat, so every worker runs the same fixed number of steps
+                metrics = self.model.evaluate(self.validation_generator, steps=self.validation_steps)
+            elif hasattr(self.validation_generator, 'reset'):
+                # Start from the first image, then stop after exactly one pass
+                # (the last batch is partial rather than wrapping around)
+                self.validation_generator.reset()
+                metrics = self.model.evaluate(
+                    self.validation_generator,
+                    steps=math.ceil(self.validation_samples / self.batch_size)
+                )
+            else:
+                # tf.data datasets end after one pass
+                metrics = self.model.evaluate(self.validation_generator)
+            return {'loss': metrics[0], 'accuracy': metrics[1]}
+        
+        from pack_dataset import is_packed, read_index
+        
+        if is_packed(test_dir):
+            # A packed test set is evaluated over all of its shards
+            from data_pipeline import make_packed_dataset
+            
+            print(f"Evaluating on packed test set {test_dir}...")
+            index = read_index(test_dir)
+            metrics = self.model.evaluate(make_packed_dataset(test_dir, index, ('train', 'val'), self.batch_size))
             return {'loss': metrics[0], 'accuracy': metrics[1]}
         
         # If test_dir is provided, create a test generator and evaluate
+        from tensorflow.keras.preprocessing.image import ImageDataGenerator
+        
         print(f"Evaluating on test set {test_dir}...")
         test_datagen = ImageDataGenerator(rescale=1./255)
         test_generator = test_datagen.flow_from_directory(
@@ -345,11 +1007,115 @@ class ImprovedPartsClassifier:
         
         metrics = self.model.evaluate(
             test_generator,
-            steps=test_generator.samples // self.batch_size + 1
+            steps=math.ceil(test_generator.samples / self.batch_size)
         )
         
         return {'loss': metrics[0], 'accuracy': metrics[1]}
     
+    def _labelled_batches(self, test_dir, batch_size, num_workers):
+        """
+        Yield (images, labels) batches covering every image of an evaluation set exactly once
+        
+        test_dir may be class folders or a packed dataset; None means the
+        validation split of data_dir. Labels are mapped onto this model's class
+        indices by class name, and images of classes the model doesn't know are
+        skipped.
+        """
+        from pack_dataset import is_packed, read_index, iter_packed_chunks, list_class_files
+        
+        source = test_dir if test_dir is not None else self.data_dir
+        if source is None:
+            raise ValueError("No test_dir given and no data loaded to take a validation split from")
+        num_classes = max(self.class_indices.values()) + 1
+        buffers = [preprocessing.allocate_batch(batch_size, self.img_size) for _ in range(2)]
+        
+        if is_packed(source):
+            index = read_index(source)
+            splits = ('val',) if test_dir is None else ('train', 'val')
+            names = sorted(index['class_indices'], key=index['class_indices'].get)
+            to_model = np.array([self.class_indices.get(name, -1) for name in names])
+            shards = [shard for split in splits for shard in index['splits'].get(split, [])]
+            for images, labels in iter_packed_chunks(source, shards, chunk_size=batch_size):
+                labels = to_model[labels]
+                known = labels >= 0
+                batch = buffers[0][:int(known.sum())]
+                np.multiply(images[known], preprocessing.SCALE, out=batch, dtype=np.float32)
+                yield batch, labels[known]
+            return
+        
+        validation_split = getattr(self, 'validation_split', 0.0) if test_dir is None else 0.0
+        folder_indices, train_files, train_labels, val_files, val_labels = list_class_files(source, validation_split)
+        files, labels = (val_files, val_labels) if test_dir is None else (train_files, train_labels)
+        names = sorted(folder_indices, key=folder_indices.get)
+        to_model = np.array([self.class_indices.get(name, -1) for name in names])
+        labels = to_model[np.asarray(labels, dtype=np.int64)] if labels else np.empty(0, dtype=np.int64)
+        known = [(path, label) for path, label in zip(files, labels) if label >= 0]
+        
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            def submit(chunk_index):
+                start = chunk_index * batch_size
+                buffer = buffers[chunk_index % 2]
+                return [(label, executor.submit(self.preprocess_image, path, buffer[row]))
+                        for row, (path, label) in enumerate(known[start:start + batch_size])]
+            
+            num_chunks = math.ceil(len(known) / batch_size)
+            pending = submit(0) if num_chunks else None
+            for chunk_index in range(num_chunks):
+                current = pending
+                # Decode the next chunk into the other buffer while this one is predicted
+                pending = submit(chunk_index + 1) if chunk_index + 1 < num_chunks else None
+                buffer = buffers[chunk_index % 2]
+                batch_labels = []
+                for row, (label, future) in enumerate(current):
+                    try:
+                        future.result()
+                    except Exception as e:
+                        print(f"Skipping unreadable image: {e}")
+                        continue
+                    if row != len(batch_labels):
+                        buffer[len(batch_labels)] = buffer[row]
+                    batch_labels.append(label)
+                yield buffer[:len(batch_labels)], np.asarray(batch_labels, dtype=np.int64)
+    
+    def evaluate_detailed(self, test_dir=None, batch_size=64, top_k=(1, 3, 5), num_workers=4, report_path=None):
+        """
+        Evaluate with a confusion matrix, per-class precision/recall/F1 and top-k accuracy
+        
+        The evaluation set is streamed once, in batches of batch_size, through
+        predict_batch, so it works with every inference backend. Every image is
+        counted exactly once.
+        
+        Args:
+            test_dir: Class folders or packed dataset to evaluate on; None for the
+                      validation split of the loaded data
+            batch_size: Images per forward pass
+            top_k: Values of k to report top-k accuracy for
+            num_workers: Threads decoding images
+            report_path: Optional JSON file to write the report to
+            
+        Returns:
+            Report dictionary (see evaluation.EvaluationAccumulator.report)
+        """
+        from evaluation import EvaluationAccumulator, write_report
+        
+        if self.model is None and self.backend is None:
+            print("No model loaded. Please load or train a model first.")
+            return None
+        
+        num_classes = max(self.class_indices.values()) + 1
+        accumulator = EvaluationAccumulator(num_classes, top_k)
+        print(f"Evaluating on {test_dir or 'the validation split'}...")
+        for images, labels in self._labelled_batches(test_dir, batch_size, num_workers):
+            if len(labels):
+                accumulator.update(self.predict_batch(images), labels)
+        
+        idx_to_class = getattr(self, 'idx_to_class', None) or {}
+        class_names = [idx_to_class.get(i, f"Class {i}") for i in range(num_classes)]
+        report = accumulator.report(class_names)
+        if report_path:
+            write_report(report, report_path)
+        return report
+    
     def visualize_predictions(self, num_images=10):
         """
         Visualize model predictions on random validation images
@@ -357,12 +1123,16 @@ class ImprovedPartsClassifier:
         Args:
             num_images: Number of images to visualize
         """
+        import matplotlib.pyplot as plt
+        
         if self.model is None or self.validation_generator is None:
             print("Model or validation data not available.")
             return
             
         # Get some validation images
-        validation_images, validation_labels = next(self.validation_generator)
+        validation_images, validation_labels = next(iter(self.validation_generator))
+        validation_images = np.asarray(validation_images)
+        validation_labels = np.asarray(validation_labels)
         
         # Limit to the number of images requested
         num_to_display = min(num_images, len(validation_images))
@@ -3,9 +3,14 @@ import argparse
 import cv2
 import matplotlib.pyplot as plt
 import numpy as np
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
 from improved_parts_classifier import ImprovedPartsClassifier
 from pathlib import Path
-import glob
+import preprocessing
+from visualization import VisualizationRenderer
+from classification_jobs import (iter_image_paths, read_manifest, write_manifest, in_shard,
+                                 shard_output_path, open_writer, merge_outputs)
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Predict spare part class from image(s)')
@@ -14,15 +19,76 @@ def parse_args():
                         help='Path to a single image file to classify')
     group.add_argument('--image_dir', type=str,
                         help='Path to a directory of images to classify')
+    group.add_argument('--manifest', type=str,
+                        help='Text file listing image paths to classify, one per line (resumable job)')
+    group.add_argument('--merge', type=str, nargs='+',
+                        help='Shard outputs to merge into --output instead of predicting')
     parser.add_argument('--model_path', type=str, default='improved_parts_model.h5',
                         help='Path to the trained model')
     parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
                         help='Path to the class indices file')
+    parser.add_argument('--backend', type=str, default='keras', choices=['keras', 'savedmodel', 'tflite', 'onnx'],
+                        help='Inference backend to run the model with')
+    parser.add_argument('--num_threads', type=int, default=None,
+                        help='Thread count for the tflite and onnx backends')
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'mixed_bfloat16'],
+                        help='Compute dtype policy for the keras backend')
+    parser.add_argument('--jit_compile', action='store_true',
+                        help='XLA-compile the forward pass (keras backend)')
     parser.add_argument('--img_size', type=int, default=224,
                         help='Image size for model input')
     parser.add_argument('--save_visualizations', action='store_true',
                         help='Save visualization images with predictions')
-    return parser.parse_args()
+    parser.add_argument('--visualization_workers', type=int, default=2,
+                        help='Background threads rendering visualizations for --image_dir/--manifest')
+    parser.add_argument('--max_visualizations', type=int, default=None,
+                        help='Stop saving visualizations after this many images')
+    parser.add_argument('--visualize_every', type=int, default=1,
+                        help='Only save a visualization for every n-th image')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Images per forward pass when predicting a directory')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Threads decoding images in parallel when predicting a directory')
+    parser.add_argument('--tta', action='store_true',
+                        help='Test-time augmentation: average predictions over flipped, cropped and rotated views')
+    parser.add_argument('--tta_threshold', type=float, default=None,
+                        help='With --tta, only augment images whose plain confidence is below this')
+    parser.add_argument('--detect', action='store_true',
+                        help='With --image_path: find every part in the photo and report boxes')
+    parser.add_argument('--proposals', type=str, default='windows', choices=['windows', 'contours', 'both'],
+                        help='With --detect: sliding windows, contours of the parts, or both')
+    parser.add_argument('--min_confidence', type=float, default=0.5,
+                        help='With --detect: lowest confidence reported')
+    parser.add_argument('--iou_threshold', type=float, default=0.4,
+                        help='With --detect: overlap above which a box of the same class is suppressed')
+    parser.add_argument('--no_recursive', action='store_true',
+                        help='Only predict images directly inside --image_dir, not in subdirectories')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Where results are written as they are produced: a .jsonl file, '
+                             'or a directory ending in .parquet for Parquet part files')
+    parser.add_argument('--parquet_flush_rows', type=int, default=256,
+                        help='With a .parquet --output: results per part file, i.e. the most a crash can lose')
+    parser.add_argument('--write_manifest', type=str, default=None,
+                        help='With --image_dir: only list its images into this manifest file and exit')
+    parser.add_argument('--num_shards', type=int, default=1,
+                        help='With --manifest: number of shards the job is split into')
+    parser.add_argument('--shard_index', type=int, default=0,
+                        help='With --manifest: which shard this process classifies (0-based)')
+    args = parser.parse_args()
+    
+    if args.manifest and not args.output:
+        parser.error('--manifest needs --output to record (and resume) results')
+    if args.merge and not args.output:
+        parser.error('--merge needs --output for the merged results')
+    if args.write_manifest and not args.image_dir:
+        parser.error('--write_manifest needs --image_dir')
+    if args.detect and not args.image_path:
+        parser.error('--detect needs --image_path')
+    if args.tta_threshold is not None and not args.tta:
+        parser.error('--tta_threshold needs --tta')
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard_index must be in [0, --num_shards)')
+    return args
 
 def display_prediction(image_path, predicted_class, confidence, save_dir=None):
     """
@@ -57,7 +123,7 @@ def display_prediction(image_path, predicted_class, confidence, save_dir=None):
         plt.show()
         plt.close()
 
-def predict_single_image(classifier, image_path, save_dir=None):
+def predict_single_image(classifier, image_path, save_dir=None, tta=False, tta_threshold=None):
     """
     Make prediction on a single image
     
@@ -65,8 +131,10 @@ def predict_single_image(classifier, image_path, save_dir=None):
         classifier: Trained classifier
         image_path: Path to the image file
         save_dir: Directory to save visualization (if None, don't save)
+        tta: Average over augmented views of the image
+        tta_threshold: With tta, only augment when the plain confidence is below this
     """
-    predicted_class, confidence = classifier.predict(image_path)
+    predicted_class, confidence = classifier.predict(image_path, tta=tta, tta_threshold=tta_threshold)
     
     print(f"Image: {os.path.basename(image_path)}")
     print(f"Predicted class: {predicted_class}")
@@ -78,71 +146,283 @@ def predict_single_image(classifier, image_path, save_dir=None):
     
     return predicted_class, confidence
 
-def predict_directory(classifier, image_dir, save_dir=None):
+def detect_single_image(classifier, image_path, save_dir=None, proposals='windows', min_confidence=0.5,
+                        iou_threshold=0.4):
     """
-    Make predictions on all images in a directory
+    Find and classify every part in a single image
     
     Args:
         classifier: Trained classifier
-        image_dir: Path to the directory containing images
-        save_dir: Directory to save visualizations (if None, don't save)
+        image_path: Path to the image file
+        save_dir: Directory to save the image with its boxes drawn (if None, don't save)
+        proposals: 'windows', 'contours' or 'both'
+        min_confidence: Lowest confidence reported
+        iou_threshold: Overlap above which a box of the same class is suppressed
+    
+    Returns:
+        List of (predicted_class, confidence, box) tuples
     """
-    image_extensions = ['*.jpg', '*.jpeg', '*.png', '*.JPG', '*.JPEG', '*.PNG']
-    image_paths = []
+    detections = classifier.detect(image_path, proposals=proposals, min_confidence=min_confidence,
+                                   iou_threshold=iou_threshold)
     
-    # Get all image files
-    for ext in image_extensions:
-        image_paths.extend(glob.glob(os.path.join(image_dir, ext)))
+    print(f"Image: {os.path.basename(image_path)}")
+    print(f"Parts found: {len(detections)}")
+    for predicted_class, confidence, box in detections:
+        print(f"  {predicted_class}: {confidence:.2%} at {box}")
+    print("-" * 50)
     
-    if not image_paths:
-        print(f"No images found in {image_dir}")
-        return
+    if save_dir:
+        img = cv2.imread(image_path)
+        for predicted_class, confidence, (x0, y0, x1, y1) in detections:
+            cv2.rectangle(img, (x0, y0), (x1, y1), (0, 200, 0), 2)
+            cv2.putText(img, f"{predicted_class} {confidence:.0%}", (x0 + 4, max(y0 - 6, 14)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 200, 0), 1, cv2.LINE_AA)
+        output_dir = Path(save_dir)
+        output_dir.mkdir(exist_ok=True)
+        output_path = output_dir / f"detect_{Path(image_path).stem}.png"
+        cv2.imwrite(str(output_path), img)
+        print(f"Visualization saved to {output_path}")
+    
+    return detections
+
+def predict_paths(classifier, paths, renderer=None, batch_size=32, num_workers=4, writer=None,
+                  display_root=None, tta=False, tta_threshold=None):
+    """
+    Make predictions on a stream of image paths
+    
+    Images are decoded on a pool of worker threads straight into one of two
+    alternating batch buffers, so the next batch is decoding while the current
+    one runs through the model. Results are printed (and handed to writer)
+    batch by batch as they finish. With a renderer, the decoded images are kept
+    until their predictions are known and then passed on for drawing, so
+    visualizations never re-read the file or hold up the next batch.
+    
+    Args:
+        classifier: Trained classifier
+        paths: Iterable of image paths
+        renderer: Optional VisualizationRenderer to hand predictions to
+        batch_size: Number of images per forward pass
+        num_workers: Number of decoding threads
+        writer: Optional result writer from classification_jobs; gets one record
+                per image, including images that failed to decode
+        display_root: Directory printed image paths are shown relative to
+        tta: Average each image's predictions over augmented views of it
+        tta_threshold: With tta, only augment images whose plain confidence is below this
+    
+    Returns:
+        Dictionary with the number of images predicted, errors and per-class counts
+    """
+    paths = iter(paths)
+    # Double buffering: item k is decoded into row k % batch_size of buffer (k // batch_size) % 2
+    buffers = [preprocessing.allocate_batch(batch_size, classifier.img_size) for _ in range(2)]
+    pending = deque()
+    submitted = 0
     
-    print(f"Found {len(image_paths)} images to predict")
-    
-    # Process each image
-    results = []
-    for image_path in image_paths:
-        try:
-            predicted_class, confidence = predict_single_image(classifier, image_path, save_dir)
-            results.append({
-                'image': os.path.basename(image_path),
-                'prediction': predicted_class,
-                'confidence': confidence
-            })
-        except Exception as e:
-            print(f"Error processing {image_path}: {e}")
-    
-    # Calculate statistics
-    if results:
-        class_counts = {}
-        for result in results:
-            pred = result['prediction']
-            if pred in class_counts:
-                class_counts[pred] += 1
-            else:
-                class_counts[pred] = 1
+    class_counts = Counter()
+    total = 0
+    errors = 0
+    
+    def decode_for_renderer(image_path, out):
+        image = preprocessing.load_image(image_path, classifier.img_size)
+        if image is None:
+            raise ValueError(f"Failed to load image: {image_path}")
+        preprocessing.preprocess_into(image, out)
+        return image
+    
+    decode = classifier.preprocess_image if renderer is None else decode_for_renderer
+    
+    def submit_batch(executor):
+        nonlocal submitted
+        buffer = buffers[(submitted // batch_size) % 2]
+        for row in range(batch_size):
+            image_path = next(paths, None)
+            if image_path is None:
+                return
+            pending.append((image_path, row, executor.submit(decode, image_path, buffer[row])))
+            submitted += 1
+    
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        # Keep two batches in flight: one being predicted, the next one decoding
+        submit_batch(executor)
+        submit_batch(executor)
+        batch_number = 0
         
+        while pending:
+            buffer = buffers[batch_number % 2]
+            batch_paths = []
+            batch_images = []
+            records = []
+            for _ in range(min(batch_size, len(pending))):
+                image_path, row, future = pending.popleft()
+                try:
+                    decoded = future.result()
+                except Exception as e:
+                    print(f"Error processing {image_path}: {e}")
+                    errors += 1
+                    records.append({'image': image_path, 'error': str(e)})
+                    continue
+                # Compact successfully decoded rows to the front of the buffer
+                if row != len(batch_paths):
+                    buffer[len(batch_paths)] = buffer[row]
+                batch_paths.append(image_path)
+                batch_images.append(decoded)
+            
+            if batch_paths:
+                if tta:
+                    predictions = classifier.predict_batch_tta(buffer[:len(batch_paths)], threshold=tta_threshold)
+                else:
+                    predictions = classifier.predict_batch(buffer[:len(batch_paths)])
+                results = zip(batch_paths, batch_images, classifier.decode_predictions(predictions))
+                for image_path, decoded, (predicted_class, confidence) in results:
+                    shown_path = os.path.relpath(image_path, display_root) if display_root else image_path
+                    print(f"Image: {shown_path}")
+                    print(f"Predicted class: {predicted_class}")
+                    print(f"Confidence: {confidence:.2%}")
+                    print("-" * 50)
+                    
+                    class_counts[predicted_class] += 1
+                    total += 1
+                    records.append({
+                        'image': image_path,
+                        'prediction': predicted_class,
+                        'confidence': confidence
+                    })
+                    if renderer is not None and renderer.wants():
+                        renderer.submit(image_path, decoded, predicted_class, confidence)
+            
+            if writer is not None and records:
+                writer.write(records)
+            
+            # This buffer is free again: start decoding the batch after next into it
+            batch_number += 1
+            submit_batch(executor)
+    
+    if total:
         print("\nSummary of predictions:")
-        for cls, count in sorted(class_counts.items(), key=lambda x: x[1], reverse=True):
-            print(f"{cls}: {count} images ({count/len(results):.1%})")
+        for cls, count in class_counts.most_common():
+            print(f"{cls}: {count} images ({count/total:.1%})")
+    
+    return {'total': total, 'errors': errors, 'class_counts': dict(class_counts)}
+
+def predict_directory(classifier, image_dir, renderer=None, batch_size=32, num_workers=4,
+                      recursive=True, output_path=None, tta=False, tta_threshold=None, flush_rows=256):
+    """
+    Make predictions on all images in a directory (see predict_paths)
+    
+    Args:
+        classifier: Trained classifier
+        image_dir: Path to the directory containing images
+        renderer: Optional VisualizationRenderer to hand predictions to
+        batch_size: Number of images per forward pass
+        num_workers: Number of decoding threads
+        recursive: Whether to include images in subdirectories
+        output_path: Optional .jsonl file or .parquet directory to write results to
+        tta: Average each image's predictions over augmented views of it
+        tta_threshold: With tta, only augment images whose plain confidence is below this
+        flush_rows: Results per Parquet part file
+    
+    Returns:
+        Dictionary with the number of images predicted, errors and per-class counts
+    """
+    paths = iter_image_paths(image_dir, recursive=recursive)
+    writer = open_writer(output_path, rows_per_file=flush_rows) if output_path else None
+    try:
+        stats = predict_paths(classifier, paths, renderer, batch_size, num_workers, writer, display_root=image_dir,
+                              tta=tta, tta_threshold=tta_threshold)
+    finally:
+        if writer is not None:
+            writer.close()
+    
+    if stats['total'] == 0 and stats['errors'] == 0:
+        print(f"No images found in {image_dir}")
+        return None
+    return stats
+
+def run_job(classifier, paths, output_path, num_shards=1, shard_index=0, renderer=None, batch_size=32,
+            num_workers=4, tta=False, tta_threshold=None, flush_rows=256):
+    """
+    Classify one shard of a path list, resuming from whatever is already in the output
+    
+    Images are assigned to shards by a hash of their path, so separate processes
+    (or machines) given the same manifest and num_shards split it without
+    coordinating. Every result is committed to the shard's output before the
+    next batch starts, and a rerun skips the images already recorded there, so
+    an interrupted job picks up where it stopped.
+    
+    Args:
+        classifier: Trained classifier
+        paths: Iterable of image paths (e.g. from read_manifest)
+        output_path: Base .jsonl file or .parquet directory; suffixed per shard when num_shards > 1
+        num_shards: Total number of shards the paths are split into
+        shard_index: Which shard this process handles (0-based)
+        renderer: Optional VisualizationRenderer to hand predictions to
+        batch_size: Number of images per forward pass
+        num_workers: Number of decoding threads
+        tta: Average each image's predictions over augmented views of it
+        tta_threshold: With tta, only augment images whose plain confidence is below this
+        flush_rows: Results per Parquet part file
+    
+    Returns:
+        Dictionary with the number of images predicted, errors, per-class counts,
+        the number of images skipped as already done, and the shard output path
+    """
+    shard_path = shard_output_path(output_path, num_shards, shard_index)
+    writer = open_writer(shard_path, rows_per_file=flush_rows)
+    done = writer.done_paths()
+    if done:
+        print(f"Resuming: {len(done)} images already in {shard_path}")
+    
+    skipped = 0
+    def remaining():
+        nonlocal skipped
+        for image_path in paths:
+            if num_shards > 1 and not in_shard(image_path, num_shards, shard_index):
+                continue
+            if image_path in done:
+                skipped += 1
+                continue
+            yield image_path
     
-    return results
+    try:
+        stats = predict_paths(classifier, remaining(), renderer, batch_size, num_workers, writer,
+                              tta=tta, tta_threshold=tta_threshold)
+    finally:
+        writer.close()
+    
+    stats['skipped'] = skipped
+    stats['output'] = shard_path
+    print(f"Shard {shard_index + 1}/{num_shards}: {stats['total']} predicted, "
+          f"{stats['errors']} errors, {skipped} already done -> {shard_path}")
+    return stats
 
 def main():
     # Parse command-line arguments
     args = parse_args()
     
+    # Modes that don't need the model
+    if args.write_manifest:
+        count = write_manifest(args.image_dir, args.write_manifest, recursive=not args.no_recursive)
+        print(f"Wrote {count} image paths to {args.write_manifest}")
+        return
+    if args.merge:
+        count = merge_outputs(args.merge, args.output)
+        print(f"Merged {count} results into {args.output}")
+        return
+    
     # Create the classifier
     classifier = ImprovedPartsClassifier(
         data_dir=None,  # Not needed for prediction
-        img_size=(args.img_size, args.img_size)
+        img_size=(args.img_size, args.img_size),
+        precision=args.precision,
+        jit_compile=args.jit_compile
     )
     
     # Load the trained model
     loaded = classifier.load_model(
         model_path=args.model_path,
-        class_map_path=args.class_map_path
+        class_map_path=args.class_map_path,
+        backend=args.backend,
+        num_threads=args.num_threads
     )
     
     if not loaded:
@@ -155,12 +435,59 @@ def main():
         save_dir = "improved_predictions"
     
     # Make predictions
+    if args.image_path and args.detect:
+        # Every part in a single image
+        detect_single_image(classifier, args.image_path, save_dir, proposals=args.proposals,
+                            min_confidence=args.min_confidence, iou_threshold=args.iou_threshold)
+        return
     if args.image_path:
         # Single image prediction
-        predict_single_image(classifier, args.image_path, save_dir)
-    else:
-        # Directory prediction
-        predict_directory(classifier, args.image_dir, save_dir)
+        predict_single_image(classifier, args.image_path, save_dir, tta=args.tta, tta_threshold=args.tta_threshold)
+        return
+    
+    # Directory and manifest predictions render visualizations in the background
+    renderer = None
+    if save_dir:
+        renderer = VisualizationRenderer(
+            save_dir,
+            num_workers=args.visualization_workers,
+            max_images=args.max_visualizations,
+            every=args.visualize_every
+        )
+    
+    try:
+        if args.manifest:
+            # Resumable (optionally sharded) job over a manifest
+            run_job(
+                classifier,
+                read_manifest(args.manifest),
+                args.output,
+                num_shards=args.num_shards,
+                shard_index=args.shard_index,
+                renderer=renderer,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                tta=args.tta,
+                tta_threshold=args.tta_threshold,
+                flush_rows=args.parquet_flush_rows
+            )
+        else:
+            # Directory prediction
+            predict_directory(
+                classifier,
+                args.image_dir,
+                renderer,
+                batch_size=args.batch_size,
+                num_workers=args.num_workers,
+                recursive=not args.no_recursive,
+                output_path=args.output,
+                tta=args.tta,
+                tta_threshold=args.tta_threshold,
+                flush_rows=args.parquet_flush_rows
+            )
+    finally:
+        if renderer is not None:
+            renderer.close()
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -1,12 +1,19 @@
 import os
+import sys
+import json
+import time
+import socket
 import argparse
+import subprocess
+import numpy as np
 from improved_parts_classifier import ImprovedPartsClassifier
+from evaluation import print_report
 import matplotlib.pyplot as plt
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Train an improved spare parts classifier')
     parser.add_argument('--data_dir', type=str, default='parts_images',
-                        help='Directory containing class folders with images')
+                        help='Directory containing class folders with images, or a dataset packed by pack_dataset.py')
     parser.add_argument('--img_size', type=int, default=224,
                         help='Image size for model input')
     parser.add_argument('--batch_size', type=int, default=16,
@@ -16,15 +23,194 @@ def parse_args():
     parser.add_argument('--fine_tune_epochs', type=int, default=15,
                         help='Number of fine-tuning epochs')
     parser.add_argument('--model_choice', type=str, default='resnet', 
-                        choices=['resnet', 'efficientnet'],
-                        help='Base model to use (resnet, efficientnet)')
+                        choices=['resnet', 'efficientnet', 'mobilenet'],
+                        help='Base model to use (resnet, efficientnet, or mobilenet for a fast cascade tier)')
     parser.add_argument('--model_path', type=str, default='improved_parts_model.h5',
                         help='Path to save the trained model')
     parser.add_argument('--validation_split', type=float, default=0.2,
                         help='Validation split ratio (0-1)')
     parser.add_argument('--visualize', action='store_true',
                         help='Visualize predictions after training')
-    return parser.parse_args()
+    parser.add_argument('--loader', type=str, default='generator', choices=['generator', 'tfdata'],
+                        help='Input pipeline: ImageDataGenerator (generator) or parallel tf.data (tfdata)')
+    parser.add_argument('--cache', type=str, default=None,
+                        help="With --loader tfdata: cache decoded images in 'memory' or at this file path prefix")
+    parser.add_argument('--precision', type=str, default='float32', choices=['float32', 'mixed_bfloat16'],
+                        help='Compute dtype policy (mixed_bfloat16 needs a CPU with bfloat16 support to pay off)')
+    parser.add_argument('--jit_compile', action='store_true',
+                        help='XLA-compile the training and evaluation steps')
+    parser.add_argument('--eval_report', type=str, default=None,
+                        help='After training, write a per-class evaluation report of the validation split to this JSON file')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Train data-parallel across this many local worker processes '
+                             '(MultiWorkerMirroredStrategy); --batch_size is per worker')
+    parser.add_argument('--worker_index', type=int, default=None,
+                        help=argparse.SUPPRESS)  # Set by the --workers launcher for each worker
+    parser.add_argument('--worker_summary', type=str, default=None,
+                        help='Path prefix: every worker writes its final metrics and a weights fingerprint to '
+                             'PREFIX.worker-N.json, to check that the workers stayed in sync')
+    parser.add_argument('--weights', type=str, default='imagenet', choices=['imagenet', 'none'],
+                        help="Initial backbone weights ('none' starts from random weights and needs no download)")
+    parser.add_argument('--feature_cache', type=str, default=None,
+                        help='Directory to cache frozen-backbone features in; phase 1 then trains only the head on them')
+    parser.add_argument('--feature_variants', type=int, default=1,
+                        help='With --feature_cache: augmented passes over the training set to cache')
+    parser.add_argument('--head_units', type=int, nargs='+', default=[1024, 512],
+                        help='Sizes of the Dense layers in the classification head (e.g. 256 for a small student)')
+    parser.add_argument('--distill_from', type=str, default=None,
+                        help='Train as a student of this trained teacher model, on its cached soft targets')
+    parser.add_argument('--teacher_class_map', type=str, default='improved_class_indices.pkl',
+                        help="With --distill_from: the teacher's class indices file")
+    parser.add_argument('--temperature', type=float, default=4.0,
+                        help='With --distill_from: softening temperature of the teacher and student outputs')
+    parser.add_argument('--alpha', type=float, default=0.7,
+                        help="With --distill_from: weight of the teacher's soft targets against the true labels")
+    parser.add_argument('--soft_target_cache', type=str, default='soft_target_cache',
+                        help="With --distill_from: directory to cache the teacher's outputs in")
+    parser.add_argument('--distill_report', type=str, default=None,
+                        help='With --distill_from: after training, compare teacher and student and write a JSON report')
+    args = parser.parse_args()
+    
+    if args.workers > 1 and args.feature_cache:
+        parser.error('--feature_cache trains the head in a single process; drop it or --workers')
+    if args.distill_from and args.feature_cache:
+        parser.error('--feature_cache trains on hard labels only; it can\'t be combined with --distill_from')
+    return args
+
+def free_ports(count):
+    """
+    Ask the OS for count currently unused localhost ports
+    """
+    sockets = []
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('localhost', 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+def launch_workers(num_workers, command=None):
+    """
+    Re-run this script as num_workers local processes forming one TensorFlow cluster
+    
+    Each worker gets a TF_CONFIG naming the whole cluster and its own index, and
+    an even share of the CPU cores for its intra-op thread pool. If any worker
+    fails, the others are stopped, since they would otherwise block in the
+    next all-reduce.
+    
+    Args:
+        num_workers: Number of worker processes
+        command: Worker command line, to which '--worker_index N' is appended
+                 (default: this script with the current arguments)
+    
+    Returns:
+        Exit code (0 if every worker succeeded)
+    """
+    if command is None:
+        command = [sys.executable, os.path.abspath(__file__), *sys.argv[1:]]
+    cluster = {'worker': [f'localhost:{port}' for port in free_ports(num_workers)]}
+    threads_per_worker = max(1, (os.cpu_count() or 1) // num_workers)
+    
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ)
+        env['TF_CONFIG'] = json.dumps({'cluster': cluster, 'task': {'type': 'worker', 'index': index}})
+        env.setdefault('TF_NUM_INTRAOP_THREADS', str(threads_per_worker))
+        processes.append(subprocess.Popen([*command, '--worker_index', str(index)], env=env))
+    print(f"Started {num_workers} workers on {', '.join(cluster['worker'])}")
+    
+    exit_code = 0
+    remaining = list(processes)
+    while remaining:
+        for process in list(remaining):
+            code = process.poll()
+            if code is None:
+                continue
+            remaining.remove(process)
+            if code != 0 and exit_code == 0:
+                exit_code = code
+                print(f"Worker {processes.index(process)} exited with code {code}; stopping the others")
+                for other in remaining:
+                    other.terminate()
+        time.sleep(0.5)
+    return exit_code
+
+def weights_fingerprint(model):
+    """
+    Sum of absolute values of every weight tensor: cheap to compare across workers
+    """
+    return [float(np.abs(weights).astype(np.float64).sum()) for weights in model.get_weights()]
+
+def write_worker_summary(classifier, metrics, prefix):
+    path = f"{prefix}.worker-{classifier.worker_index}.json"
+    with open(path, 'w') as f:
+        json.dump({
+            'worker_index': classifier.worker_index,
+            'num_workers': classifier.num_workers,
+            'metrics': {name: float(value) for name, value in metrics.items()},
+            'weights_fingerprint': weights_fingerprint(classifier.model)
+        }, f, indent=2)
+    print(f"Worker summary written to {path}")
+
+def cache_soft_targets(args):
+    """
+    Compute the teacher's soft targets before the workers start, so they all
+    read them from the cache instead of each running the teacher
+    """
+    from pack_dataset import list_class_files
+    from distillation import load_soft_targets
+    
+    class_indices, train_files, _, val_files, _ = list_class_files(args.data_dir, args.validation_split)
+    load_soft_targets(args.distill_from, args.teacher_class_map, train_files + val_files, class_indices,
+                      (args.img_size, args.img_size), cache_dir=args.soft_target_cache)
+
+def compare_with_teacher(classifier, args):
+    """
+    Side-by-side size, latency and accuracy of the teacher and the freshly saved student
+    """
+    from distillation_report import load_labelled_images, compare_models, print_comparison, write_comparison
+    
+    teacher = ImprovedPartsClassifier(data_dir=None, img_size=classifier.img_size)
+    student = ImprovedPartsClassifier(data_dir=None, img_size=classifier.img_size)
+    if not teacher.load_model(model_path=args.distill_from, class_map_path=args.teacher_class_map):
+        print("Could not load the teacher; skipping the distillation report")
+        return
+    student.load_model(model_path=args.model_path)
+    images, class_names = load_labelled_images(student, args.data_dir, args.validation_split, max_images=1000)
+    report = compare_models(teacher, args.distill_from, student, args.model_path, images, class_names)
+    print_comparison(report)
+    write_comparison(report, args.distill_report)
+
+def make_epoch_timer():
+    """
+    Keras callback recording the wall-clock time of every epoch (in its .times list)
+    """
+    from tensorflow.keras.callbacks import Callback
+    
+    class EpochTimer(Callback):
+        def __init__(self):
+            super().__init__()
+            self.times = []
+        
+        def on_epoch_begin(self, epoch, logs=None):
+            self._start = time.perf_counter()
+        
+        def on_epoch_end(self, epoch, logs=None):
+            self.times.append(time.perf_counter() - self._start)
+    
+    return EpochTimer()
+
+def print_epoch_times(times, loader):
+    if not times:
+        return
+    print(f"Epoch times with the {loader} loader:")
+    for epoch, seconds in enumerate(times, 1):
+        print(f"  epoch {epoch}: {seconds:.1f}s")
+    # The first epoch includes tracing (and filling the cache), so report the rest separately
+    steady = times[1:] or times
+    print(f"  first epoch {times[0]:.1f}s, mean of the rest {sum(steady) / len(steady):.1f}s")
 
 def plot_training_history(history, save_path='improved_training_history.png'):
     # Plot training & validation accuracy values
@@ -57,6 +243,21 @@ def main():
     # Parse command-line arguments
     args = parse_args()
     
+    if args.workers > 1 and args.worker_index is None:
+        if args.distill_from:
+            cache_soft_targets(args)
+        sys.exit(launch_workers(args.workers))
+    
+    strategy = None
+    if args.worker_index is not None:
+        import tensorflow as tf
+        # Must exist before any other TensorFlow op runs in this process
+        strategy = tf.distribute.MultiWorkerMirroredStrategy(
+            communication_options=tf.distribute.experimental.CommunicationOptions(
+                implementation=tf.distribute.experimental.CommunicationImplementation.RING
+            )
+        )
+    
     print(f"Using {args.model_choice} as base model")
     
     # Create the classifier
@@ -64,17 +265,49 @@ def main():
         data_dir=args.data_dir,
         img_size=(args.img_size, args.img_size),
         batch_size=args.batch_size,
-        model_choice=args.model_choice
+        model_choice=args.model_choice,
+        precision=args.precision,
+        jit_compile=args.jit_compile,
+        strategy=strategy,
+        head_units=args.head_units
     )
+    if args.distill_from:
+        print(f"Distilling {args.distill_from} (temperature {args.temperature}, alpha {args.alpha})")
+        classifier.distill_from(
+            args.distill_from,
+            teacher_class_map_path=args.teacher_class_map,
+            temperature=args.temperature,
+            alpha=args.alpha,
+            cache_dir=args.soft_target_cache
+        )
     
     # Load the data
-    classifier.load_data(validation_split=args.validation_split)
+    classifier.load_data(validation_split=args.validation_split, loader=args.loader, cache=args.cache)
     
     # Build the model
-    classifier.build_model()
+    classifier.build_model(weights=None if args.weights == 'none' else args.weights)
     
     # Train the model
-    history = classifier.train(epochs=args.epochs, fine_tune_epochs=args.fine_tune_epochs)
+    epoch_timer = make_epoch_timer()
+    history = classifier.train(
+        epochs=args.epochs,
+        fine_tune_epochs=args.fine_tune_epochs,
+        callbacks=[epoch_timer],
+        feature_cache_dir=args.feature_cache,
+        feature_variants=args.feature_variants
+    )
+    
+    # Evaluation is a collective step under a distribution strategy, so every worker runs it
+    metrics = classifier.evaluate()
+    if args.worker_summary:
+        write_worker_summary(classifier, metrics, args.worker_summary)
+    
+    if not classifier.is_chief:
+        # The weights are identical on every worker; only the chief writes them out
+        print(f"Worker {classifier.worker_index} done")
+        return
+    
+    print_epoch_times(epoch_timer.times, args.loader)
     
     # Save the model
     classifier.save_model(model_path=args.model_path)
@@ -83,12 +316,24 @@ def main():
     plot_training_history(history)
     
     # Evaluate the model on the validation set
-    metrics = classifier.evaluate()
     print(f"Final validation accuracy: {metrics['accuracy']:.4f}")
     
+    if args.eval_report:
+        if strategy is None:
+            report = classifier.evaluate_detailed(report_path=args.eval_report)
+            print_report(report)
+        else:
+            print(f"Skipping --eval_report in distributed training; run evaluate_model.py on {args.model_path}")
+    
+    if args.distill_from and args.distill_report:
+        compare_with_teacher(classifier, args)
+    
     # Visualize predictions if requested
     if args.visualize:
-        classifier.visualize_predictions(num_images=5)
+        if strategy is None:
+            classifier.visualize_predictions(num_images=5)
+        else:
+            print("Skipping --visualize in distributed training; run it on the saved model instead")
     
     print(f"Training complete! Model saved to {args.model_path}")
 
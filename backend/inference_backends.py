@@ -0,0 +1,225 @@
+import threading
+import numpy as np
+
+
+BACKENDS = ['keras', 'savedmodel', 'tflite', 'onnx']
+PRECISIONS = ['float32', 'mixed_bfloat16']
+
+
+def to_mixed_precision(model, policy='mixed_bfloat16'):
+    """
+    Rebuild a functional Keras model with a mixed precision policy
+
+    Every layer except the input and output layers computes in the policy's
+    dtype (variables stay float32), so the final softmax is still computed in
+    float32. Models trained with a mixed policy already carry it and can be
+    used as they are.
+
+    Args:
+        model: Loaded Keras functional model
+        policy: Keras dtype policy name (default: 'mixed_bfloat16')
+
+    Returns:
+        New model with the same weights
+    """
+    config = model.get_config()
+    outputs = config['output_layers']
+    if outputs and isinstance(outputs[0], str):
+        outputs = [outputs]  # A single output is stored unnested
+    output_layers = {output[0] for output in outputs}
+    for layer in config['layers']:
+        if layer['class_name'] == 'InputLayer' or layer['config']['name'] in output_layers:
+            continue
+        layer['config']['dtype'] = policy
+    mixed_model = model.__class__.from_config(config)
+    mixed_model.set_weights(model.get_weights())
+    return mixed_model
+
+
+class KerasBackend:
+    name = 'keras'
+
+    def __init__(self, model, jit_compile=False):
+        """
+        Run inference with a full Keras model
+
+        Args:
+            model: A loaded Keras model
+            jit_compile: Run the forward pass as one XLA-compiled function; each
+                         batch size compiles once, which the batcher's warmup covers
+        """
+        self.model = model
+        self.jit_compile = jit_compile
+        self._forward = None
+        if jit_compile:
+            import tensorflow as tf
+            self._tf = tf
+            self._forward = tf.function(lambda images: model(images, training=False), jit_compile=True)
+
+    @classmethod
+    def load(cls, model_path, num_threads=None, precision='float32', jit_compile=False):
+        import tensorflow as tf
+        model = tf.keras.models.load_model(model_path)
+        if precision != 'float32':
+            model = to_mixed_precision(model, precision)
+        return cls(model, jit_compile=jit_compile)
+
+    def predict(self, images):
+        """
+        Args:
+            images: Float32 array of shape (N, H, W, 3) scaled to [0, 1]
+
+        Returns:
+            Array of shape (N, num_classes) with class probabilities
+        """
+        if self._forward is not None:
+            return self._forward(self._tf.constant(images)).numpy()
+        return np.asarray(self.model.predict_on_batch(images))
+
+
+class SavedModelBackend:
+    name = 'savedmodel'
+
+    def __init__(self, model_path):
+        """
+        Run inference with an exported SavedModel
+
+        Loading the traced serving function skips Keras model deserialization
+        and the graph tracing Keras does on its first predict call.
+
+        Args:
+            model_path: Directory written by Keras model.export() (or convert_model.py)
+        """
+        import tensorflow as tf
+        self._tf = tf
+        self._loaded = tf.saved_model.load(model_path)
+        if hasattr(self._loaded, 'serve'):
+            self._serve = self._loaded.serve
+        else:
+            signature = self._loaded.signatures['serving_default']
+            input_name = list(signature.structured_input_signature[1].keys())[0]
+            self._serve = lambda images: signature(**{input_name: images})
+
+    @classmethod
+    def load(cls, model_path, num_threads=None):
+        return cls(model_path)
+
+    def predict(self, images):
+        outputs = self._serve(self._tf.constant(images))
+        if isinstance(outputs, dict):
+            outputs = next(iter(outputs.values()))
+        return outputs.numpy()
+
+
+class TFLiteBackend:
+    name = 'tflite'
+
+    def __init__(self, model_path, num_threads=None):
+        """
+        Run inference with a (possibly quantized) TFLite flatbuffer
+
+        Args:
+            model_path: Path to the .tflite file
+            num_threads: Number of interpreter threads (default: TFLite's choice)
+        """
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            import tensorflow as tf
+            Interpreter = tf.lite.Interpreter
+
+        self.interpreter = Interpreter(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input_detail = self.interpreter.get_input_details()[0]
+        self.output_detail = self.interpreter.get_output_details()[0]
+        self._batch_size = int(self.input_detail['shape'][0])
+        # An interpreter holds its tensors internally, so calls must not overlap
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, model_path, num_threads=None):
+        return cls(model_path, num_threads=num_threads)
+
+    def predict(self, images):
+        with self._lock:
+            if images.shape[0] != self._batch_size:
+                self.interpreter.resize_tensor_input(self.input_detail['index'], list(images.shape))
+                self.interpreter.allocate_tensors()
+                self.input_detail = self.interpreter.get_input_details()[0]
+                self.output_detail = self.interpreter.get_output_details()[0]
+                self._batch_size = images.shape[0]
+
+            # Fully integer models take quantized inputs; map [0, 1] floats onto their scale
+            input_dtype = self.input_detail['dtype']
+            if input_dtype in (np.int8, np.uint8):
+                scale, zero_point = self.input_detail['quantization']
+                images = np.clip(np.round(images / scale + zero_point),
+                                 np.iinfo(input_dtype).min, np.iinfo(input_dtype).max)
+            self.interpreter.set_tensor(self.input_detail['index'], images.astype(input_dtype))
+            self.interpreter.invoke()
+            outputs = self.interpreter.get_tensor(self.output_detail['index'])
+
+            if self.output_detail['dtype'] in (np.int8, np.uint8):
+                scale, zero_point = self.output_detail['quantization']
+                outputs = (outputs.astype(np.float32) - zero_point) * scale
+            return np.array(outputs, dtype=np.float32)
+
+
+class ONNXBackend:
+    name = 'onnx'
+
+    def __init__(self, model_path, num_threads=None):
+        """
+        Run inference with ONNX Runtime on the CPU
+
+        Args:
+            model_path: Path to the .onnx file
+            num_threads: Number of intra-op threads (default: ONNX Runtime's choice)
+        """
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx backend needs onnxruntime: pip install onnxruntime")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options,
+                                            providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    @classmethod
+    def load(cls, model_path, num_threads=None):
+        return cls(model_path, num_threads=num_threads)
+
+    def predict(self, images):
+        return self.session.run(None, {self.input_name: images.astype(np.float32)})[0]
+
+
+def load_backend(backend, model_path, num_threads=None, precision='float32', jit_compile=False):
+    """
+    Load an inference backend by name
+
+    Args:
+        backend: One of BACKENDS ('keras', 'savedmodel', 'tflite', 'onnx')
+        model_path: Path to the model file for that backend
+        num_threads: Optional thread count for backends that support it
+        precision: One of PRECISIONS; keras backend only
+        jit_compile: XLA-compile the forward pass; keras backend only
+
+    Returns:
+        Backend object with a predict(images) method
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"precision must be one of {PRECISIONS}, got '{precision}'")
+    if backend != 'keras' and (precision != 'float32' or jit_compile):
+        raise ValueError("precision and jit_compile only apply to the keras backend")
+    if backend == 'keras':
+        return KerasBackend.load(model_path, num_threads, precision=precision, jit_compile=jit_compile)
+    if backend == 'savedmodel':
+        return SavedModelBackend.load(model_path, num_threads)
+    if backend == 'tflite':
+        return TFLiteBackend.load(model_path, num_threads)
+    if backend == 'onnx':
+        return ONNXBackend.load(model_path, num_threads)
+    raise ValueError(f"backend must be one of {BACKENDS}, got '{backend}'")
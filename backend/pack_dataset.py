@@ -0,0 +1,207 @@
+import os
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+import preprocessing
+
+# Same file types flow_from_directory picks up
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.ppm', '.tif', '.tiff')
+
+INDEX_FILE = 'index.json'
+PACK_FORMAT_VERSION = 1
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Pack a class-folder image dataset into sharded uint8 arrays')
+    parser.add_argument('--data_dir', type=str, default='parts_images',
+                        help='Directory containing class folders with images')
+    parser.add_argument('--output_dir', type=str, default='parts_images_packed',
+                        help='Directory to write the shards and index.json to')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size the images are resized to (must match training)')
+    parser.add_argument('--validation_split', type=float, default=0.2,
+                        help='Fraction of each class packed as validation shards (0 packs everything as training)')
+    parser.add_argument('--shard_size', type=int, default=512,
+                        help='Images per shard (512 images at 224 px is about 77 MB)')
+    parser.add_argument('--num_workers', type=int, default=4,
+                        help='Threads decoding images in parallel')
+    return parser.parse_args()
+
+def list_class_files(data_dir, validation_split=0.0):
+    """
+    List images per class folder and split them the way flow_from_directory does
+
+    Classes are the sorted subfolder names. Within each class the files are
+    sorted and the first validation_split of them go to validation, so every
+    loader trains and validates on exactly the same images.
+
+    Returns:
+        (class_indices, train_files, train_labels, val_files, val_labels)
+    """
+    class_names = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    class_indices = {name: i for i, name in enumerate(class_names)}
+
+    train_files, train_labels, val_files, val_labels = [], [], [], []
+    for name, index in class_indices.items():
+        class_dir = os.path.join(data_dir, name)
+        files = []
+        for root, _, filenames in sorted(os.walk(class_dir, followlinks=False)):
+            files.extend(os.path.join(root, f) for f in sorted(filenames) if f.lower().endswith(IMAGE_EXTENSIONS))
+        split = int(validation_split * len(files))
+        val_files.extend(files[:split])
+        val_labels.extend([index] * split)
+        train_files.extend(files[split:])
+        train_labels.extend([index] * (len(files) - split))
+
+    return class_indices, train_files, train_labels, val_files, val_labels
+
+def is_packed(directory):
+    """
+    Whether a directory holds a packed dataset rather than class folders
+    """
+    return directory is not None and os.path.isfile(os.path.join(directory, INDEX_FILE))
+
+def read_index(packed_dir):
+    """
+    Load the index.json of a packed dataset
+    """
+    with open(os.path.join(packed_dir, INDEX_FILE)) as f:
+        index = json.load(f)
+    if index.get('format_version') != PACK_FORMAT_VERSION:
+        raise ValueError(f"{packed_dir} was packed with an unsupported format version")
+    return index
+
+def load_rgb(image_path, img_size):
+    """
+    Decode an image file and resize it to an RGB uint8 array of shape (*img_size, 3)
+
+    OpenCV applies the EXIF orientation, so packed images are upright exactly
+    as api.py sees them at serving time.
+    """
+    image = preprocessing.load_image(image_path, img_size)
+    if image is None:
+        raise ValueError(f"Could not read image {image_path}")
+    resized = cv2.resize(image, (img_size[1], img_size[0]))
+    return cv2.cvtColor(resized, cv2.COLOR_BGR2RGB)
+
+def pack_split(files, labels, output_dir, split, img_size, shard_size, executor):
+    """
+    Decode one split's images and write them as fixed-size shards
+
+    Returns:
+        (list of shard entries for the index, list of files that failed to decode)
+    """
+    shards = []
+    failed = []
+    for start in range(0, len(files), shard_size):
+        shard_files = files[start:start + shard_size]
+        shard_labels = labels[start:start + shard_size]
+        images = np.empty((len(shard_files), *img_size, 3), dtype=np.uint8)
+        kept = []
+
+        def decode(item):
+            row, image_path = item
+            images[row] = load_rgb(image_path, img_size)
+
+        futures = [executor.submit(decode, item) for item in enumerate(shard_files)]
+        for row, future in enumerate(futures):
+            try:
+                future.result()
+                kept.append(row)
+            except Exception as e:
+                print(f"Skipping {shard_files[row]}: {e}")
+                failed.append(shard_files[row])
+
+        name = f"{split}-{len(shards):05d}"
+        np.save(os.path.join(output_dir, f"{name}.images.npy"), images[kept] if len(kept) < len(images) else images)
+        np.save(os.path.join(output_dir, f"{name}.labels.npy"), np.asarray(shard_labels, dtype=np.int32)[kept])
+        shards.append({
+            'images': f"{name}.images.npy",
+            'labels': f"{name}.labels.npy",
+            'count': len(kept)
+        })
+        print(f"Wrote {name} ({len(kept)} images)")
+    return shards, failed
+
+def pack_dataset(data_dir, output_dir, img_size=(224, 224), validation_split=0.2, shard_size=512, num_workers=4):
+    """
+    Pack a class-folder dataset into sharded uint8 arrays plus an index
+
+    Each split is written as shards of shard_size images: an (N, H, W, 3) RGB
+    uint8 array and an (N,) int32 label array per shard, as .npy files that
+    loaders memory-map and read front to back. index.json holds the class map,
+    image size and shard list. Images are shuffled across classes before
+    packing, so sequential reads see a mix of classes.
+
+    Returns:
+        The index dictionary
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    class_indices, train_files, train_labels, val_files, val_labels = list_class_files(data_dir, validation_split)
+
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(train_files))
+    train_files = [train_files[i] for i in order]
+    train_labels = [train_labels[i] for i in order]
+
+    index = {
+        'format_version': PACK_FORMAT_VERSION,
+        'img_size': list(img_size),
+        'class_indices': class_indices,
+        'validation_split': validation_split,
+        'splits': {},
+        'failed': []
+    }
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        for split, files, labels in (('train', train_files, train_labels), ('val', val_files, val_labels)):
+            shards, failed = pack_split(files, labels, output_dir, split, tuple(img_size), shard_size, executor)
+            index['splits'][split] = shards
+            index['failed'].extend(failed)
+
+    # Written last, so a half-packed directory is never picked up as a dataset
+    with open(os.path.join(output_dir, INDEX_FILE), 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+def split_size(index, split):
+    return sum(shard['count'] for shard in index['splits'].get(split, []))
+
+def iter_packed_chunks(packed_dir, shards, chunk_size=256, rng=None):
+    """
+    Yield (images, labels) chunks from packed shards, reading each shard front to back
+
+    Args:
+        packed_dir: Directory of the packed dataset
+        shards: Shard entries from the index
+        chunk_size: Images per yielded chunk
+        rng: Optional numpy Generator; if given, the shard order is shuffled
+    """
+    order = np.arange(len(shards))
+    if rng is not None:
+        rng.shuffle(order)
+    for i in order:
+        shard = shards[i]
+        images = np.load(os.path.join(packed_dir, shard['images']), mmap_mode='r')
+        labels = np.load(os.path.join(packed_dir, shard['labels']))
+        for start in range(0, len(labels), chunk_size):
+            yield np.asarray(images[start:start + chunk_size]), labels[start:start + chunk_size]
+
+def main():
+    args = parse_args()
+    img_size = (args.img_size, args.img_size)
+
+    print(f"Packing {args.data_dir} into {args.output_dir} at {args.img_size}px...")
+    index = pack_dataset(
+        args.data_dir,
+        args.output_dir,
+        img_size=img_size,
+        validation_split=args.validation_split,
+        shard_size=args.shard_size,
+        num_workers=args.num_workers
+    )
+    print(f"Packed {split_size(index, 'train')} training and {split_size(index, 'val')} validation images "
+          f"in {len(index['class_indices'])} classes ({len(index['failed'])} skipped)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import json
+import time
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """
+    Serialize to JSON bytes, with orjson when it's installed
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+class PartCatalog:
+    def __init__(self, details_json_path, reload_interval=2.0):
+        """
+        Part details from Details.json, indexed by class index.
+
+        Each part's details are serialized to JSON once at load time, so responses
+        can splice in the bytes instead of looking up and re-encoding the dict on
+        every request. The file is re-read when its modification time changes.
+
+        Args:
+            details_json_path: Path to Details.json
+            reload_interval: Minimum seconds between checks for a changed file (default: 2)
+        """
+        self.details_json_path = details_json_path
+        self.reload_interval = reload_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._mtime = None
+        # (parts, names, payloads) is swapped as a whole so readers never see a half-built index
+        self._index = ({}, {}, {})
+        self.load()
+
+    def load(self):
+        """
+        (Re)load the catalogue from disk
+
+        Returns:
+            True if the file was loaded, False if it couldn't be read (the previous
+            catalogue stays in place)
+        """
+        try:
+            mtime = os.path.getmtime(self.details_json_path)
+            with open(self.details_json_path, 'r') as f:
+                parts_details = json.load(f)
+        except Exception as e:
+            print(f"Error loading parts details: {e}")
+            return False
+
+        parts = {}
+        names = {}
+        payloads = {}
+        for part in parts_details:
+            index = int(part["index"])
+            parts[index] = part
+            names[index] = part["part_name"]
+            payloads[index] = dumps(part)
+
+        self._index = (parts, names, payloads)
+        self._mtime = mtime
+        print(f"Parts details loaded from {self.details_json_path} ({len(parts)} classes)")
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        with self._lock:
+            if now - self._last_check < self.reload_interval:
+                return
+            self._last_check = now
+            try:
+                mtime = os.path.getmtime(self.details_json_path)
+            except OSError:
+                return
+            if mtime != self._mtime:
+                self.load()
+
+    def get(self, index):
+        """
+        Part details dict for a class index, or None
+        """
+        self._maybe_reload()
+        return self._index[0].get(index)
+
+    def name(self, index):
+        """
+        Part name for a class index
+        """
+        self._maybe_reload()
+        return self._index[1].get(index, f"Unknown Class {index}")
+
+    def payload(self, index):
+        """
+        Pre-serialized JSON bytes of the part details for a class index (b'null' if unknown)
+        """
+        self._maybe_reload()
+        return self._index[2].get(index, b"null")
+
+    @property
+    def idx_to_class(self):
+        self._maybe_reload()
+        return dict(self._index[1])
+
+    def __len__(self):
+        return len(self._index[0])
@@ -0,0 +1,150 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from improved_parts_classifier import ImprovedPartsClassifier
+from pack_dataset import list_class_files
+
+# (precision, jit_compile) pairs compared by default; the first one is the baseline
+CONFIGS = [
+    ('float32', False),
+    ('float32', True),
+    ('mixed_bfloat16', False),
+    ('mixed_bfloat16', True)
+]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare throughput and accuracy of float32, bfloat16 and XLA inference')
+    parser.add_argument('--model_path', type=str, default='improved_parts_model.h5',
+                        help='Path to the trained Keras model')
+    parser.add_argument('--class_map_path', type=str, default='improved_class_indices.pkl',
+                        help='Path to the class indices file')
+    parser.add_argument('--data_dir', type=str, required=True,
+                        help='Validation directory with one folder per class')
+    parser.add_argument('--img_size', type=int, default=224,
+                        help='Image size for model input')
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='Images per forward pass')
+    parser.add_argument('--max_images', type=int, default=1000,
+                        help='Evaluate on at most this many images')
+    parser.add_argument('--timing_batches', type=int, default=20,
+                        help='Forward passes timed per configuration for throughput')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Optional JSON file to write the report to')
+    return parser.parse_args()
+
+def cpu_supports_bfloat16():
+    """
+    Whether the CPU advertises native bfloat16 arithmetic (AVX512-BF16 or AMX)
+
+    Returns None when it can't be told (no /proc/cpuinfo).
+    """
+    try:
+        with open('/proc/cpuinfo') as f:
+            flags = f.read()
+    except OSError:
+        return None
+    return 'avx512_bf16' in flags or 'amx_bf16' in flags
+
+def load_images(classifier, data_dir, max_images):
+    """
+    Preprocess a deterministic sample of labelled images once, shared by every configuration
+
+    Returns:
+        (float32 images of shape (N, H, W, 3), int labels)
+    """
+    _, files, labels, _, _ = list_class_files(data_dir)
+    class_names = sorted(d for d in os.listdir(data_dir) if os.path.isdir(os.path.join(data_dir, d)))
+    # Map the folder order onto the trained model's class indices
+    folder_to_model = np.array([classifier.class_indices.get(name, -1) for name in class_names])
+
+    rng = np.random.default_rng(0)
+    order = rng.permutation(len(files))[:max_images]
+    images = np.empty((len(order), *classifier.img_size, 3), dtype=np.float32)
+    for row, i in enumerate(order):
+        classifier.preprocess_image(files[i], images[row])
+    return images, folder_to_model[np.asarray(labels)[order]]
+
+def measure(classifier, images, batch_size, timing_batches):
+    """
+    Predict every image and time repeated forward passes of one full batch
+
+    Returns:
+        (probabilities, images per second, seconds per batch)
+    """
+    probabilities = np.concatenate([
+        classifier.predict_batch(images[start:start + batch_size])
+        for start in range(0, len(images), batch_size)
+    ])
+
+    batch = images[:batch_size]
+    classifier.predict_batch(batch)  # The timed shape is compiled by now, but make sure
+    start = time.perf_counter()
+    for _ in range(timing_batches):
+        classifier.predict_batch(batch)
+    seconds_per_batch = (time.perf_counter() - start) / timing_batches
+    return probabilities, len(batch) / seconds_per_batch, seconds_per_batch
+
+def main():
+    args = parse_args()
+    img_size = (args.img_size, args.img_size)
+
+    bf16 = cpu_supports_bfloat16()
+    if bf16 is False:
+        print("Warning: this CPU has no native bfloat16 support, so mixed_bfloat16 is likely to be slower")
+
+    images = labels = None
+    baseline = None
+    results = []
+    for precision, jit_compile in CONFIGS:
+        name = precision + (' + XLA' if jit_compile else '')
+        classifier = ImprovedPartsClassifier(data_dir=None, img_size=img_size,
+                                             precision=precision, jit_compile=jit_compile)
+        if not classifier.load_model(model_path=args.model_path, class_map_path=args.class_map_path):
+            raise RuntimeError(f"Could not load {args.model_path}")
+        if images is None:
+            images, labels = load_images(classifier, args.data_dir, args.max_images)
+            print(f"Comparing on {len(images)} images from {args.data_dir}")
+
+        print(f"Measuring {name}...")
+        probabilities, throughput, seconds_per_batch = measure(classifier, images, args.batch_size,
+                                                               args.timing_batches)
+        top1 = np.argmax(probabilities, axis=1)
+        labelled = labels >= 0
+        result = {
+            'config': name,
+            'precision': precision,
+            'jit_compile': jit_compile,
+            'images_per_second': throughput,
+            'ms_per_batch': seconds_per_batch * 1000,
+            'accuracy': float(np.mean(top1[labelled] == labels[labelled])) if labelled.any() else None
+        }
+        if baseline is None:
+            baseline = (probabilities, top1, throughput)
+        else:
+            result['speedup'] = throughput / baseline[2]
+            result['top1_agreement'] = float(np.mean(top1 == baseline[1]))
+            result['max_abs_prob_diff'] = float(np.abs(probabilities - baseline[0]).max())
+        results.append(result)
+
+    print(f"\n{'config':<24}{'img/s':>10}{'speedup':>10}{'accuracy':>10}{'agreement':>11}")
+    for result in results:
+        accuracy = result['accuracy']
+        print(f"{result['config']:<24}{result['images_per_second']:>10.1f}{result.get('speedup', 1.0):>9.2f}x"
+              f"{accuracy if accuracy is not None else float('nan'):>10.4f}{result.get('top1_agreement', 1.0):>11.4f}")
+
+    report = {
+        'model_path': args.model_path,
+        'num_images': len(images),
+        'batch_size': args.batch_size,
+        'cpu_bfloat16': bf16,
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+
+class PredictionCache:
+    def __init__(self, max_entries=1024, ttl=3600, disk_path=None, disk_max_entries=100000):
+        """
+        Content-addressed cache of model outputs keyed by image bytes and model version.
+
+        Entries live in an in-process LRU. If disk_path is given, entries are also
+        written to a SQLite file there so several server workers share hits.
+
+        Args:
+            max_entries: Maximum number of entries kept in memory (default: 1024)
+            ttl: Seconds an entry stays valid, or None to never expire (default: 3600)
+            disk_path: Optional path of a shared SQLite cache file
+            disk_max_entries: Maximum number of entries kept on disk (default: 100000)
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_path = disk_path
+        self.disk_max_entries = disk_max_entries
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.disk_errors = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk = None
+        self._disk_writes = 0
+
+        if disk_path:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_path)), exist_ok=True)
+            self._disk = sqlite3.connect(disk_path, timeout=5, check_same_thread=False)
+            # WAL lets readers in other worker processes proceed while one writes
+            self._disk.execute("PRAGMA journal_mode=WAL")
+            self._disk.execute(
+                "CREATE TABLE IF NOT EXISTS predictions "
+                "(key TEXT PRIMARY KEY, created REAL, dtype TEXT, value BLOB)"
+            )
+            self._disk.commit()
+
+    @staticmethod
+    def make_key(contents, model_version):
+        """
+        Build the cache key for an uploaded file
+
+        Args:
+            contents: Raw bytes of the uploaded image
+            model_version: String identifying the model that produces the outputs
+
+        Returns:
+            Hex digest of the model version and image bytes
+        """
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(model_version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(contents)
+        return digest.hexdigest()
+
+    def _expired(self, created):
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def get(self, key):
+        """
+        Look up a cached model output
+
+        Args:
+            key: Key from make_key
+
+        Returns:
+            The cached output array, or None on a miss
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created, value = entry
+                if not self._expired(created):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+
+            if self._disk is not None:
+                try:
+                    row = self._disk.execute(
+                        "SELECT created, dtype, value FROM predictions WHERE key = ?", (key,)
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    # An unreadable cache file is a miss, not a failed request
+                    self.disk_errors += 1
+                    print(f"Prediction cache read from {self.disk_path} failed: {e}")
+                    row = None
+                if row is not None and not self._expired(row[0]):
+                    value = np.frombuffer(row[2], dtype=row[1])
+                    self._remember(key, row[0], value)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Store a model output
+
+        Args:
+            key: Key from make_key
+            value: Output array to cache
+        """
+        # Copy so a cached row doesn't keep the whole output batch alive
+        value = np.array(value)
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, value)
+
+            if self._disk is not None:
+                # Best effort: a locked or full cache file must not fail the prediction being cached
+                try:
+                    self._disk.execute(
+                        "INSERT OR REPLACE INTO predictions (key, created, dtype, value) VALUES (?, ?, ?, ?)",
+                        (key, created, value.dtype.str, value.tobytes())
+                    )
+                    self._disk_writes += 1
+                    # Prune expired and surplus rows every so often rather than on every write
+                    if self._disk_writes % 1000 == 0:
+                        self._prune_disk()
+                    self._disk.commit()
+                except sqlite3.Error as e:
+                    self.disk_errors += 1
+                    print(f"Prediction cache write to {self.disk_path} failed: {e}")
+                    try:
+                        self._disk.rollback()
+                    except sqlite3.Error:
+                        pass
+
+    def _remember(self, key, created, value):
+        self._entries[key] = (created, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _prune_disk(self):
+        if self.ttl is not None:
+            self._disk.execute("DELETE FROM predictions WHERE created < ?", (time.time() - self.ttl,))
+        self._disk.execute(
+            "DELETE FROM predictions WHERE key NOT IN "
+            "(SELECT key FROM predictions ORDER BY created DESC LIMIT ?)",
+            (self.disk_max_entries,)
+        )
+
+    def stats(self):
+        """
+        Return hit/miss counters and current size
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "disk_errors": self.disk_errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl": self.ttl,
+            "disk_path": self.disk_path
+        }
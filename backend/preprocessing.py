@@ -0,0 +1,153 @@
+import struct
+import numpy as np
+import cv2
+
+# JPEG start-of-frame markers (everything in 0xC0-0xCF except DHT, JPG and DAC)
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# libjpeg can decode straight to 1/2, 1/4 or 1/8 scale via DCT scaling
+REDUCED_DECODE_FLAGS = [
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2)
+]
+
+SCALE = np.float32(1.0 / 255.0)
+
+
+def peek_image_size(contents):
+    """
+    Read image dimensions from a JPEG or PNG header without decoding the pixels
+
+    Args:
+        contents: Raw bytes of the image file
+
+    Returns:
+        (height, width), or None if the format isn't recognised
+    """
+    if contents[:8] == b'\x89PNG\r\n\x1a\n' and len(contents) >= 24:
+        width, height = struct.unpack('>II', contents[16:24])
+        return height, width
+
+    if contents[:2] != b'\xff\xd8':
+        return None
+
+    # Walk the JPEG segments until the frame header
+    i = 2
+    while i + 9 < len(contents):
+        if contents[i] != 0xFF:
+            return None
+        marker = contents[i + 1]
+        if marker == 0xFF:
+            i += 1  # Fill byte
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            i += 2  # Standalone marker, no length field
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack('>HH', contents[i + 5:i + 9])
+            return height, width
+        i += 2 + struct.unpack('>H', contents[i + 2:i + 4])[0]
+    return None
+
+
+def decode_image(contents, target_size=None):
+    """
+    Decode image bytes to a BGR uint8 array, at reduced resolution where that's free
+
+    JPEGs at least twice as large as target_size on their short side are decoded
+    at 1/2, 1/4 or 1/8 scale, which skips most of the IDCT work and the memory for
+    the full-resolution image.
+
+    Args:
+        contents: Raw bytes of the image file
+        target_size: Final (height, width) the image will be resized to, or None for full resolution
+
+    Returns:
+        BGR uint8 array, or None if the bytes are not a valid image
+    """
+    buffer = np.frombuffer(contents, np.uint8)
+    flags = cv2.IMREAD_COLOR
+
+    if target_size is not None and contents[:2] == b'\xff\xd8':
+        size = peek_image_size(contents)
+        if size is not None:
+            # Compare the short side with the larger target side, so EXIF rotation can't undershoot
+            short_side = min(size)
+            for factor, reduced_flag in REDUCED_DECODE_FLAGS:
+                if short_side // factor >= max(target_size):
+                    flags = reduced_flag
+                    break
+
+    return cv2.imdecode(buffer, flags)
+
+
+def load_image(image_path, target_size=None):
+    """
+    Read and decode an image file (see decode_image)
+
+    Returns:
+        BGR uint8 array, or None if the file is not a valid image
+    """
+    with open(image_path, 'rb') as f:
+        return decode_image(f.read(), target_size)
+
+
+def preprocess_into(image_bgr, out):
+    """
+    Resize a BGR image and write it as normalized RGB float32 into out
+
+    The resize runs on the BGR image, then the channel swap and the /255
+    scaling happen in one pass from a reversed-channel view directly into out,
+    with no float64 or intermediate RGB copy.
+
+    Args:
+        image_bgr: Decoded BGR uint8 image
+        out: Float32 array of shape (height, width, 3), e.g. one row of a batch buffer
+
+    Returns:
+        out
+    """
+    height, width = out.shape[:2]
+    resized = cv2.resize(image_bgr, (width, height))
+    np.multiply(resized[..., ::-1], SCALE, out=out, dtype=np.float32)
+    return out
+
+
+def preprocess_bytes(contents, target_size, out=None):
+    """
+    Decode image bytes and preprocess them into a model input
+
+    Args:
+        contents: Raw bytes of the image file
+        target_size: Model input size as (height, width)
+        out: Optional float32 array of shape (*target_size, 3) to write into
+
+    Returns:
+        Float32 array of shape (*target_size, 3), or None if the bytes are not a valid image
+    """
+    image = decode_image(contents, target_size)
+    if image is None:
+        return None
+    if out is None:
+        out = np.empty((*target_size, 3), dtype=np.float32)
+    return preprocess_into(image, out)
+
+
+def preprocess_file(image_path, target_size, out=None):
+    """
+    Load an image file and preprocess it into a model input (see preprocess_bytes)
+    """
+    image = load_image(image_path, target_size)
+    if image is None:
+        return None
+    if out is None:
+        out = np.empty((*target_size, 3), dtype=np.float32)
+    return preprocess_into(image, out)
+
+
+def allocate_batch(batch_size, target_size):
+    """
+    Allocate a float32 batch buffer that preprocess_into can fill row by row
+    """
+    return np.zeros((batch_size, *target_size, 3), dtype=np.float32)
@@ -0,0 +1,105 @@
+import asyncio
+import numpy as np
+import pytest
+from batcher import MicroBatcher, bucket_sizes
+
+
+@pytest.mark.parametrize('max_batch_size, expected', [
+    (1, [1]),
+    (2, [1, 2]),
+    (8, [1, 2, 4, 8]),
+    (12, [1, 2, 4, 8, 12]),
+    (16, [1, 2, 4, 8, 16])
+])
+def test_bucket_sizes(max_batch_size, expected):
+    assert bucket_sizes(max_batch_size) == expected
+
+
+def row_sums(images):
+    # One output row per input, so padding rows would show up as extra rows
+    return images.reshape(len(images), -1).sum(axis=1, keepdims=True)
+
+
+def run_batch(batcher, images):
+    async def main():
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(image) for image in images))
+        finally:
+            await batcher.stop()
+    return asyncio.run(main())
+
+
+def test_pads_each_batch_to_the_next_bucket():
+    seen_sizes = []
+
+    def predict(batch):
+        seen_sizes.append(len(batch))
+        return row_sums(batch)
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_delay=0.05)
+    images = [np.full((2, 2, 3), i, dtype=np.float32) for i in range(5)]
+    results = run_batch(batcher, images)
+
+    assert seen_sizes == [8]
+    assert [float(row[0]) for row, _ in results] == [12.0 * i for i in range(5)]
+    assert all(stats['batch_size'] == 5 for _, stats in results)
+
+
+def test_padding_rows_are_zeroed_between_batches():
+    batches = []
+
+    def predict(batch):
+        batches.append(batch.copy())
+        return row_sums(batch)
+
+    batcher = MicroBatcher(predict, max_batch_size=4, max_delay=0.05)
+    run_batch(batcher, [np.ones((2, 2, 3), dtype=np.float32)] * 4)
+    run_batch(batcher, [np.ones((2, 2, 3), dtype=np.float32)] * 3)
+
+    assert [len(batch) for batch in batches] == [4, 4]
+    assert not batches[1][3].any()
+
+
+def test_without_padding_batches_keep_their_size():
+    seen_sizes = []
+
+    def predict(batch):
+        seen_sizes.append(len(batch))
+        return row_sums(batch)
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_delay=0.05, pad_batches=False)
+    run_batch(batcher, [np.ones((2, 2, 3), dtype=np.float32)] * 5)
+    assert batcher.batch_sizes == list(range(1, 9))
+    assert seen_sizes == [5]
+
+
+def test_warmup_runs_every_bucket():
+    seen_sizes = []
+
+    def predict(batch):
+        seen_sizes.append(len(batch))
+        return row_sums(batch)
+
+    timings = MicroBatcher(predict, max_batch_size=6).warmup((2, 2, 3))
+    assert seen_sizes == [1, 2, 4, 6]
+    assert sorted(timings) == [1, 2, 4, 6]
+
+
+def test_failing_hook_does_not_stop_the_worker():
+    def on_batch(batch_size, inference_time):
+        raise RuntimeError("metrics backend down")
+
+    batcher = MicroBatcher(row_sums, max_batch_size=4, max_delay=0.01, on_batch=on_batch)
+
+    async def main():
+        await batcher.start()
+        try:
+            first = await batcher.submit(np.ones((2, 2, 3), dtype=np.float32))
+            second = await asyncio.wait_for(batcher.submit(np.ones((2, 2, 3), dtype=np.float32)), 5)
+            return first, second
+        finally:
+            await batcher.stop()
+
+    first, second = asyncio.run(main())
+    assert float(first[0][0]) == float(second[0][0]) == 12.0
@@ -0,0 +1,106 @@
+import os
+import json
+import pytest
+from classification_jobs import (JSONLResultWriter, ParquetResultWriter, in_shard, iter_records, merge_outputs,
+                                 read_manifest, shard_output_path, write_manifest)
+
+
+def write_jsonl(path, lines):
+    path.write_text("".join(line + "\n" for line in lines))
+
+
+def test_done_paths_skips_errors_and_partial_lines(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    output.write_text(
+        json.dumps({'image': 'a.jpg', 'predicted_class': 'disc'}) + "\n" +
+        json.dumps({'image': 'b.jpg', 'error': 'Invalid image file'}) + "\n" +
+        '{"image": "c.jpg", "predic'
+    )
+    assert JSONLResultWriter(str(output)).done_paths() == {'a.jpg'}
+
+
+def test_resume_drops_the_partial_last_line(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    output.write_text(json.dumps({'image': 'a.jpg'}) + "\n" + '{"image": "b.jp')
+
+    writer = JSONLResultWriter(str(output))
+    writer.write([{'image': 'b.jpg'}, {'image': 'c.jpg'}])
+    writer.close()
+
+    assert [record['image'] for record in iter_records(str(output))] == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert output.read_text().count("\n") == 3
+
+
+def test_resume_of_a_file_without_any_complete_line(tmp_path):
+    output = tmp_path / 'results.jsonl'
+    output.write_text('{"image": "a.j')
+    writer = JSONLResultWriter(str(output))
+    writer.write([{'image': 'a.jpg'}])
+    writer.close()
+    assert output.read_text() == json.dumps({'image': 'a.jpg'}) + "\n"
+
+
+def test_merge_prefers_success_over_errors(tmp_path):
+    first = tmp_path / 'results.shard-00000-of-00002.jsonl'
+    second = tmp_path / 'results.shard-00001-of-00002.jsonl'
+    write_jsonl(first, [
+        json.dumps({'image': 'a.jpg', 'error': 'timeout'}),
+        json.dumps({'image': 'a.jpg', 'predicted_class': 'disc'}),
+        json.dumps({'image': 'b.jpg', 'error': 'Invalid image file'})
+    ])
+    write_jsonl(second, [
+        json.dumps({'image': 'c.jpg', 'predicted_class': 'pad'}),
+        json.dumps({'image': 'a.jpg', 'predicted_class': 'drum'}),
+        json.dumps({'image': 'b.jpg', 'error': 'second failure'})
+    ])
+    merged = tmp_path / 'results.jsonl'
+
+    assert merge_outputs([str(first), str(second)], str(merged), chunk_size=2) == 3
+    records = {record['image']: record for record in iter_records(str(merged))}
+    assert records['a.jpg'] == {'image': 'a.jpg', 'predicted_class': 'disc'}
+    assert records['b.jpg']['error'] == 'Invalid image file'
+    assert records['c.jpg']['predicted_class'] == 'pad'
+
+
+def test_shards_partition_the_manifest(tmp_path):
+    for folder in ('x', 'x/y'):
+        (tmp_path / 'images' / folder).mkdir(parents=True)
+    for name in ('x/1.jpg', 'x/2.PNG', 'x/y/3.jpeg', 'x/notes.txt'):
+        (tmp_path / 'images' / name).write_bytes(b'')
+    manifest = tmp_path / 'manifest.txt'
+
+    assert write_manifest(str(tmp_path / 'images'), str(manifest)) == 3
+    paths = list(read_manifest(str(manifest)))
+    shards = [[path for path in paths if in_shard(path, 2, index)] for index in range(2)]
+    assert sorted(shards[0] + shards[1]) == sorted(paths)
+    assert shard_output_path('out/results.jsonl', 4, 2) == 'out/results.shard-00002-of-00004.jsonl'
+    assert shard_output_path('out/results.jsonl', 1, 0) == 'out/results.jsonl'
+
+
+def test_parquet_parts_never_overwrite_each_other(tmp_path):
+    pytest.importorskip('pyarrow')
+    output = tmp_path / 'results.parquet'
+    first = ParquetResultWriter(str(output), rows_per_file=1)
+    first.write([{'image': 'a.jpg', 'prediction': 'disc', 'confidence': 0.9}])
+    # A failed part left a gap: the next part goes after the highest number, not into the gap
+    os.rename(output / 'part-00000.parquet', output / 'part-00003.parquet')
+    second = ParquetResultWriter(str(output), rows_per_file=1)
+    second.write([{'image': 'b.jpg', 'error': 'Invalid image file'}])
+    first.write([{'image': 'c.jpg', 'prediction': 'pad', 'confidence': 0.8}])
+
+    assert sorted(os.listdir(output)) == ['part-00003.parquet', 'part-00004.parquet', 'part-00005.parquet']
+    assert sorted(record['image'] for record in iter_records(str(output))) == ['a.jpg', 'b.jpg', 'c.jpg']
+    assert second.done_paths() == {'a.jpg', 'c.jpg'}
+
+
+def test_parquet_part_taken_by_another_writer_is_skipped(tmp_path, monkeypatch):
+    pytest.importorskip('pyarrow')
+    output = tmp_path / 'results.parquet'
+    writer = ParquetResultWriter(str(output), rows_per_file=1)
+    writer.write([{'image': 'a.jpg', 'prediction': 'disc', 'confidence': 0.9}])
+    # As if another writer published part-00000 between the directory scan and the rename
+    monkeypatch.setattr(writer, '_next_part_number', lambda: 0)
+    writer.write([{'image': 'b.jpg', 'prediction': 'pad', 'confidence': 0.8}])
+
+    assert sorted(os.listdir(output)) == ['part-00000.parquet', 'part-00001.parquet']
+    assert [record['image'] for record in iter_records(str(output))] == ['a.jpg', 'b.jpg']
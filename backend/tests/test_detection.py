@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+import detection
+
+
+def test_nms_drops_overlapping_lower_scores():
+    boxes = np.array([
+        [0, 0, 10, 10],
+        [1, 1, 11, 11],    # IoU with the first is 81/119, about 0.68
+        [20, 20, 30, 30],
+        [1, 1, 11, 6]      # IoU with the second is 0.5
+    ])
+    scores = np.array([0.9, 0.95, 0.5, 0.8])
+    assert detection.non_max_suppression(boxes, scores, iou_threshold=0.4).tolist() == [1, 2]
+    assert detection.non_max_suppression(boxes, scores, iou_threshold=0.5).tolist() == [1, 3, 2]
+    assert detection.non_max_suppression(boxes, scores, iou_threshold=0.7).tolist() == [1, 0, 3, 2]
+
+
+def test_nms_max_detections_and_empty_input():
+    boxes = np.array([[0, 0, 1, 1], [2, 2, 3, 3], [4, 4, 5, 5]])
+    assert detection.non_max_suppression(boxes, [0.1, 0.3, 0.2], max_detections=2).tolist() == [1, 2]
+    empty = detection.non_max_suppression(np.zeros((0, 4)), np.zeros(0))
+    assert empty.dtype == np.int64 and len(empty) == 0
+
+
+def test_select_detections_suppresses_per_class():
+    boxes = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [1, 1, 11, 11], [20, 20, 30, 30]])
+    probabilities = np.array([
+        [0.9, 0.1],
+        [0.8, 0.2],   # same class, overlapping: suppressed
+        [0.3, 0.7],   # other class, overlapping: kept
+        [0.6, 0.4]    # below min_confidence
+    ])
+    keep = detection.select_detections(boxes, probabilities, min_confidence=0.65)
+    assert keep.tolist() == [0, 2]
+
+
+def test_scale_boxes_maps_x_and_y_separately():
+    boxes = np.array([[10, 20, 30, 40]])
+    # scale is (y, x), as returned by decode_for_detection
+    assert detection.scale_boxes(boxes, (2.0, 0.5)).tolist() == [[5, 40, 15, 80]]
+    assert detection.scale_boxes(boxes, (1.25, 1.25)).tolist() == [[12, 25, 38, 50]]
+
+
+def test_sliding_windows_cover_the_image():
+    boxes = detection.sliding_window_boxes(60, 100, scales=(1.0, 0.5), overlap=0.5)
+    assert boxes[:, 2].max() == 100 and boxes[:, 3].max() == 60
+    assert (boxes[:, 0] >= 0).all() and (boxes[:, 1] >= 0).all()
+    # Whole-short-side windows: 60px wide at stride 30, the last one flush with the right edge
+    assert boxes[boxes[:, 2] - boxes[:, 0] == 60][:, 0].tolist() == [0, 30, 40]
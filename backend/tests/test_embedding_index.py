@@ -0,0 +1,136 @@
+import os
+import json
+import multiprocessing
+import numpy as np
+import pytest
+import embedding_index
+from embedding_index import EmbeddingIndex, combine_probabilities, similarity_probabilities
+
+EYE = np.eye(4, dtype=np.float32)
+
+
+def test_add_and_search_centroid(tmp_path):
+    index = EmbeddingIndex(str(tmp_path))
+    index.add(EYE[:2], [0, 1])
+    index.add(EYE[2:], 3)
+
+    assert len(index) == 4
+    assert index.num_labels == 3
+    assert index.count(3) == 2 and index.count(2) == 0
+    similarities = index.similarities(EYE[3:] * 5, num_classes=2)
+    # Class 2 has no references; class 3's centroid is (e2 + e3) / sqrt(2)
+    np.testing.assert_allclose(similarities, [[0.0, 0.0, -np.inf, np.sqrt(0.5)]], atol=1e-6)
+
+
+def test_nearest_takes_each_classes_best_reference(tmp_path):
+    index = EmbeddingIndex(str(tmp_path), reduce='nearest')
+    index.add(EYE, [1, 0, 1, 0])
+    np.testing.assert_allclose(index.similarities(EYE[2:3]), [[0.0, 1.0]], atol=1e-6)
+
+
+def test_dimension_mismatch_is_rejected(tmp_path):
+    index = EmbeddingIndex(str(tmp_path))
+    index.add(EYE, 0)
+    with pytest.raises(ValueError):
+        index.add(np.ones((1, 3)), 0)
+
+
+def test_reopened_index_matches(tmp_path):
+    index = EmbeddingIndex(str(tmp_path))
+    index.add(EYE[:3], [0, 1, 2])
+    index.add(EYE[3:], 1)
+
+    reopened = EmbeddingIndex(str(tmp_path))
+    assert reopened.stats() == index.stats()
+    np.testing.assert_array_equal(reopened.similarities(EYE), index.similarities(EYE))
+
+
+def test_reload_picks_up_another_processes_enrolment(tmp_path):
+    writer = EmbeddingIndex(str(tmp_path))
+    writer.add(EYE[:1], 0)
+    reader = EmbeddingIndex(str(tmp_path), reload_interval=0)
+    writer.add(EYE[1:], 5)
+
+    reader.maybe_reload()
+    assert len(reader) == 4
+    assert reader.revision == writer.revision == 2
+    assert reader.label_space() == 6
+    # Only the current and the previous revision's files remain
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith('.npy')) == [
+        'labels-1.npy', 'labels-2.npy', 'references-1.npy', 'references-2.npy'
+    ]
+
+
+def test_two_instances_enrol_into_one_directory(tmp_path):
+    first = EmbeddingIndex(str(tmp_path))
+    second = EmbeddingIndex(str(tmp_path))
+    first.add(EYE[:1], 0)
+    # second has not reloaded, but must build on first's revision rather than overwrite it
+    second.add(EYE[1:2], 1)
+    first.add(EYE[2:3], 2)
+
+    index = EmbeddingIndex(str(tmp_path))
+    assert len(index) == 3
+    assert [index.count(label) for label in range(3)] == [1, 1, 1]
+    assert index.revision == 3
+
+
+def enrol_repeatedly(index_dir, label, times):
+    index = EmbeddingIndex(index_dir)
+    for _ in range(times):
+        index.add(EYE[label:label + 1], label)
+
+
+@pytest.mark.skipif(embedding_index.fcntl is None, reason='needs fcntl file locks')
+def test_concurrent_processes_keep_every_enrolment(tmp_path):
+    context = multiprocessing.get_context('spawn')
+    workers = [context.Process(target=enrol_repeatedly, args=(str(tmp_path), label, 10)) for label in (0, 1)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    index = EmbeddingIndex(str(tmp_path))
+    assert (index.count(0), index.count(1)) == (10, 10)
+    assert index.revision == 20
+
+
+def test_inconsistent_index_is_not_loaded(tmp_path):
+    writer = EmbeddingIndex(str(tmp_path))
+    writer.add(EYE[:2], 0)
+    reader = EmbeddingIndex(str(tmp_path), reload_interval=0)
+    writer.add(EYE[2:], 1)
+
+    # index.json promises more references than its files hold
+    meta_path = tmp_path / 'index.json'
+    meta = json.loads(meta_path.read_text())
+    meta['count'] += 1
+    meta_path.write_text(json.dumps(meta))
+    os.utime(meta_path, (0, 0))
+
+    reader.maybe_reload()
+    assert len(reader) == 2
+    with pytest.raises(ValueError):
+        EmbeddingIndex(str(tmp_path))
+
+
+def test_format_1_index_still_loads(tmp_path):
+    np.save(tmp_path / 'references.npy', EYE[:2])
+    np.save(tmp_path / 'labels.npy', np.array([0, 1], dtype=np.int32))
+    (tmp_path / 'index.json').write_text(json.dumps({'format_version': 1, 'dim': 4, 'count': 2, 'revision': 7}))
+
+    index = EmbeddingIndex(str(tmp_path))
+    assert (len(index), index.revision) == (2, 7)
+    index.add(EYE[2:], 2)
+    assert len(EmbeddingIndex(str(tmp_path))) == 4
+    assert not (tmp_path / 'references.npy').exists()
+
+
+def test_probabilities_helpers():
+    probabilities = similarity_probabilities(np.array([[1.0, 0.0, -np.inf]]), temperature=0.5)
+    np.testing.assert_allclose(probabilities.sum(axis=1), [1.0])
+    assert probabilities[0, 2] == 0.0
+
+    combined = combine_probabilities(np.array([[0.6, 0.4]]), np.array([[0.0, 0.5, 0.5]]), weight=0.5)
+    np.testing.assert_allclose(combined, [[0.3, 0.45, 0.25]])
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+from evaluation import EvaluationAccumulator
+
+# Three classes, five samples: rows are probabilities, labels the true classes
+PROBABILITIES = np.array([
+    [0.7, 0.2, 0.1],  # true 0, predicted 0
+    [0.1, 0.6, 0.3],  # true 1, predicted 1
+    [0.5, 0.3, 0.2],  # true 1, predicted 0 (label ranked second)
+    [0.6, 0.3, 0.1],  # true 2, predicted 0 (label ranked third)
+    [0.2, 0.2, 0.6]   # true 2, predicted 2
+])
+LABELS = np.array([0, 1, 1, 2, 2])
+
+
+def test_confusion_matrix_rows_are_true_classes():
+    accumulator = EvaluationAccumulator(3)
+    accumulator.update(PROBABILITIES, LABELS)
+    assert accumulator.report()['confusion_matrix'] == [
+        [1, 0, 0],
+        [1, 1, 0],
+        [1, 0, 1]
+    ]
+
+
+def test_batches_accumulate_like_one_pass():
+    whole = EvaluationAccumulator(3)
+    whole.update(PROBABILITIES, LABELS)
+    batched = EvaluationAccumulator(3)
+    for start in range(0, len(LABELS), 2):
+        batched.update(PROBABILITIES[start:start + 2], LABELS[start:start + 2])
+    batched.update(np.zeros((0, 3)), np.zeros(0))
+    assert batched.report()['confusion_matrix'] == whole.report()['confusion_matrix']
+    assert batched.report()['top_k_accuracy'] == whole.report()['top_k_accuracy']
+    assert batched.report()['loss'] == pytest.approx(whole.report()['loss'])
+
+
+def test_top_k_accuracy():
+    accumulator = EvaluationAccumulator(3, top_k=(1, 2, 3, 5))
+    accumulator.update(PROBABILITIES, LABELS)
+    report = accumulator.report()
+    # k larger than the number of classes is dropped
+    assert report['top_k_accuracy'] == pytest.approx({'1': 0.6, '2': 0.8, '3': 1.0})
+    assert report['accuracy'] == pytest.approx(0.6)
+
+
+def test_ties_count_in_the_labels_favour():
+    accumulator = EvaluationAccumulator(3, top_k=(1,))
+    accumulator.update(np.array([[0.4, 0.4, 0.2]]), np.array([1]))
+    assert accumulator.report()['top_k_accuracy'] == {'1': 1.0}
+
+
+def test_per_class_and_averages():
+    accumulator = EvaluationAccumulator(4)
+    accumulator.update(PROBABILITIES[:, [0, 1, 2, 2]] * [1, 1, 1, 0], LABELS)
+    report = accumulator.report(class_names=['a', 'b', 'c', 'd'])
+    per_class = {entry['class']: entry for entry in report['per_class']}
+
+    assert per_class['a']['precision'] == pytest.approx(1 / 3)
+    assert per_class['a']['recall'] == 1.0
+    assert per_class['b']['precision'] == 1.0
+    assert per_class['b']['recall'] == 0.5
+    assert per_class['d'] == {'index': 3, 'class': 'd', 'precision': 0.0, 'recall': 0.0, 'f1': 0.0, 'support': 0}
+    # Classes without support are left out of the macro average
+    assert report['recall']['macro'] == pytest.approx((1.0 + 0.5 + 0.5) / 3)
+    assert report['recall']['weighted'] == pytest.approx(report['accuracy'])
+    assert report['loss'] == pytest.approx(-np.log([0.7, 0.6, 0.3, 0.1, 0.6]).mean())
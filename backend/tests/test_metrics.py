@@ -0,0 +1,21 @@
+from metrics import Registry
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    requests = registry.counter('requests_total', 'Requests by path\nand "status"', labelnames=('path',))
+    requests.inc(path='C:\\parts\\"disc"\npad')
+
+    lines = registry.render().splitlines()
+    assert '# HELP requests_total Requests by path\\nand "status"' in lines
+    assert 'requests_total{path="C:\\\\parts\\\\\\"disc\\"\\npad"} 1.0' in lines
+
+
+def test_histogram_labels_are_escaped():
+    registry = Registry()
+    latency = registry.histogram('latency_seconds', 'Latency', labelnames=('part',), buckets=(1.0,))
+    latency.observe(0.5, part='a"b')
+
+    lines = registry.render().splitlines()
+    assert 'latency_seconds_bucket{part="a\\"b",le="1.0"} 1' in lines
+    assert 'latency_seconds_count{part="a\\"b"} 1' in lines
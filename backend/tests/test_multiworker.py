@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import time
+import subprocess
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('matplotlib')
+cv2 = pytest.importorskip('cv2')
+import improved_train
+import improved_parts_classifier
+
+TRAIN_SCRIPT = improved_train.__file__
+
+
+def make_dataset(root, classes=2, images_per_class=12, size=32):
+    rng = np.random.default_rng(0)
+    for class_index in range(classes):
+        folder = root / f"part_{class_index}"
+        folder.mkdir(parents=True)
+        for i in range(images_per_class):
+            # Each class gets its own dominant colour so one step can learn something
+            image = rng.integers(0, 64, (size, size, 3), dtype=np.uint8)
+            image[..., class_index % 3] += 160
+            cv2.imwrite(str(folder / f"{i}.jpg"), image)
+
+
+def test_unverified_keras_is_refused(monkeypatch):
+    import keras
+    monkeypatch.setattr(keras, '__version__', '3.99.0')
+    with pytest.raises(RuntimeError, match='3.99.0'):
+        improved_parts_classifier.check_multi_worker_keras()
+
+
+def test_keras_patches_are_undone():
+    import keras
+    from keras.src.backend.tensorflow import trainer
+    classifier = improved_parts_classifier.ImprovedPartsClassifier(data_dir=None)
+    classifier.model = keras.Sequential([keras.layers.Dense(1)])
+    original = trainer.reduce_per_replica
+
+    with classifier._multi_worker_keras():
+        assert trainer.reduce_per_replica is original
+    classifier.num_workers = 2
+    with pytest.raises(KeyError):
+        with classifier._multi_worker_keras():
+            assert trainer.reduce_per_replica is not original
+            assert '_maybe_symbolic_build' in vars(classifier.model)
+            raise KeyError
+    assert trainer.reduce_per_replica is original
+    assert '_maybe_symbolic_build' not in vars(classifier.model)
+
+
+def test_worker_failure_stops_the_others(tmp_path):
+    # Worker 1 fails right away; worker 0 would otherwise wait forever (like a blocked all-reduce)
+    worker = tmp_path / 'worker.py'
+    worker.write_text(
+        "import sys, time\n"
+        "index = int(sys.argv[sys.argv.index('--worker_index') + 1])\n"
+        "if index == 1:\n"
+        "    sys.exit(3)\n"
+        "time.sleep(120)\n"
+    )
+    start = time.monotonic()
+    exit_code = improved_train.launch_workers(2, command=[sys.executable, str(worker)])
+    assert exit_code == 3
+    assert time.monotonic() - start < 60
+
+
+def test_two_workers_train_in_sync(tmp_path):
+    data_dir = tmp_path / 'data'
+    make_dataset(data_dir)
+    command = [
+        sys.executable, TRAIN_SCRIPT,
+        '--data_dir', str(data_dir),
+        '--workers', '2',
+        '--loader', 'tfdata',
+        '--model_choice', 'mobilenet',
+        '--weights', 'none',
+        '--head_units', '8',
+        '--img_size', '32',
+        '--batch_size', '2',
+        '--epochs', '1',
+        '--fine_tune_epochs', '1',
+        '--validation_split', '0.25',
+        '--model_path', str(tmp_path / 'model.h5'),
+        '--worker_summary', str(tmp_path / 'summary')
+    ]
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    result = subprocess.run(command, cwd=tmp_path, env=env, timeout=900)
+    assert result.returncode == 0
+
+    summaries = []
+    for index in range(2):
+        with open(tmp_path / f"summary.worker-{index}.json") as f:
+            summaries.append(json.load(f))
+    assert [summary['num_workers'] for summary in summaries] == [2, 2]
+    assert summaries[0]['metrics'] == pytest.approx(summaries[1]['metrics'], rel=1e-6)
+    # The all-reduce may add the workers' gradients in a different order on each worker
+    np.testing.assert_allclose(summaries[0]['weights_fingerprint'], summaries[1]['weights_fingerprint'],
+                               rtol=1e-6, atol=1e-6)
+    # Only the chief saves the model
+    assert (tmp_path / 'model.h5').exists()
@@ -0,0 +1,82 @@
+import numpy as np
+import prediction_cache
+from prediction_cache import PredictionCache
+
+
+def test_make_key_depends_on_model_version_and_contents():
+    key = PredictionCache.make_key(b"image", "v1")
+    assert key == PredictionCache.make_key(b"image", "v1")
+    assert key != PredictionCache.make_key(b"image", "v2")
+    assert key != PredictionCache.make_key(b"other", "v1")
+
+
+def test_lru_evicts_least_recently_used():
+    cache = PredictionCache(max_entries=2, ttl=None)
+    cache.put('a', np.array([1.0]))
+    cache.put('b', np.array([2.0]))
+    assert cache.get('a') is not None  # 'b' is now the least recently used
+    cache.put('c', np.array([3.0]))
+
+    assert cache.get('b') is None
+    assert cache.get('a')[0] == 1.0
+    assert cache.get('c')[0] == 3.0
+    assert cache.stats()['entries'] == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_put_copies_the_row():
+    cache = PredictionCache(ttl=None)
+    outputs = np.array([[0.1, 0.9], [0.8, 0.2]], dtype=np.float32)
+    cache.put('a', outputs[0])
+    outputs[0] = 0
+    np.testing.assert_array_equal(cache.get('a'), np.array([0.1, 0.9], dtype=np.float32))
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, 'time', lambda: now[0])
+    cache = PredictionCache(ttl=10)
+    cache.put('a', np.array([1.0]))
+
+    now[0] += 5
+    assert cache.get('a') is not None
+    now[0] += 6
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_sqlite_file_is_shared_between_caches(tmp_path):
+    path = str(tmp_path / 'cache' / 'predictions.sqlite')
+    writer = PredictionCache(ttl=None, disk_path=path)
+    reader = PredictionCache(ttl=None, disk_path=path)
+    row = np.array([0.25, 0.75], dtype=np.float32)
+    writer.put('a', row)
+
+    cached = reader.get('a')
+    np.testing.assert_array_equal(cached, row)
+    assert cached.dtype == np.float32
+    assert reader.disk_hits == 1
+    # The disk hit now lives in the reader's memory as well
+    assert reader.get('a') is not None
+    assert reader.disk_hits == 1
+
+
+def test_expired_disk_entries_are_misses(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(prediction_cache.time, 'time', lambda: now[0])
+    path = str(tmp_path / 'predictions.sqlite')
+    PredictionCache(ttl=10, disk_path=path).put('a', np.array([1.0]))
+
+    now[0] += 11
+    assert PredictionCache(ttl=10, disk_path=path).get('a') is None
+
+
+def test_disk_errors_do_not_fail_put_or_get(tmp_path):
+    cache = PredictionCache(ttl=None, disk_path=str(tmp_path / 'predictions.sqlite'))
+    cache._disk.execute("DROP TABLE predictions")
+
+    cache.put('a', np.array([1.0]))
+    # The row is still served from memory; the disk only missed it
+    assert cache.get('a')[0] == 1.0
+    assert cache.get('b') is None
+    assert cache.stats()['disk_errors'] == 2
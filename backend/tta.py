@@ -0,0 +1,105 @@
+import math
+import functools
+from collections import namedtuple
+import numpy as np
+
+# One augmented view of an image: horizontal flip, zoom into the centre (1.15
+# crops away the outer 13%) and rotation in degrees, all about the image centre
+View = namedtuple('View', ['flip', 'zoom', 'angle'], defaults=(False, 1.0, 0.0))
+
+# Views averaged with the original image: flips, centre crops and small rotations,
+# the differences between photos of the same part taken from different angles
+DEFAULT_VIEWS = (
+    View(flip=True),
+    View(zoom=1.15),
+    View(flip=True, zoom=1.15),
+    View(angle=12.0),
+    View(angle=-12.0)
+)
+
+
+@functools.lru_cache(maxsize=16)
+def sampling_plan(height, width, views):
+    """
+    Bilinear sampling indices and weights for a set of views, computed once per input size
+
+    Each output pixel of each view maps back to a point in the source image
+    (clamped to the border, like the training augmentation's 'nearest' fill);
+    its value is a weighted sum of the four surrounding source pixels.
+
+    Returns:
+        (flat pixel indices of shape (4, len(views), height * width),
+         weights of shape (4, len(views), height * width, 1))
+    """
+    ys, xs = np.mgrid[0:height, 0:width].astype(np.float64)
+    cy, cx = (height - 1) / 2, (width - 1) / 2
+    indices = np.empty((4, len(views), height * width), dtype=np.int64)
+    weights = np.empty((4, len(views), height * width, 1), dtype=np.float32)
+
+    for v, view in enumerate(views):
+        # Invert the view's transform: undo the flip, then the zoom, then the rotation
+        u = (xs - cx) * (-1 if view.flip else 1) / view.zoom
+        w = (ys - cy) / view.zoom
+        theta = math.radians(view.angle)
+        src_x = np.clip(cx + u * math.cos(theta) + w * math.sin(theta), 0, width - 1)
+        src_y = np.clip(cy - u * math.sin(theta) + w * math.cos(theta), 0, height - 1)
+
+        x0 = np.floor(src_x).astype(np.int64)
+        y0 = np.floor(src_y).astype(np.int64)
+        x1 = np.minimum(x0 + 1, width - 1)
+        y1 = np.minimum(y0 + 1, height - 1)
+        fx = src_x - x0
+        fy = src_y - y0
+        for corner, (y, x, weight) in enumerate(((y0, x0, (1 - fy) * (1 - fx)), (y0, x1, (1 - fy) * fx),
+                                                 (y1, x0, fy * (1 - fx)), (y1, x1, fy * fx))):
+            indices[corner, v] = (y * width + x).ravel()
+            weights[corner, v, :, 0] = weight.ravel()
+    return indices, weights
+
+
+def augment(images, views=DEFAULT_VIEWS, include_original=True):
+    """
+    Build every view of every image in one vectorized pass
+
+    Args:
+        images: Float32 array of shape (N, H, W, C) of preprocessed images
+        views: Sequence of View
+        include_original: Put each unmodified image first, before its views
+
+    Returns:
+        Float32 array of shape (N * V, H, W, C), grouped by image, where V is
+        len(views), plus one with include_original
+    """
+    n, height, width, channels = images.shape
+    indices, weights = sampling_plan(height, width, tuple(views))
+    flat = images.reshape(n, height * width, channels)
+
+    offset = 1 if include_original else 0
+    out = np.empty((n, len(views) + offset, height * width, channels), dtype=np.float32)
+    if include_original:
+        out[:, 0] = flat
+    augmented = out[:, offset:]
+    np.multiply(np.take(flat, indices[0], axis=1), weights[0], out=augmented)
+    for corner in range(1, 4):
+        augmented += np.take(flat, indices[corner], axis=1) * weights[corner]
+    return out.reshape(-1, height, width, channels)
+
+
+def average_views(first, views, num_columns=None):
+    """
+    Average each image's first-pass output with the outputs for its views
+
+    Args:
+        first: Outputs for the original images, shape (N, C)
+        views: Outputs for augment(..., include_original=False), shape (N * V, C')
+        num_columns: Leading columns to average (default: all of first); later
+                     columns, e.g. an appended embedding, keep the first pass's values
+
+    Returns:
+        New float32 array shaped like first
+    """
+    first = np.array(first, dtype=np.float32)
+    num_columns = num_columns or first.shape[1]
+    view_outputs = np.asarray(views)[:, :num_columns].reshape(len(first), -1, num_columns)
+    first[:, :num_columns] = (first[:, :num_columns] + view_outputs.sum(axis=1)) / (view_outputs.shape[1] + 1)
+    return first
@@ -0,0 +1,128 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import cv2
+
+# Longest side of a saved visualization; larger decoded images are scaled down first
+MAX_RENDER_SIDE = 800
+
+
+def render_overlay(image_bgr, predicted_class, confidence):
+    """
+    Draw the prediction as a text banner over the top of an image
+
+    Args:
+        image_bgr: Decoded BGR uint8 image (not modified)
+        predicted_class: Predicted class name
+        confidence: Prediction confidence (0-1)
+
+    Returns:
+        New BGR uint8 image with the banner drawn on it
+    """
+    height, width = image_bgr.shape[:2]
+    scale = min(1.0, MAX_RENDER_SIDE / max(height, width))
+    if scale < 1.0:
+        canvas = cv2.resize(image_bgr, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+    else:
+        canvas = image_bgr.copy()
+    height, width = canvas.shape[:2]
+
+    lines = [f"Predicted: {predicted_class}", f"Confidence: {confidence:.2%}"]
+    font_scale = max(0.4, width / 800)
+    thickness = max(1, int(round(font_scale * 2)))
+    line_height = int(30 * font_scale) + 6
+
+    # Darken the banner area in place instead of blending a whole overlay image
+    banner = canvas[:min(height, line_height * len(lines) + 8)]
+    banner //= 3
+    for i, line in enumerate(lines):
+        cv2.putText(canvas, line, (8, line_height * (i + 1)), cv2.FONT_HERSHEY_SIMPLEX, font_scale,
+                    (255, 255, 255), thickness, cv2.LINE_AA)
+    return canvas
+
+
+class VisualizationRenderer:
+    def __init__(self, save_dir, num_workers=2, max_images=None, every=1, max_pending=64):
+        """
+        Save prediction visualizations on a background thread pool.
+
+        Predictions are handed over together with the image that was already
+        decoded for the model, so nothing is read from disk twice, and the
+        prediction loop only blocks when max_pending renders are queued.
+
+        Args:
+            save_dir: Directory the visualizations are written to (created if missing)
+            num_workers: Number of rendering threads (default: 2)
+            max_images: Stop after this many visualizations, or None for no limit
+            every: Only render every n-th prediction (default: 1, all of them)
+            max_pending: Renders that may be queued before submit blocks (default: 64)
+        """
+        self.save_dir = Path(save_dir)
+        self.save_dir.mkdir(parents=True, exist_ok=True)
+        self.max_images = max_images
+        self.every = max(1, every)
+        self.seen = 0
+        self.accepted = 0
+        self.saved = 0
+        self.failed = 0
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="render")
+
+    def wants(self):
+        """
+        Whether the next prediction should be rendered, given the cap and sampling
+
+        Each call counts as one prediction seen, so call it exactly once per prediction.
+        """
+        self.seen += 1
+        if (self.seen - 1) % self.every:
+            return False
+        return self.max_images is None or self.accepted < self.max_images
+
+    def submit(self, image_path, image_bgr, predicted_class, confidence):
+        """
+        Queue one visualization; blocks while max_pending renders are outstanding
+
+        Args:
+            image_path: Path of the source image (names the output file)
+            image_bgr: Decoded BGR uint8 image; must not be modified afterwards
+            predicted_class: Predicted class name
+            confidence: Prediction confidence (0-1)
+        """
+        self.accepted += 1
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._render, image_path, image_bgr, predicted_class, confidence)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+
+    def _render(self, image_path, image_bgr, predicted_class, confidence):
+        output_path = self.save_dir / f"pred_{Path(image_path).stem}.png"
+        try:
+            canvas = render_overlay(image_bgr, predicted_class, confidence)
+            # Fast PNG compression: the files are for eyeballing, not archiving
+            if not cv2.imwrite(str(output_path), canvas, [cv2.IMWRITE_PNG_COMPRESSION, 1]):
+                raise OSError(f"could not write {output_path}")
+        except Exception as e:
+            print(f"Error saving visualization for {image_path}: {e}")
+            with self._lock:
+                self.failed += 1
+            return
+        with self._lock:
+            self.saved += 1
+
+    def close(self):
+        """
+        Wait for all queued renders to finish
+
+        Returns:
+            Number of visualizations saved
+        """
+        self._executor.shutdown(wait=True)
+        print(f"Saved {self.saved} visualizations to {os.fspath(self.save_dir)}"
+              + (f" ({self.failed} failed)" if self.failed else ""))
+        return self.saved
@@ -29,6 +29,8 @@ const API_BASE_URL = getApiBaseUrl();
 export const API_ENDPOINTS = {
   PREDICT: `${API_BASE_URL}/predict`,
   HEALTH: `${API_BASE_URL}/health`,
+  DETECT: `${API_BASE_URL}/detect`,
+  PREDICT_STREAM: `${API_BASE_URL.replace(/^http/, "ws")}/ws/predict`,
 };
 
 export default API_BASE_URL; 
\ No newline at end of file